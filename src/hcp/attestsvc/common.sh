@@ -14,9 +14,70 @@ if [[ -z $HCP_ATTESTSVC_USER_FLASK ]]; then
 	export HCP_ATTESTSVC_USER_FLASK=ahcpflask
 fi
 export HCP_ATTESTSVC_REMOTE_REPO=$(echo "$HCP_ATTESTSVC_JSON" | jq -r ".enrollsvc")
+# If the enrollsvc DB is sharded (see enrollsvc/db_common.py), '.shards' lists
+# the shards to replicate (eg. [ "0", "1" ]), each from its own repo, which is
+# the '.enrollsvc' URL with "-<shard>" appended. Empty means the DB isn't
+# sharded, and '.enrollsvc' is the (one and only) repo.
+export HCP_ATTESTSVC_SHARDS=$(echo "$HCP_ATTESTSVC_JSON" | jq -r ".shards // [] | .[]")
+# If '.depth' is set, the clones are shallow, with (about) that many commits of
+# history rather than all of it, see init_clones.sh and updater_loop.sh. If
+# '.prefixes' is set (eg. [ "0", "1a" ], each one or two hex digits), the
+# replica only serves the enrollments whose ekpubhash starts with one of them.
+# The clones are then partial (no file contents are fetched until they're
+# needed) and sparse (only those 'ekpubhash/' plies are checked out).
+export HCP_ATTESTSVC_DEPTH=$(echo "$HCP_ATTESTSVC_JSON" | jq -r ".depth // empty")
+export HCP_ATTESTSVC_PREFIXES=$(echo "$HCP_ATTESTSVC_JSON" | jq -r ".prefixes // [] | .[]")
 
 export HCP_ATTESTSVC_DB_DIR="$HCP_ATTESTSVC_STATE/db"
 
+# The directories that updater_loop.sh keeps up to date, each having the A/B
+# clones and the current/next symlinks. Without sharding, that's the DB dir
+# itself. With sharding, it's one per shard, under 'shards/', and the DB dir's
+# 'current' is a directory of symlinks (one per top-level 'ekpubhash/' ply)
+# that point into each shard's 'current', so the attestation server sees one
+# DB, of the shards we replicate.
+function replica_dirs {
+	if [[ -z $HCP_ATTESTSVC_SHARDS ]]; then
+		echo "$HCP_ATTESTSVC_DB_DIR"
+		return
+	fi
+	for s in $HCP_ATTESTSVC_SHARDS; do
+		echo "$HCP_ATTESTSVC_DB_DIR/shards/$s"
+	done
+}
+
+# The top-level 'ekpubhash/' plies (2 hex digits) that a shard covers
+function shard_plies {
+	if [[ ${#1} == 2 ]]; then
+		echo "$1"
+		return
+	fi
+	for x in 0 1 2 3 4 5 6 7 8 9 a b c d e f; do
+		echo "$1$x"
+	done
+}
+
+# The top-level 'ekpubhash/' plies that '.prefixes' covers (nothing if it isn't
+# set, meaning all of them)
+function prefix_plies {
+	for p in $HCP_ATTESTSVC_PREFIXES; do
+		shard_plies $p
+	done
+}
+
+# Whether the replica serves the top-level 'ekpubhash/' ply $1
+function ply_served {
+	if [[ -z $HCP_ATTESTSVC_PREFIXES ]]; then
+		return 0
+	fi
+	for p in $HCP_ATTESTSVC_PREFIXES; do
+		if [[ $1 == $p* ]]; then
+			return 0
+		fi
+	done
+	return 1
+}
+
 if [[ $WHOAMI == "root" ]]; then
 	hcp_config_user_init $HCP_ATTESTSVC_USER_DB
 	hcp_config_user_init $HCP_ATTESTSVC_USER_FLASK
@@ -1,9 +1,17 @@
 # The 'sbin/attest-server' in safeboot already declares a flask app, called
 # "app", and will run it using flask's built-in dev/debug server if executed
 # directly. Here, we simply reuse that 'app' object and its API handlers, and
-# we add our healthcheck handler. This gets loaded by uwsgi, in run_hcp.sh.
+# we add our healthcheck and metrics handlers. This gets loaded by uwsgi, in
+# run_hcp.sh.
 
 import sys
+import os
+import json
+import glob
+from flask import Response
+
+sys.path.insert(1, '/hcp/common')
+from hcp_common import hcp_config_extract
 
 sys.path.insert(1, '/install-safeboot/sbin')
 from attest_server import app
@@ -14,3 +22,84 @@ def hcp_healthcheck():
     return '''
 <h1>Healthcheck</h1>
 '''
+
+# Replication metrics, in the Prometheus text format. The replication client
+# (attestsvc/updater_loop.sh) writes a 'metrics.json' for each replica it
+# maintains (the DB dir, or one per shard, see replica_dirs in
+# attestsvc/common.sh) and touches 'verified' whenever the replica is known to
+# be up to date. Here we just relay those, labelled by 'replica' (the shard,
+# or "" if the DB isn't sharded).
+db_dir = f"{hcp_config_extract('.attestsvc.state', must_exist = True)}/db"
+
+# (name, field, type, help)
+metrics = [
+    ('hcp_replica_commit_timestamp_seconds', 'commit_time', 'gauge',
+        'Committer time of the commit the replica serves.'),
+    ('hcp_replica_behind_commits', 'behind_commits', 'gauge',
+        'Commits the replica is behind upstream (-1 if not yet fetched).'),
+    ('hcp_replica_behind_seconds', 'behind_seconds', 'gauge',
+        'Age of the oldest upstream commit the replica is missing.'),
+    ('hcp_replica_lag_seconds', 'lag_seconds', 'gauge',
+        'How long the commits taken by the last update had been waiting.'),
+    ('hcp_replica_fetch_seconds', 'fetch_ms', 'gauge',
+        'Duration of the last fetch.'),
+    ('hcp_replica_update_seconds', 'update_ms', 'gauge',
+        'Duration of the last update (moving to what was fetched).'),
+    ('hcp_replica_updates_total', 'updates_total', 'counter',
+        'Commits taken since the replication client started.'),
+    ('hcp_replica_failures_total', 'failures_total', 'counter',
+        'Failed updates since the replication client started.'),
+    ('hcp_replica_consecutive_failures', 'failures_consecutive', 'gauge',
+        'Failed updates since the last successful one.'),
+    ('hcp_replica_last_success_timestamp_seconds', 'last_success', 'gauge',
+        'Time of the last successful update.'),
+    ('hcp_replica_last_attempt_timestamp_seconds', 'last_attempt', 'gauge',
+        'Time of the last update attempt.'),
+    ('hcp_replica_last_verified_timestamp_seconds', 'verified', 'gauge',
+        'Last time the replica was known to be up to date.')
+]
+
+def replicas():
+    result = {}
+    paths = [ ('', db_dir) ] + [ (os.path.basename(x), x)
+        for x in sorted(glob.glob(f"{db_dir}/shards/*")) ]
+    for name, path in paths:
+        try:
+            with open(f"{path}/metrics.json", 'r') as f:
+                m = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        try:
+            m['verified'] = int(os.stat(f"{path}/verified").st_mtime)
+        except FileNotFoundError:
+            m['verified'] = 0
+        m['transient_failure'] = int(os.path.exists(
+            f"{path}/transient-failure"))
+        result[name] = m
+    return result
+
+def label(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+@app.route('/metrics', methods=['GET'])
+def hcp_metrics():
+    data = replicas()
+    lines = [
+        '# HELP hcp_replica_info The commits the replica has and upstream has.',
+        '# TYPE hcp_replica_info gauge' ]
+    for name, m in data.items():
+        lines.append(f'hcp_replica_info{{replica="{label(name)}",'
+            f'commit="{label(m.get("commit", ""))}",'
+            f'upstream="{label(m.get("upstream", ""))}"}} 1')
+    for metric, field, kind, text in metrics + [
+            ('hcp_replica_transient_failure', 'transient_failure', 'gauge',
+                'Whether the last update failed.') ]:
+        lines.append(f"# HELP {metric} {text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, m in data.items():
+            value = m.get(field, 0)
+            if field.endswith('_ms'):
+                value = value / 1000
+            lines.append(f'{metric}{{replica="{label(name)}"}} {value}')
+    return Response('\n'.join(lines) + '\n',
+        content_type = 'text/plain; version=0.0.4; charset=utf-8')
@@ -6,15 +6,63 @@ expect_db_user
 
 cd $HCP_ATTESTSVC_DB_DIR
 
-if [[ -d A || -d B || -h current || -h next || -h thirdwheel ]]; then
+if [[ -d A || -d B || -e current || -h next || -h thirdwheel || -d shards ]]; then
 	echo "Error, updater state half-baked?" >&2
 	exit 1
 fi
 
-echo "First-time initialization of $HCP_ATTESTSVC_DB_DIR. Two clones and two symlinks." >&2
-git clone -o origin $HCP_ATTESTSVC_REMOTE_REPO A
-git clone -o twin A B
-ln -s A current
-ln -s B next
-(cd A && git remote add twin ../B)
-(cd B && git remote add origin $HCP_ATTESTSVC_REMOTE_REPO)
+# With '.depth', the clones only get that much history. (B is a local clone of
+# A, which copies A's shallowness along with everything else.) With
+# '.prefixes', they're partial clones (fetching the contents of whatever gets
+# checked out, lazily, from the enrollsvc) with only the top-level files and
+# the plies we serve checked out. B can't get those contents from A (it
+# doesn't have them either), so it clones from the enrollsvc too.
+CLONE_ARGS=
+if [[ -n $HCP_ATTESTSVC_DEPTH ]]; then
+	CLONE_ARGS="--depth $HCP_ATTESTSVC_DEPTH"
+fi
+if [[ -n $HCP_ATTESTSVC_PREFIXES ]]; then
+	CLONE_ARGS="$CLONE_ARGS --filter=blob:none --sparse"
+fi
+
+function init_clone {
+	git clone $CLONE_ARGS -o origin $1 $2
+	if [[ -n $HCP_ATTESTSVC_PREFIXES ]]; then
+		git -C $2 sparse-checkout set $(prefix_plies | sed -e "s,^,ekpubhash/,")
+	fi
+}
+
+# Two clones and two symlinks, in the current directory
+function init_pair {
+	init_clone $1 A
+	if [[ -z $HCP_ATTESTSVC_PREFIXES ]]; then
+		git clone -o twin A B
+		(cd B && git remote add origin $1)
+	else
+		init_clone $1 B
+		(cd B && git remote add twin ../A)
+	fi
+	ln -s A current
+	ln -s B next
+	(cd A && git remote add twin ../B)
+}
+
+if [[ -z $HCP_ATTESTSVC_SHARDS ]]; then
+	echo "First-time initialization of $HCP_ATTESTSVC_DB_DIR. Two clones and two symlinks." >&2
+	init_pair $HCP_ATTESTSVC_REMOTE_REPO
+	exit 0
+fi
+
+# Sharded, see replica_dirs in common.sh
+echo "First-time initialization of $HCP_ATTESTSVC_DB_DIR, shards:" $HCP_ATTESTSVC_SHARDS >&2
+mkdir -p current/ekpubhash shards
+for s in $HCP_ATTESTSVC_SHARDS; do
+	mkdir shards/$s
+	(cd shards/$s && init_pair $HCP_ATTESTSVC_REMOTE_REPO-$s)
+	for ply in $(shard_plies $s); do
+		if ! ply_served $ply; then
+			continue
+		fi
+		ln -s ../../shards/$s/current/ekpubhash/$ply current/ekpubhash/$ply
+	done
+done
@@ -0,0 +1,30 @@
+import sys
+import json
+import requests
+
+# Usage: notify_wait.py <url> <generation> <timeout>
+#
+# Waits (up to <timeout> seconds) for the enrollsvc's DB to move on from
+# <generation>, by long-polling its repl_notify service at <url> (see
+# enrollsvc/repl_notify.py), and prints the response ({ 'generation', 'heads'
+# }) to stdout. An empty <generation> returns the current one straight away.
+# Exits non-zero if the notifier couldn't be reached, in which case the caller
+# should fall back to polling.
+
+if len(sys.argv) != 4:
+	print(f"Wrong number of arguments: {len(sys.argv)}", file = sys.stderr)
+	sys.exit(2)
+
+url, since, timeout = sys.argv[1], sys.argv[2], int(sys.argv[3])
+params = { 'timeout': timeout }
+if since:
+	params['since'] = since
+try:
+	r = requests.get(f"{url.rstrip('/')}/v1/generation", params = params,
+			timeout = (3.05, timeout + 10))
+	r.raise_for_status()
+	result = r.json()
+except (requests.RequestException, ValueError) as e:
+	print(f"notify_wait: {e}", file = sys.stderr)
+	sys.exit(1)
+print(json.dumps(result))
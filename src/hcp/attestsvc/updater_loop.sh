@@ -8,19 +8,175 @@ export HCP_ATTESTSVC_UPDATE_TIMER=$(hcp_config_extract ".replication_client.peri
 
 BACKOFF_TIMER=$(($HCP_ATTESTSVC_UPDATE_TIMER * 5))
 
+# If '.replication_client.notify' is set (the URL of the enrollsvc's
+# repl_notify service, see enrollsvc/repl_notify.py), then rather than sleeping
+# for the period between updates, we long-poll it, so we hear about new commits
+# as soon as they land, and we only fetch the replicas whose repo has actually
+# changed (so when the DB is idle, we don't fetch at all). Each wait lasts up
+# to 'notify_timeout' seconds (default 60). If the notifier can't be reached,
+# we fall back to sleeping for the period and fetching everything.
+NOTIFY_URL=$(hcp_config_extract_or ".replication_client.notify" "")
+NOTIFY_TIMEOUT=$(hcp_config_extract_or ".replication_client.notify_timeout" 60)
+GENERATION=
+HEADS=
+
+# With '.attestsvc.depth' (see init_clones.sh), fetches are limited to that
+# many commits, so a replica that's far behind doesn't fetch history it has no
+# use for. That moves the clone's shallow boundary along, but the history it
+# had still takes up space, so every 'reshallow' seconds (default 3600), each
+# clone drops it, see reshallow. With '.attestsvc.prefixes', the clones are
+# partial, so they can't give each other the contents of what they fetch, and
+# they fetch from origin only.
+FETCH_ARGS=
+if [[ -n $HCP_ATTESTSVC_DEPTH ]]; then
+	FETCH_ARGS="--depth $HCP_ATTESTSVC_DEPTH"
+fi
+RESHALLOW_TIMER=$(hcp_config_extract_or ".replication_client.reshallow" 3600)
+declare -A LAST_RESHALLOW
+STARTED=$(date +%s)
+
+# Per-replica counters for write_metrics, keyed by replica directory, and the
+# timings of the latest pull_updates.
+declare -A FAILURES_TOTAL FAILURES_RUN UPDATES_TOTAL LAST_SUCCESS
+FETCH_MS=0
+UPDATE_MS=0
+TAKEN=0
+LAG=0
+
 function datetime_log {
 	d=`date +"%Y%m%d-%H%M%S"`
 	echo "$d: $1"
 }
 
+# We never change anything locally, so we just move to whatever we fetched,
+# rather than merging it. That's the same as a fast-forward merge in the usual
+# case, and it also follows the enrollsvc when it squashes old history into a
+# checkpoint (see enrollsvc/db_maint.py), which is a non-fast-forward update
+# that a merge would choke on.
 function pull_updates {
-	(git fetch twin && git fetch origin) || return 1
+	TAKEN=0
+	LAG=0
+	UPDATE_MS=0
+	t0=$(date +%s%N)
+	if [[ -z $HCP_ATTESTSVC_PREFIXES ]] && ! git fetch $FETCH_ARGS twin; then
+		FETCH_MS=$(( ($(date +%s%N) - t0) / 1000000 ))
+		return 1
+	fi
+	if ! git fetch $FETCH_ARGS origin; then
+		FETCH_MS=$(( ($(date +%s%N) - t0) / 1000000 ))
+		return 1
+	fi
+	FETCH_MS=$(( ($(date +%s%N) - t0) / 1000000 ))
 	updates=$(git log ..origin/master --oneline | wc -l)
 	if [[ $updates -eq 0 ]]; then
 		return 0
 	fi
-	datetime_log "merging $updates update(s)"
-	git merge origin/master > /dev/null
+	datetime_log "taking $updates update(s)"
+	oldest=$(git log --reverse --format=%ct ..origin/master | head -n 1)
+	t0=$(date +%s%N)
+	git reset -q --hard origin/master || return 1
+	UPDATE_MS=$(( ($(date +%s%N) - t0) / 1000000 ))
+	TAKEN=$updates
+	LAG=$(( $(date +%s) - oldest ))
+}
+
+# Drops whatever history the clone in the current directory has beyond its
+# shallow boundary (once fetches have moved it along), ie. everything that
+# isn't reachable from what was fetched. The remote-tracking refs for the twin
+# and ORIG_HEAD (from the last update) would keep older commits alive, so they
+# go too. The next fetch from the twin restores its refs.
+function reshallow {
+	for ref in $(git for-each-ref --format='%(refname)' refs/remotes/twin); do
+		git update-ref --no-deref -d $ref
+	done
+	git update-ref -d ORIG_HEAD 2> /dev/null || true
+	git reflog expire --expire=now --all
+	git gc -q --prune=now
+}
+
+# Whether clone $1 is due a reshallow
+function reshallow_due {
+	[[ -n $HCP_ATTESTSVC_DEPTH ]] && \
+		(( $(date +%s) - ${LAST_RESHALLOW[$1]:-$STARTED} >= RESHALLOW_TIMER ))
+}
+
+function wait_for_change {
+	if [[ -n $NOTIFY_URL ]]; then
+		if out=$(python3 /hcp/attestsvc/notify_wait.py "$NOTIFY_URL" \
+				"$GENERATION" "$NOTIFY_TIMEOUT"); then
+			GENERATION=$(echo "$out" | jq -r '.generation')
+			HEADS=$(echo "$out" | jq -c '.heads')
+			return
+		fi
+		datetime_log "notifier unreachable, sleeping for $HCP_ATTESTSVC_UPDATE_TIMER seconds"
+	fi
+	GENERATION=
+	HEADS=
+	sleep $HCP_ATTESTSVC_UPDATE_TIMER
+}
+
+# Whether the replica in directory $1 is behind the notifier's HEADs (or we
+# don't have them). The repo's name is the last part of its origin URL.
+function replica_stale {
+	if [[ -z $HEADS ]]; then
+		return 0
+	fi
+	repo=$(git -C $1/current config remote.origin.url)
+	repo=$(basename "$repo" .git)
+	want=$(echo "$HEADS" | jq -r --arg r "$repo" '.[$r] // empty')
+	have=$(git -C $1/current rev-parse -q --verify HEAD || true)
+	[[ -z $want || $want != $have ]]
+}
+
+# Writes $1/metrics.json, which the attestation server's /metrics (see
+# hcp_api.py) serves. It has the replica's commit (and its committer time), the
+# upstream commit (what the notifier says, if we have one, otherwise what we
+# last fetched), how far behind that the replica is, in commits (-1 if it
+# hasn't fetched it yet, so it can't tell) and in seconds (since the oldest
+# commit it's missing, or since its last successful update if it can't tell),
+# the timings of the last fetch and update, how long the commits taken by the
+# last update had been waiting ('lag_seconds'), and counters. $1/verified is
+# touched whenever the replica is known to be up to date (whether or not that
+# took an update), its mtime is reported too.
+function write_metrics {
+	local dir=$1
+	cd $dir/current
+	commit=$(git rev-parse -q --verify HEAD || true)
+	commit_time=$(git log -1 --format=%ct HEAD 2> /dev/null || echo 0)
+	upstream=$(git rev-parse -q --verify origin/master || true)
+	if [[ -n $HEADS ]]; then
+		repo=$(basename "$(git config remote.origin.url)" .git)
+		want=$(echo "$HEADS" | jq -r --arg r "$repo" '.[$r] // empty')
+		upstream=${want:-$upstream}
+	fi
+	now=$(date +%s)
+	behind=0
+	behind_secs=0
+	if [[ -n $upstream && $upstream != $commit ]]; then
+		if git cat-file -e "$upstream^{commit}" 2> /dev/null; then
+			behind=$(git rev-list --count HEAD..$upstream)
+			oldest=$(git log --reverse --format=%ct HEAD..$upstream | head -n 1)
+			behind_secs=$(( now - ${oldest:-$now} ))
+		else
+			behind=-1
+			behind_secs=$(( now - ${LAST_SUCCESS[$dir]:-$now} ))
+		fi
+	fi
+	cd $dir
+	jq -n --arg commit "$commit" --arg upstream "$upstream" \
+		--argjson commit_time "$commit_time" \
+		--argjson behind_commits "$behind" \
+		--argjson behind_seconds "$behind_secs" \
+		--argjson lag_seconds "$LAG" \
+		--argjson fetch_ms "$FETCH_MS" \
+		--argjson update_ms "$UPDATE_MS" \
+		--argjson updates_total "${UPDATES_TOTAL[$dir]:-0}" \
+		--argjson failures_total "${FAILURES_TOTAL[$dir]:-0}" \
+		--argjson failures_consecutive "${FAILURES_RUN[$dir]:-0}" \
+		--argjson last_success "${LAST_SUCCESS[$dir]:-0}" \
+		--argjson last_attempt "$now" \
+		'$ARGS.named' > metrics.json.tmp
+	mv metrics.json.tmp metrics.json
 }
 
 # By discipline and convention, we do all our bash with "-e", so make sure to
@@ -38,33 +194,68 @@ function pull_updates {
 # complexity - and new ways for things to go wrong - and is more likely to
 # "bury the lede" when someone sifts through the wreckage later trying to
 # figure out what happened.)
+#
+# If we're replicating shards, each shard is updated (and swapped) in turn,
+# and a failure in one doesn't hold up the others. See replica_dirs.
+DIRS=$(replica_dirs)
 while /bin/true; do
-	cd $HCP_ATTESTSVC_DB_DIR
-	cd next
-	if pull_updates; then
-		cd $HCP_ATTESTSVC_DB_DIR
-		rm -f transient-failure
-		cp -P current thirdwheel
-		cp -T -P next current
-		mv -T thirdwheel next
-		sleep $HCP_ATTESTSVC_UPDATE_TIMER
+	failed=
+	for dir in $DIRS; do
+		if ! replica_stale $dir; then
+			touch $dir/verified
+			continue
+		fi
+		cd $dir
+		cd next
+		if pull_updates; then
+			cd $dir
+			rm -f transient-failure
+			cp -P current thirdwheel
+			cp -T -P next current
+			mv -T thirdwheel next
+			# The clone that was current is now idle (until the
+			# next update), so it's a good time to reshallow it.
+			clone=$dir/$(readlink next)
+			if reshallow_due $clone; then
+				datetime_log "reshallowing $clone"
+				if ! (cd $clone && reshallow); then
+					datetime_log "reshallow failed ($clone)"
+				fi
+				LAST_RESHALLOW[$clone]=$(date +%s)
+			fi
+			UPDATES_TOTAL[$dir]=$(( ${UPDATES_TOTAL[$dir]:-0} + TAKEN ))
+			FAILURES_RUN[$dir]=0
+			LAST_SUCCESS[$dir]=$(date +%s)
+			touch $dir/verified
+		else
+			# TODO: we should alert that the fetch/merge failed.
+			# Such failures would (likely) point to a problem with
+			# the db we're replicating from, meaning the same
+			# failures are likely being reported by other instances
+			# that replicate from the same db. "We" can't provide
+			# much information about the db, beyond signaling the
+			# existence of an issue, so keep it concise.
+			# TODO: on the other hand, if the transient error
+			# handling and recovery steps below fail for any
+			# reason, that is a different matter entirely, and it
+			# means an operator needs to look at this node,
+			# irrespective of whether our troubles were caused by a
+			# db failure. I.e. we need error-handling around our
+			# error-handling, to raise a different kind of alert.
+			datetime_log "Transient error ($dir). Trying to revert from incomplete update."
+			touch $dir/transient-failure
+			git reset --hard
+			git clean -f -d -x
+			failed=1
+			FAILURES_TOTAL[$dir]=$(( ${FAILURES_TOTAL[$dir]:-0} + 1 ))
+			FAILURES_RUN[$dir]=$(( ${FAILURES_RUN[$dir]:-0} + 1 ))
+		fi
+		write_metrics $dir
+	done
+	if [[ -z $failed ]]; then
+		wait_for_change
 	else
-		# TODO: we should alert that the fetch/merge failed. Such
-		# failures would (likely) point to a problem with the db we're
-		# replicating from, meaning the same failures are likely being
-		# reported by other instances that replicate from the same db.
-		# "We" can't provide much information about the db, beyond
-		# signaling the existence of an issue, so keep it concise.
-		# TODO: on the other hand, if the transient error handling and
-		# recovery steps below fail for any reason, that is a different
-		# matter entirely, and it means an operator needs to look at
-		# this node, irrespective of whether our troubles were caused
-		# by a db failure. I.e. we need error-handling around our
-		# error-handling, to raise a different kind of alert.
-		datetime_log "Transient error. Trying to revert from incomplete update."
-		touch $HCP_ATTESTSVC_DB_DIR/transient-failure
-		git reset --hard
-		git clean -f -d -x
+		# Retry what failed, whether or not anything else changes
 		datetime_log "sleeping for $BACKOFF_TIMER seconds"
 		sleep $BACKOFF_TIMER
 	fi
@@ -68,14 +68,15 @@ bail() {
 # We want to follow the http model, in that 2xx codes represent success, 4xx
 # codes represent request problems, 5xx codes represent server issues, etc.
 # This doesn't map well to the posix conventions for process exit codes. For
-# one, we have more than one success code (we only need 200 and 201, but that's
-# more than one). Also, exit codes are 8-bit, so we can't use the http status
+# one, we have more than one success code (we only need 200, 201, and 202, but
+# that's more than one). Also, exit codes are 8-bit, so we can't use the http status
 # codes literally as process exit codes. We use the following conventions
 # instead, and that's why we have the following functions and definitions.
 #
 #   http codes   ->   exit codes   ->   http codes
 #       200               20               200   (most success cases)
 #       201               21               201   (success creating a record)
+#       202               22               202   (accepted, still in progress)
 #       400               40               400   (malformed input)
 #       401               41               401   (authentication failure)
 #       403               43               403   (authorization failure)
@@ -86,11 +87,11 @@ bail() {
 #                         xx               500   (unexpected exit code)
 #
 declare -A ahttp2exit=(
-	[200]=20, [201]=21,
+	[200]=20, [201]=21, [202]=22,
 	[400]=40, [401]=41, [403]=43, [404]=44,
 	[500]=50)
 declare -A aexit2http=(
-	[20]=200, [21]=201,
+	[20]=200, [21]=201, [22]=202,
 	[40]=400, [41]=401, [43]=403, [44]=404,
 	[50]=500, [49]=500, [0]=200)
 aahttp2exit="${!ahttp2exit[@]}"
@@ -314,12 +314,12 @@ def datetime2hint(dt):
 # See the comments for http2exit and exit2http in common/hcp.sh, this is simply
 # a python version of the same.
 ahttp2exit = {
-	200: 20, 201: 21,
+	200: 20, 201: 21, 202: 22,
 	400: 40, 401: 41, 403: 43, 404: 44,
 	500: 50
 }
 aexit2http = {
-	20: 200, 21: 201,
+	20: 200, 21: 201, 22: 202,
 	40: 400, 41: 401, 43: 403, 44: 404,
 	50: 500, 49: 500, 0: 200
 }
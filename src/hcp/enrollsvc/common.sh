@@ -16,6 +16,7 @@ if [[ -z $HCP_ENROLLSVC_USER_FLASK ]]; then
 fi
 export HCP_ENROLLSVC_POLICYURL=$(echo "$HCP_ENROLLSVC_JSON" | jq -r ".policyurl")
 export HCP_ENROLLSVC_VENDORS=$(echo "$HCP_ENROLLSVC_JSON" | jq -r ".tpm_vendors")
+export HCP_ENROLLSVC_SHARDS=$(echo "$HCP_ENROLLSVC_JSON" | jq -r ".shards // 1")
 
 export HCP_DB_DIR=$HCP_ENROLLSVC_STATE/db
 
@@ -77,16 +78,34 @@ fi
 # The remaining functions are used for navigating and manipulating the
 # enrollment database.
 
-# Variables concerning the enrolldb
+# Variables concerning the enrolldb. (If the DB is sharded, these are for the
+# unsharded layout, and repo_names lists the actual repos. See db_common.py.)
 REPO_NAME=enrolldb.git
 REPO_PATH=$HCP_DB_DIR/$REPO_NAME
-REPO_LOCKPATH=$HCP_DB_DIR/lock-$REPO_NAME
+REPO_LOCKPATH=$HCP_DB_DIR/lockq-$REPO_NAME
 EK_BASENAME=ekpubhash
 EK_PATH=$REPO_PATH/$EK_BASENAME
 
+# Lists the name of each repo that makes up the enrolldb, one per line
+function repo_names {
+	if [[ $HCP_ENROLLSVC_SHARDS == 1 ]]; then
+		echo "$REPO_NAME"
+		return
+	fi
+	digits=1
+	if [[ $HCP_ENROLLSVC_SHARDS == 256 ]]; then
+		digits=2
+	fi
+	for ((i = 0; i < HCP_ENROLLSVC_SHARDS; i++)); do
+		printf "enrolldb-%0${digits}x.git\n" $i
+	done
+}
+
 # Variables concerning the HN2EK reverse-mapping file
 HN2EK_BASENAME=hn2ek
 HN2EK_PATH=$REPO_PATH/$HN2EK_BASENAME
+HN2EK_REV_BASENAME=hn2ek-rev
+HN2EK_REV_PATH=$REPO_PATH/$HN2EK_REV_BASENAME
 
 # ekpubhash must consist only of lower-case hex, and be at least 16 characters
 # long (8 bytes)
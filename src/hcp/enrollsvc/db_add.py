@@ -1,13 +1,14 @@
 import sys
 import os
 import json
-import requests
 import shutil
 import subprocess
 import time
 import hashlib
+import threading
 from tempfile import TemporaryDirectory
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.insert(1, '/hcp/common')
 
@@ -16,340 +17,736 @@ from hcp_common import log, current_tracefile, http2exit, \
 
 sys.path.insert(1, '/hcp/xtra')
 
-from HcpHostname import valid_hostname, dc_hostname, pop_hostname, pop_domain
+from HcpHostname import valid_hostname, dc_hostname, pop_hostname, pop_domain, \
+	HcpHostnameError
 from HcpRecursiveUnion import union
 import HcpJsonExpander
+import HcpHttpClient
 
 sys.path.insert(1, '/hcp/enrollsvc')
 import db_common
 bail = db_common.bail
-git_commit = db_common.git_commit
-git_reset = db_common.git_reset
-
-# IMPORTANT: this file must send any miscellaneous output to stderr _only_.
-# This process is launched (by mgmt_sudo.sh) behind a 'sudo' call from the
-# web-app, which is expecting JSON output to show up on stdout when we exit
-# (unless we exit non-zero). Anything else that goes to stdout will likely
-# corrupt the JSON.
-
-class HcpErrorTPMalreadyEnrolled(Exception):
+import db_commit
+import db_jobs
+
+# IMPORTANT: when run as a command, this file must send any miscellaneous
+# output to stderr _only_. This process is launched (by mgmt_sudo.sh, via
+# db_jobs.py) behind a 'sudo' call from the web-app, which is expecting JSON
+# output to show up on stdout when we exit (unless we exit non-zero). Anything
+# else that goes to stdout will likely corrupt the JSON.
+
+HcpErrorTPMalreadyEnrolled = db_commit.HcpErrorTPMalreadyEnrolled
+HcpErrorTPMnotEnrolled = db_commit.HcpErrorTPMnotEnrolled
+HcpErrorCommitFailed = db_commit.HcpErrorCommitFailed
+class HcpErrorBadRequest(Exception):
 	pass
-class HcpErrorTPMnotEnrolled(Exception):
+class HcpErrorPolicyRefused(Exception):
+	pass
+class HcpErrorEnrollFailed(Exception):
 	pass
 
-# Usage: either
-#     db_add.py add <path-to-ekpub> <hostname> <clientjson>
-# or
-#     db_add.py reenroll <ekpubhash>
-
-if len(sys.argv) < 2 or (sys.argv[1] != 'add' and
-			sys.argv[1] != 'reenroll'):
-	bail("First argument must be 'add' or 'reenroll")
-
-cmdname = sys.argv[1]
-log(f"db_add: starting '{cmdname}'")
-z = f"db_{cmdname}"
-
-# We expect these env-vars to point to things
-signing_key_dir = env_get_dir('SIGNING_KEY_DIR')
-signing_key_pub = env_get_file('SIGNING_KEY_PUB')
-signing_key_priv = env_get_file('SIGNING_KEY_PRIV')
-gencert_ca_dir = env_get_dir('GENCERT_CA_DIR')
-gencert_ca_cert = env_get_file('GENCERT_CA_CERT')
-gencert_ca_priv = env_get_file('GENCERT_CA_PRIV')
-
-# Make sure attest-enroll prefers HCP's genprogs
-genprogspath = '/hcp/enrollsvc/genprogs'
-if 'PATH' in os.environ:
-	genprogspath=f"{genprogspath}:{os.environ['PATH']}"
-os.environ['PATH']=genprogspath
-
-# Enroll in a temp directory that gets automatically cleaned up
-ephemeral_dir_obj = TemporaryDirectory()
-ephemeral_dir = ephemeral_dir_obj.name
-os.environ['EPHEMERAL_ENROLL'] = ephemeral_dir
-log(f"{z}: ephemeral_dir={ephemeral_dir}")
-
-# Load the server's config and extract the "preclient" and "postclient"
-# profiles.
-serverprofile = hcp_config_extract('.enrollsvc.db_add', must_exist = True)
-log(f"{z}: serverprofile={serverprofile}")
-serverprofile_pre = serverprofile.pop('preclient', {})
-serverprofile_post = serverprofile.pop('postclient', {})
-
-# We also need to pull the policy URL (if any) from our JSON input. We'll pump
-# this into the environment so that any child processes (eg. genprogs) that
-# expect it get it.
-policy_url = hcp_config_extract('.enrollsvc.policy_url', or_default = True)
-if policy_url:
-	os.environ['HCP_ENROLLSVC_POLICY'] = policy_url
-else:
-	if 'HCP_ENROLLSVC_POLICY' in os.environ:
-		os.environ.pop('HCP_ENROLLSVC_POLICY')
-
-# Initialization that differs between enroll/reenroll
-if cmdname == 'add':
-	if len(sys.argv) != 5:
-		bail(f"{z}: wrong number of arguments: {len(sys.argv)}")
-	log(f"{z}: args [{sys.argv[2]},{sys.argv[3]},{sys.argv[4]}]")
-
-	path_ekpub = sys.argv[2]
-	if not os.path.exists(path_ekpub):
-		bail(f"No file at ekpub path: {path_ekpub}")
+# The http status that each error maps to, for callers that report them
+error_status = {
+	HcpErrorBadRequest: 400,
+	HcpErrorPolicyRefused: 403,
+	HcpErrorTPMnotEnrolled: 404,
+	HcpErrorTPMalreadyEnrolled: 409
+}
 
-	hostname = sys.argv[3]
-	valid_hostname(hostname)
+# This file can be run as a command (see the usage at the bottom) or imported.
+# Importers call init() once, and then either enroll() for each enrollment,
+# enroll_bulk() for many at once, or job() to do whatever the command would. An
+# enrollment goes through the following steps, each of which is a function
+# below, and whose state is carried in a dict (the "enrollment");
+#   prepare_add() or prepare_reenroll()
+#       - validate the inputs, produce the enrollment. ('add' also turns away
+#         TPMs that are visibly enrolled already.)
+#   build_profile()
+#       - merge the client's profile with the server's, and expand it.
+#   policy_check() (or policy_check_batch())
+#       - ask the policy-checker whether to proceed.
+#   generate()
+#       - run attest-enroll, to produce the enrollment's assets.
+#   db_commit.submit_many() (or whatever the caller passes in its place)
+#       - add the assets to the DB.
+# None of them touch os.environ after init(), the per-enrollment environment
+# for attest-enroll and the genprogs is built for each subprocess, so that
+# many enrollments can be generated in parallel.
+
+# Set by init()
+signing_key_dir = None
+signing_key_pub = None
+signing_key_priv = None
+gencert_ca_dir = None
+gencert_ca_cert = None
+gencert_ca_priv = None
+serverprofile_pre = None
+serverprofile_post = None
+prepared_profiles = {}
+policy_url = None
+policy_client = None
+
+def init():
+	global signing_key_dir, signing_key_pub, signing_key_priv
+	global gencert_ca_dir, gencert_ca_cert, gencert_ca_priv
+	global serverprofile_pre, serverprofile_post, prepared_profiles
+	global policy_url, policy_client
+
+	# We expect these env-vars to point to things
+	signing_key_dir = env_get_dir('SIGNING_KEY_DIR')
+	signing_key_pub = env_get_file('SIGNING_KEY_PUB')
+	signing_key_priv = env_get_file('SIGNING_KEY_PRIV')
+	gencert_ca_dir = env_get_dir('GENCERT_CA_DIR')
+	gencert_ca_cert = env_get_file('GENCERT_CA_CERT')
+	gencert_ca_priv = env_get_file('GENCERT_CA_PRIV')
+
+	# Make sure attest-enroll prefers HCP's genprogs
+	genprogspath = '/hcp/enrollsvc/genprogs'
+	if 'PATH' in os.environ:
+		genprogspath=f"{genprogspath}:{os.environ['PATH']}"
+	os.environ['PATH']=genprogspath
+
+	# Load the server's config and extract the "preclient" and "postclient"
+	# profiles.
+	serverprofile = hcp_config_extract('.enrollsvc.db_add',
+					must_exist = True)
+	log(f"db_add: serverprofile={serverprofile}")
+	serverprofile_pre = serverprofile.pop('preclient', {})
+	serverprofile_post = serverprofile.pop('postclient', {})
+	prepared_profiles = {}
+
+	# We also need to pull the policy URL (if any) from our JSON input.
+	# We'll pump this into the environment so that any child processes
+	# (eg. genprogs) that expect it get it.
+	policy_url = hcp_config_extract('.enrollsvc.policy_url',
+					or_default = True)
+	if policy_url:
+		os.environ['HCP_ENROLLSVC_POLICY'] = policy_url
+		# One (pooled, keep-alive) client for all our policy requests,
+		# see HcpHttpClient. '.enrollsvc.policy_http' can override its
+		# settings (connect_timeout, read_timeout, retries, backoff,
+		# threshold, cooldown, pool).
+		policy_client = HcpHttpClient.Client(policy_url,
+			**hcp_config_extract('.enrollsvc.policy_http',
+				or_default = True, default = {}))
+	else:
+		if 'HCP_ENROLLSVC_POLICY' in os.environ:
+			os.environ.pop('HCP_ENROLLSVC_POLICY')
+
+	# and give attest-enroll trust-roots for validating EKcerts
+	log(f"db_add: setting TPM_VENDORS={db_common.enrollsvc_state}/tpm_vendors")
+	os.environ['TPM_VENDORS'] = f"{db_common.enrollsvc_state}/tpm_vendors"
+
+	# Most clients send an empty profile, so get that one ready now. (If
+	# the profile is broken, the enrollments will say so.)
+	try:
+		prepared_profile({})
+	except Exception as e:
+		log(f"db_add: couldn't prepare the profile: {e}")
 
-	clientjson = sys.argv[4]
+def prepare_add(path_ekpub, hostname, clientjson):
+	z = 'db_add'
+	log(f"{z}: args [{path_ekpub},{hostname},{clientjson}]")
+	if not os.path.exists(path_ekpub):
+		raise HcpErrorBadRequest(f"No file at ekpub path: {path_ekpub}")
+	try:
+		valid_hostname(hostname)
+	except HcpHostnameError as e:
+		raise HcpErrorBadRequest(f"{e}")
 	if len(clientjson) == 0:
-		bail(f"Empty JSON")
-else: # cmdname == 'reenroll'
-	if len(sys.argv) != 3:
-		bail(f"{z}: wrong number of arguments: {len(sys.argv)}")
-	log(f"{z}: args [{sys.argv[2]}]")
+		raise HcpErrorBadRequest(f"Empty JSON")
+	# If we can already tell that the TPM is enrolled, there's no point
+	# generating assets only for the commit to refuse them (which is still
+	# where it gets decided, for the cases we can't tell here).
+	with open(path_ekpub, 'rb') as f:
+		ekpubhash = db_common.enrolled_ekpub(f.read())
+	if ekpubhash:
+		raise HcpErrorTPMalreadyEnrolled(f"existing ekpub: "
+				f"{db_common.halfhash(ekpubhash)}")
+	return {
+		'z': z,
+		'op': 'add',
+		'path_ekpub': path_ekpub,
+		'hostname': hostname,
+		'clientjson': clientjson,
+		# 'add' has to figure out ekpubhash (and so fpath) after
+		# attest-enroll runs, see generate().
+		'ekpubhash': None
+	}
 
-	clientjson = sys.argv[2]
-	log(f"{z}: using clientjson={clientjson}")
+def prepare_reenroll(clientjson):
+	z = 'db_reenroll'
+	log(f"{z}: args [{clientjson}]")
 	if len(clientjson) == 0:
-		bail(f"Empty JSON")
+		raise HcpErrorBadRequest(f"Empty JSON")
 	clientdata = json.loads(clientjson)
 	log(f"{z}: clientdata={clientdata}")
 	ekpubhash = clientdata['ekpubhash']
 	log(f"{z}: ekpubhash={ekpubhash}")
-	db_common.valid_ekpubhash(ekpubhash)
+	try:
+		db_common.valid_ekpubhash(ekpubhash)
+	except db_common.HcpEkpubhashError as e:
+		raise HcpErrorBadRequest(f"{e}")
 
-	# 'enroll' has to figure out fpath after attest-enroll runs,
-	# 'reenroll' has to figure it out long before that.
+	# 'reenroll' has to figure out fpath long before attest-enroll runs.
 	fpath = db_common.fpath(ekpubhash)
 	log(f"{z}: fpath={fpath}")
+	if not os.path.isdir(fpath):
+		raise HcpErrorTPMnotEnrolled(f"unknown ekpub: "
+				f"{db_common.halfhash(ekpubhash)}")
 	check = open(f"{fpath}/ekpubhash", 'r').read().strip('\n')
 	if ekpubhash != check:
-		bail(f"{z}: fail, ekpubhash={ekpubhash}, check={check}")
+		raise HcpErrorEnrollFailed(f"{z}: fail, ekpubhash={ekpubhash}, "
+				f"check={check}")
 	clientjson = open(f"{fpath}/clientprofile", 'r').read().strip('\n')
 	hostname = open(f"{fpath}/hostname", 'r').read().strip('\n')
 	log(f"{z}: found hostname={hostname}")
-	path_ekpub = f"{fpath}/ek.pub"
-
-# Now merge with the client. Basically this is a non-shallow merge, in which
-# the client's (requested) profile is overlaid on the server's "preclient"
-# profile, and then the server's "postclient" profile is overlaid on top of
-# that.
-clientdata = json.loads(clientjson)
-log(f"{z}: clientdata={clientdata}")
-resultprofile = union(union(serverprofile_pre, clientdata), serverprofile_post)
-log(f"db_add: client-adjusted resultprofile={resultprofile}")
-
-# Need to add some "env" elements to support expansion
-# - force the ENROLL_HOSTNAME variable from our inputs
-# - also add application config that comes to us from env-vars but may be
-#   needed in substitution.
-# - calculate derivative environment variables that we make available for
-#   parameter-expansion.
-hostname2dc = dc_hostname(hostname)
-domain = ""
-if 'ENROLL_DOMAIN' in resultprofile['__env']:
-	domain = resultprofile['__env']['ENROLL_DOMAIN']
-else:
-	_, domain = pop_hostname(hostname)
-	resultprofile['__env']['ENROLL_DOMAIN'] = domain
-_id, _domain = pop_domain(hostname, domain)
-if not _domain:
-	_id = "unknown_id"
-domain2dc = dc_hostname(domain)
-xtra_env = {
-	'__env': {
-		'ENROLL_ID': _id,
-		'ENROLL_HOSTNAME': hostname,
+	return {
+		'z': z,
+		'op': 'reenroll',
+		'path_ekpub': f"{fpath}/ek.pub",
+		'hostname': hostname,
+		'clientjson': clientjson,
+		'ekpubhash': ekpubhash
+	}
+
+# Merge the server's profiles with the client's. Basically this is a
+# non-shallow merge, in which the client's (requested) profile is overlaid on
+# the server's "preclient" profile, and then the server's "postclient" profile
+# is overlaid on top of that. The result is then parameter-expanded, using its
+# '__env' plus the vars that build_profile() adds, most of which depend on the
+# enrollment's hostname.
+#
+# The server profiles (and the vars that come from init()) only change when
+# the config does, and clients tend to send the same few profiles (often an
+# empty one), so most of that work is done once per client profile and cached
+# (keyed by the client's profile) in a "prepared" profile;
+#   'env'   the merged '__env', unexpanded (it's what the enrollment's profile
+#           gets as its '__env').
+#   'body'  the merged profile without its '__env', unexpanded.
+#   'text'  'body', expanded with all the vars except the per-enrollment ones
+#           (see enrollment_vars()), as JSON. The vars that refer to those
+#           still get expanded, as far as they can be, so what's left in
+#           'text' are references to the per-enrollment vars.
+#   'late'  the per-enrollment vars that 'text' refers to, and how.
+# expand_profile() then only has to replace those references, as the
+# per-enrollment vars don't refer to anything. If the vars can't be expanded
+# once and for all (eg. they refer to each other in a cycle), 'text' is None,
+# and the whole profile gets expanded for each enrollment, from 'body', as it
+# would without the cache. The cache only lives as long as the process, so it
+# helps the importers that enroll many times (the enroll_worker, and the
+# reenroller's batches), from many threads at once. The cached objects are
+# shared, so they must not be modified.
+prepared_profiles_max = 64
+prepared_profiles_lock = threading.Lock()
+
+# The vars that build_profile() sets for each enrollment (rather than from
+# init()), given the merged '__env' (which may set ENROLL_DOMAIN for all).
+def enrollment_vars(env):
+	result = [ 'ENROLL_ID', 'ENROLL_HOSTNAME', 'ENROLL_HOSTNAME2DC',
+		'ENROLL_DOMAIN2DC' ]
+	if 'ENROLL_DOMAIN' not in env:
+		result.append('ENROLL_DOMAIN')
+	return result
+
+# The vars that init() provides, which take precedence over the profile's
+def config_vars():
+	return {
 		'SIGNING_KEY_DIR': signing_key_dir,
 		'SIGNING_KEY_PUB': signing_key_pub,
 		'SIGNING_KEY_PRIV': signing_key_priv,
 		'GENCERT_CA_DIR': gencert_ca_dir,
 		'GENCERT_CA_CERT': gencert_ca_cert,
-		'GENCERT_CA_PRIV': gencert_ca_priv,
+		'GENCERT_CA_PRIV': gencert_ca_priv
+	}
+
+# A var's reference as it appears in a JSON document
+def json_ref(name):
+	return json.dumps(f"{{{name}}}")[1:-1]
+
+def prepare_profile(clientdata):
+	merged = union(union(serverprofile_pre, clientdata), serverprofile_post)
+	body = dict(merged)
+	env = body.pop('__env', {})
+	result = { 'env': env, 'body': body, 'text': None }
+	late = enrollment_vars(env)
+	early = { k: v for k, v in union(env, config_vars()).items()
+		if k not in late }
+	early = HcpJsonExpander.vars_selfexpand(early, '.')
+	if HcpJsonExpander.vars_expand(early, early, '.') != early:
+		log("db_add: profile vars don't converge, not preparing")
+		return result
+	text = json.dumps(HcpJsonExpander.expand_obj(early, body))
+	result['text'] = text
+	result['late'] = [ (k, json_ref(k)) for k in late if json_ref(k) in text ]
+	return result
+
+def prepared_profile(clientdata):
+	key = json.dumps(clientdata)
+	with prepared_profiles_lock:
+		if key in prepared_profiles:
+			return prepared_profiles[key]
+	result = prepare_profile(clientdata)
+	with prepared_profiles_lock:
+		if len(prepared_profiles) >= prepared_profiles_max:
+			prepared_profiles.pop(next(iter(prepared_profiles)))
+		prepared_profiles[key] = result
+	return result
+
+# Returns a new, parameter-expanded profile (without its '__env'), given the
+# prepared one and the enrollment's '__env' (the prepared 'env' plus the vars
+# that build_profile() adds). The same as expanding 'body' with 'env', which
+# is what happens if the profile couldn't be prepared (or if a per-enrollment
+# var looks like it refers to something, which they never should).
+def expand_profile(prepared, env):
+	text = prepared['text']
+	if text is not None:
+		for k, ref in prepared['late']:
+			v = json.dumps(env[k])[1:-1]
+			if '{' in v:
+				text = None
+				break
+			text = text.replace(ref, v)
+	if text is None:
+		return HcpJsonExpander.expand_obj(env, prepared['body'])
+	return json.loads(text)
+
+# Genprogs that the profile declares dependencies for, in 'genprogs_deps';
+#   { <genprog>: [ <genprogs it has to run after>, ... ], ... }
+# don't get run one after the other by attest-enroll, but concurrently (as far
+# as their dependencies allow) by our 'genpipeline' genprog, which
+# attest-enroll runs in the place of the first of them. (They have to be HCP's
+# own genprogs, ie. not ones that are built in to attest-enroll.) Given the
+# final list of genprogs, this returns the list for attest-enroll, and the
+# plan for genpipeline (see genprogs/genpipeline), or None if there's nothing
+# to run concurrently. Dependencies on genprogs that aren't being run are
+# ignored, as are those on genprogs that attest-enroll runs before
+# genpipeline, but those that it runs after can't be satisfied.
+def genpipeline_plan(genprogs, deps):
+	if not isinstance(deps, dict):
+		raise HcpErrorBadRequest("'genprogs_deps' must be a dict")
+	members = list(dict.fromkeys(x for x in genprogs if x in deps))
+	if len(members) < 2:
+		return genprogs, None
+	slot = genprogs.index(members[0])
+	pending = {}
+	for x in members:
+		after = deps[x]
+		if not isinstance(after, list) or \
+				not all(isinstance(y, str) for y in after):
+			raise HcpErrorBadRequest(
+				f"'genprogs_deps' for {x} must be a list of genprogs")
+		for y in after:
+			if y in genprogs[slot:] and y not in members:
+				raise HcpErrorBadRequest(f"genprog {x} can't run "
+					f"after {y}, which runs after it")
+		pending[x] = [ y for y in after if y in members ]
+	plan = {}
+	while pending:
+		ready = [ x for x in pending
+			if all(y in plan for y in pending[x]) ]
+		if not ready:
+			raise HcpErrorBadRequest(
+				f"'genprogs_deps' has a cycle: {list(pending)}")
+		for x in ready:
+			plan[x] = pending.pop(x)
+	run = genprogs[:slot] + [ 'genpipeline' ] + \
+		[ x for x in genprogs[slot:] if x not in plan ]
+	return run, plan
+
+def build_profile(e):
+	z = e['z']
+	hostname = e['hostname']
+
+	clientdata = json.loads(e['clientjson'])
+	log(f"{z}: clientdata={clientdata}")
+	prepared = prepared_profile(clientdata)
+
+	# Need to add some "env" elements to support expansion
+	# - force the ENROLL_HOSTNAME variable from our inputs
+	# - also add application config that comes to us from env-vars but may
+	#   be needed in substitution.
+	# - calculate derivative environment variables that we make available
+	#   for parameter-expansion.
+	hostname2dc = dc_hostname(hostname)
+	domain = ""
+	xtra_env = {}
+	if 'ENROLL_DOMAIN' in prepared['env']:
+		domain = prepared['env']['ENROLL_DOMAIN']
+	else:
+		_, domain = pop_hostname(hostname)
+		xtra_env['ENROLL_DOMAIN'] = domain
+	_id, _domain = pop_domain(hostname, domain)
+	if not _domain:
+		_id = "unknown_id"
+	domain2dc = dc_hostname(domain)
+	xtra_env.update({
+		'ENROLL_ID': _id,
+		'ENROLL_HOSTNAME': hostname,
 		'ENROLL_HOSTNAME2DC': hostname2dc,
 		'ENROLL_DOMAIN2DC': domain2dc
+	})
+	xtra_env.update(config_vars())
+	origenv = union(prepared['env'], xtra_env)
+
+	# Now we need to perform parameter-expansion. (This returns a new
+	# object, so it's safe to modify from here on.)
+	resultprofile = expand_profile(prepared, origenv)
+	resultprofile['__env'] = origenv
+	log(f"{z}: param-expanded resultprofle={resultprofile}")
+
+	# And we now deal with genprogs[_{pre,post}]
+	genprogs_pre = ""
+	genprogs_post = ""
+	genprogs = ""
+	if 'genprogs_pre' in resultprofile:
+		genprogs_pre = resultprofile['genprogs_pre']
+	if 'genprogs_post' in resultprofile:
+		genprogs_post = resultprofile['genprogs_post']
+	if 'genprogs' in resultprofile:
+		genprogs = resultprofile['genprogs']
+	final_genprogs = f"{genprogs_pre} {genprogs} {genprogs_post}"
+	# NB: we keep the 'final_genprogs' variable as a space-separated string
+	# for the benefit of safeboot, which expects it. But the
+	# correspondingly-named field in the profile will be an array.
+	resultprofile['final_genprogs'] = final_genprogs.split(' ')
+
+	# The policy-checker sees the genprogs that will run (above), whereas
+	# attest-enroll may be told to run some of them through genpipeline.
+	if 'genprogs_deps' in resultprofile:
+		genprogs, plan = genpipeline_plan(
+			resultprofile['final_genprogs'],
+			resultprofile['genprogs_deps'])
+		if plan:
+			resultprofile['genpipeline'] = plan
+			final_genprogs = ' '.join(genprogs)
+
+	# The JSON profile is now fully curated. (The only thing left to do is
+	# generate the enroll.conf that safeboot's 'attest-enroll' requires,
+	# but that's only because it doesn't consume our profile.)
+	e['clientdata'] = clientdata
+	e['profile'] = resultprofile
+	e['final_genprogs'] = final_genprogs
+	e['request_uid'] = uuid4().urn
+
+# Before performing the enrollment, send our profile to the policy-checker!
+def policy_check(e):
+	if not policy_url:
+		return
+	z = e['z']
+	body = {
+		'hookname': "enrollsvc::add_request",
+		'request_uid': e['request_uid'],
+		'params': e['profile']
 	}
-}
-resultprofile=union(resultprofile, xtra_env)
-log(f"{z}: env-adjusted resultprofle={resultprofile}")
-
-# Now we need to perform parameter-expansion
-origenv = resultprofile.pop('__env', {})
-resultprofile = HcpJsonExpander.process_obj(origenv, resultprofile, '.',
-			varskey = None, fileskey = None)
-resultprofile['__env'] = origenv
-log(f"{z}: param-expanded resultprofle={resultprofile}")
-
-# The only thing left to do to resultprofile is determine which genprogs to
-# run, and the genprogs themselves don't need to know that, so export the
-# resultprofile now so that safeboot and/or genprogs scripts can get at it.
-os.environ['ENROLL_JSON'] = json.dumps(resultprofile)
-
-# And we now deal with genprogs[_{pre,post}]
-genprogs_pre = ""
-genprogs_post = ""
-genprogs = ""
-if 'genprogs_pre' in resultprofile:
-	genprogs_pre = resultprofile['genprogs_pre']
-if 'genprogs_post' in resultprofile:
-	genprogs_post = resultprofile['genprogs_post']
-if 'genprogs' in resultprofile:
-	genprogs = resultprofile['genprogs']
-final_genprogs = f"{genprogs_pre} {genprogs} {genprogs_post}"
-# NB: we keep the 'final_genprogs' variable as a space-separated string for the
-# benefit of safeboot, which expects it. But the correspondingly-named field in
-# the profile will be an array.
-resultprofile['final_genprogs'] = final_genprogs.split(' ')
-
-# The JSON profile is now fully curated. (The only thing left to do is generate
-# the enroll.conf that safeboot's 'attest-enroll' requires, but that's only
-# because it doesn't consume our profile.)
-# So before doing that and performing the enrollment, send our profile to the
-# policy-checker!
-if policy_url:
-	uuid = uuid4().urn
-	os.environ['HCP_REQUEST_UID'] = uuid
-	form_data = {
-		'hookname': (None, "enrollsvc::add_request"),
-		'request_uid': (None, uuid),
-		'params': (None, json.dumps(resultprofile))
-	}
-	url = f"{policy_url}/run"
-	log(f"{z}: sending policy request={form_data}")
+	log(f"{z}: sending policy request={body}")
 	try:
-		response = requests.post(url, files=form_data)
+		response = policy_client.post_json('/run', body)
 		log(f"{z}: policy response={response}")
 		status = response.status_code
-	except Exception as e:
-		log(f"{z}: policy connection failed: {e}")
+	except Exception as ex:
+		log(f"{z}: policy connection failed: {ex}")
 		status = 403
 	if status != 200:
 		log(f"policy-checker refused enrollment: {status}")
-		sys.exit(http2exit(403))
-
-# Prepare the enroll.conf that safeboot feeds on
-shutil.copy('/install-safeboot/enroll.conf', ephemeral_dir)
-log(f"db_add: adding GENPROGS=({final_genprogs})")
-with open(f"{ephemeral_dir}/enroll.conf", 'a') as fenroll:
-	fenroll.write(f"export GENPROGS=({final_genprogs})")
-
-# and give attest-enroll trust-roots for validating EKcerts
-log(f"db_add: setting TPM_VENDORS={db_common.enrollsvc_state}/tpm_vendors")
-os.environ['TPM_VENDORS'] = f"{db_common.enrollsvc_state}/tpm_vendors"
-
-# Safeboot's 'attest-enroll' evolved when we were doing things differently, now
-# it's more convoluted than we need it to be. Eg. it calls CHECKOUT and COMMIT
-# callbacks to determine the directory to enroll in and to post-process it.
-# - our CHECKOUT hook reads $EPHEMERAL_ENROLL (which we set from
-#   'ephemeral_dir' earlier in this file) and writes it to stdout.
-# - our COMMIT hook does nothing
-# - stdout/stderr are redirected to PIPEs that are then discarded. (This tool
-#   is extremely noisy.) If debugging, you can uncomment the calls that send
-#   the command's stdout/stderr to our own stderr. Don't forget however that we
-#   can't send anything to stdout (except at the very end, when we write JSON
-#   to stdout for our caller to pick up).
-# We do the post-processing ourselves, from the ephemeral_dir, once
-# 'attest-enroll' is done.
-c = subprocess.run(
-	[ '/install-safeboot/sbin/attest-enroll', '-v',
-		'-C', f"{ephemeral_dir}/enroll.conf",
-		'-V', 'CHECKOUT=/hcp/enrollsvc/cb_checkout.sh',
-		'-V', 'COMMIT=/hcp/enrollsvc/cb_commit.sh',
-		'-I', f"{path_ekpub}",
-		f"{hostname}" ],
-	cwd = '/install-safeboot',
-	stdout = subprocess.PIPE,
-	stderr = current_tracefile,
-	text = True)
-log(f"{z}: attest-enroll returned c={c}")
-if c.returncode != 0:
-	bail(f"{z}: safeboot 'attest-enroll' failed: {c.returncode}")
-
-# Enrollment performed, so assets are in 'ephemeral_dir'. Now we need to add it
-# to the git-repo.
-
-# For 'add', ek.pub may have first been produced during attest-enroll (if
-# the client passed us the EK in a different form, attest-enroll converts
-# it), so in that case we hash it here. By dependency, the same is true of
-# fpath.
-if cmdname == 'add':
-	ekpubhash = hashlib.sha256(open(f"{ephemeral_dir}/ek.pub",
-				'rb').read()).hexdigest()
-	fpath = db_common.fpath(ekpubhash)
-	log(f"{z}: ekpubhash={ekpubhash}")
-	log(f"{z}: fpath={fpath}")
-halfhash = ekpubhash[:16]
-
-# Change working directory to the git repo
-os.chdir(db_common.repo_path)
-
-# The critical section begins
-log("{z}: critical section beginning")
-db_common.repo_lock()
-
-# From here on in, we should not allow any error to prevent us from unlocking. Of course,
-# issuing a "kill -9" or wrenching a live motherboard out of its chassis are not easily
-# coded for, but we should at least control what we can.
-caught = None
-try:
-	if cmdname == 'add':
-		# For 'add', the TPM must _not_ already be enrolled
-		if os.path.isdir(fpath):
-			raise HcpErrorTPMalreadyEnrolled(f"existing ekpub: {halfhash}")
-		# Add the hostname-to-ekpub entry to hn2ek, it's new
-		log("{z}: add hn2ek entry")
-		db_common.hn2ek_xadd(hostname, ekpubhash)
-	else: # cmdname == 'reenroll'
-		# For 'reenroll', the TPM _must_ already be enrolled
-		if not os.path.isdir(fpath):
-			raise HcpErrorTPMnotEnrolled(f"unknown ekpub: {halfhash}")
-		# Remove the existing tree. If anything goes wrong, the
-		# exception handler's 'git reset --hard' will restore what was
-		# removed. Also we hold the lock, so the tree-deletion never
-		# gets committed to git, so it goes unseen, unreplicated, etc.
-		shutil.rmtree(fpath)
-	# Copy the ephemeral enrollment dir into place. I could have moved it
-	# instead, but (a) TemporaryDirectory() garbage-collects the ephemeral
-	# dir and I don't want any surprises from that, and (b) it could be
-	# that umasks or sticky-bits or group-ids or mount options differ
-	# between the ephemeral dir and the git repo, and because 'cp' creates
-	# all the destination dirs and files, it would seem less prone to
-	# oddity than 'mv'.
-	log(f"{z}: move enrollment to DB at {fpath}")
-	import glob
-	shutil.copytree(ephemeral_dir, fpath)
-	# Add 'ekpubhash' and 'clientprofile' files
-	log("{z}: adding ekpubhash and clientprofile")
-	open(f"{fpath}/ekpubhash", 'w').write(f"{ekpubhash}")
-	open(f"{fpath}/clientprofile", 'w').write(f"{clientjson}")
-	# Close the transaction
-	git_commit(f"map {halfhash} to {hostname}")
-except Exception as e:
-	caught = e
-	log(f"{z}: caught exception: {caught}")
-	# recover the git repo before we release the lock
+		raise HcpErrorPolicyRefused(f"policy-checker refused: {status}")
+
+# The same, for many enrollments in one request (to the policy-checker's
+# '/run_batch'). Returns a list (in the same order as 'es') of None for those
+# that were accepted, or the exception for those that weren't. If the
+# policy-checker doesn't have '/run_batch', we fall back to asking about each
+# enrollment separately.
+def policy_check_batch(es):
+	if not policy_url or not es:
+		return [ None for e in es ]
+	body = {
+		'hookname': "enrollsvc::add_request",
+		'request_uids': [ e['request_uid'] for e in es ],
+		'params': [ e['profile'] for e in es ]
+	}
+	log(f"db_add: sending policy batch request, {len(es)} entries")
 	try:
-		git_reset()
-	except Exception as e:
-		log(f"{z}: rollback failed!! {e}")
-		bail(f"CATASTROPHIC! DB stays locked for manual intervention")
-	log("{z}: rollback complete")
-
-# Remove the lock, then reraise any exception we intercepted
-db_common.repo_unlock()
-if caught:
-	log(f"{z}: exception continuation: {caught}")
-	raise caught
-log("{z}: critical section complete")
-
-# The point of this entire file: produce a JSON to stdout that confirms the
-# transaction. This gets returned to the client.
-result = {
-	'returncode': 0,
-	'hostname': hostname,
-	'ekpubhash': ekpubhash,
-	'profile': clientdata
-}
-print(json.dumps(result, sort_keys = True))
-log("{z}: JSON output produced, exiting with code 201")
-sys.exit(http2exit(201))
+		response = policy_client.post_json('/run_batch', body)
+		log(f"db_add: policy batch response={response}")
+		status = response.status_code
+	except Exception as ex:
+		log(f"db_add: policy connection failed: {ex}")
+		status = 403
+	if status == 404:
+		log(f"db_add: no policy batch support, checking individually")
+		results = []
+		for e in es:
+			try:
+				policy_check(e)
+				results.append(None)
+			except HcpErrorPolicyRefused as ex:
+				results.append(ex)
+		return results
+	if status != 200:
+		log(f"policy-checker refused batch: {status}")
+		return [ HcpErrorPolicyRefused(f"policy-checker refused: {status}")
+			for e in es ]
+	verdicts = response.json()['results']
+	if len(verdicts) != len(es):
+		raise HcpErrorEnrollFailed(f"policy-checker returned "
+				f"{len(verdicts)} results for {len(es)} requests")
+	return [ None if v['status'] == 200 else
+		HcpErrorPolicyRefused(f"policy-checker refused: {v['status']}")
+		for v in verdicts ]
+
+# Runs attest-enroll, producing the enrollment's assets in a temp directory
+# that gets automatically cleaned up (when e['dir_obj'] goes away, or by
+# cleanup()).
+def generate(e):
+	z = e['z']
+	e['dir_obj'] = TemporaryDirectory()
+	ephemeral_dir = e['dir_obj'].name
+	e['dir'] = ephemeral_dir
+	log(f"{z}: ephemeral_dir={ephemeral_dir}")
+
+	# Prepare the enroll.conf that safeboot feeds on
+	shutil.copy('/install-safeboot/enroll.conf', ephemeral_dir)
+	log(f"{z}: adding GENPROGS=({e['final_genprogs']})")
+	with open(f"{ephemeral_dir}/enroll.conf", 'a') as fenroll:
+		fenroll.write(f"export GENPROGS=({e['final_genprogs']})")
+
+	# Export the resultprofile so that safeboot and/or genprogs scripts can
+	# get at it, along with the other per-enrollment settings.
+	env = dict(os.environ)
+	env['EPHEMERAL_ENROLL'] = ephemeral_dir
+	env['ENROLL_JSON'] = json.dumps(e['profile'])
+	if policy_url:
+		env['HCP_REQUEST_UID'] = e['request_uid']
+	# genpipeline reports the timing of the genprogs it runs, but not into
+	# ephemeral_dir (which becomes the enrollment).
+	if 'genpipeline' in e['profile']:
+		e['timing_obj'] = TemporaryDirectory()
+		timing_path = f"{e['timing_obj'].name}/timing.json"
+		env['HCP_GENPIPELINE_TIMING'] = timing_path
+
+	# Safeboot's 'attest-enroll' evolved when we were doing things
+	# differently, now it's more convoluted than we need it to be. Eg. it
+	# calls CHECKOUT and COMMIT callbacks to determine the directory to
+	# enroll in and to post-process it.
+	# - our CHECKOUT hook reads $EPHEMERAL_ENROLL (which we set from
+	#   'ephemeral_dir' above) and writes it to stdout.
+	# - our COMMIT hook does nothing
+	# - stdout/stderr are redirected to PIPEs that are then discarded.
+	#   (This tool is extremely noisy.) If debugging, you can uncomment the
+	#   calls that send the command's stdout/stderr to our own stderr.
+	#   Don't forget however that we can't send anything to stdout (except
+	#   at the very end, when we write JSON to stdout for our caller to pick
+	#   up).
+	# We do the post-processing ourselves, from the ephemeral_dir, once
+	# 'attest-enroll' is done.
+	start = time.monotonic()
+	c = subprocess.run(
+		[ '/install-safeboot/sbin/attest-enroll', '-v',
+			'-C', f"{ephemeral_dir}/enroll.conf",
+			'-V', 'CHECKOUT=/hcp/enrollsvc/cb_checkout.sh',
+			'-V', 'COMMIT=/hcp/enrollsvc/cb_commit.sh',
+			'-I', f"{e['path_ekpub']}",
+			f"{e['hostname']}" ],
+		cwd = '/install-safeboot',
+		env = env,
+		stdout = subprocess.PIPE,
+		stderr = current_tracefile,
+		text = True)
+	e['timing'] = { 'attest-enroll': round(time.monotonic() - start, 3) }
+	log(f"{z}: attest-enroll returned c={c}")
+	if c.returncode != 0:
+		raise HcpErrorEnrollFailed(f"{z}: safeboot 'attest-enroll' "
+				f"failed: {c.returncode}")
+	if 'timing_obj' in e:
+		with open(timing_path, 'r') as f:
+			e['timing']['genpipeline'] = json.load(f)
+
+	# For 'add', ek.pub may have first been produced during attest-enroll
+	# (if the client passed us the EK in a different form, attest-enroll
+	# converts it), so in that case we hash it here.
+	if e['op'] == 'add':
+		e['ekpubhash'] = hashlib.sha256(open(f"{ephemeral_dir}/ek.pub",
+					'rb').read()).hexdigest()
+		log(f"{z}: ekpubhash={e['ekpubhash']}")
+
+def cleanup(e):
+	if 'dir_obj' in e:
+		e.pop('dir_obj').cleanup()
+	if 'timing_obj' in e:
+		e.pop('timing_obj').cleanup()
+
+# The JSON that confirms the transaction, this gets returned to the client.
+# 'timing' has how long attest-enroll took (in seconds) and, if genpipeline
+# was used, the timing of each of the genprogs it ran.
+def result(e):
+	return {
+		'returncode': 0,
+		'hostname': e['hostname'],
+		'ekpubhash': e['ekpubhash'],
+		'profile': e['clientdata'],
+		'timing': e['timing']
+	}
+
+# A single enrollment, start to finish. 'op' is 'add' or 'reenroll', and
+# 'args' are the corresponding arguments (see the usage below). Returns the
+# result, or raises the exception that explains why there isn't one.
+# 'submit_many' commits it, see db_commit.submit_many().
+def enroll(op, args, submit_many = db_commit.submit_many):
+	if op == 'add':
+		e = prepare_add(*args)
+	else:
+		e = prepare_reenroll(*args)
+	try:
+		build_profile(e)
+		policy_check(e)
+		generate(e)
+
+		# Hand the enrollment to the group-commit logic (see
+		# db_commit.py), which takes the repo lock and commits it,
+		# possibly as part of a batch with other concurrent
+		# enrollments. It returns when our enrollment is committed, or
+		# raises the exception that explains why it wasn't. The checks
+		# are unchanged; for 'add', the TPM must _not_ already be
+		# enrolled, for 'reenroll', it must.
+		log(f"{e['z']}: submitting to group commit")
+		r, = submit_many([ (op, e['ekpubhash'], e['hostname'],
+				e['clientjson'], e['dir']) ])
+		if isinstance(r, Exception):
+			raise r
+		log(f"{e['z']}: committed")
+	finally:
+		cleanup(e)
+	return result(e)
+
+def __error(ex):
+	status = 500
+	for cls in error_status:
+		if isinstance(ex, cls):
+			status = error_status[cls]
+	return { 'http_status': status, 'error': type(ex).__name__,
+		'message': f"{ex}" }
+
+# Many enrollments at once. 'items' is a list of (op, args) tuples, as for
+# enroll(). The profiles are checked by the policy-checker in one request, the
+# assets are generated 'workers' at a time, and everything that gets that far
+# is committed together (by taking the repo lock once). Returns a list of
+# per-item outcomes, in the same order as 'items'. Each is either the result
+# (as returned by enroll()) with 'http_status' set to 201, or a dict with
+# 'http_status', 'error', and 'message' explaining why that one failed. A
+# failure only affects its own item. 'submit_many' is as for enroll().
+def enroll_bulk(items, workers, submit_many = db_commit.submit_many):
+	outcomes = [ None for i in items ]
+	es = []
+	for i, (op, args) in enumerate(items):
+		try:
+			if op == 'add':
+				e = prepare_add(*args)
+			elif op == 'reenroll':
+				e = prepare_reenroll(*args)
+			else:
+				raise HcpErrorBadRequest(f"unknown op: {op}")
+			e['index'] = i
+			build_profile(e)
+			es.append(e)
+		except Exception as ex:
+			log(f"db_add: bulk item {i} failed preparation: {ex}")
+			outcomes[i] = __error(ex)
+	verdicts = policy_check_batch(es)
+	accepted = []
+	for e, ex in zip(es, verdicts):
+		if ex:
+			outcomes[e['index']] = __error(ex)
+		else:
+			accepted.append(e)
+	log(f"db_add: bulk, generating {len(accepted)} of {len(items)}")
+	def _generate(e):
+		try:
+			generate(e)
+		except Exception as ex:
+			log(f"db_add: bulk item {e['index']} failed generation: {ex}")
+			cleanup(e)
+			return ex
+		return None
+	generated = []
+	with ThreadPoolExecutor(max_workers = workers) as pool:
+		for e, ex in zip(accepted, pool.map(_generate, accepted)):
+			if ex:
+				outcomes[e['index']] = __error(ex)
+			else:
+				generated.append(e)
+	log(f"db_add: bulk, committing {len(generated)} of {len(items)}")
+	try:
+		results = submit_many([ (e['op'], e['ekpubhash'],
+				e['hostname'], e['clientjson'], e['dir'])
+				for e in generated ])
+	finally:
+		for e in generated:
+			cleanup(e)
+	for e, r in zip(generated, results):
+		if isinstance(r, Exception):
+			outcomes[e['index']] = __error(r)
+		else:
+			outcomes[e['index']] = result(e)
+			outcomes[e['index']]['http_status'] = 201
+	return outcomes
+
+# What the command does (see the usage below), for importers: returns the
+# exit code and the output, rather than exiting and printing them. 'op' and
+# 'args' are the command's arguments, and 'submit_many' is as for enroll().
+def job(op, args, submit_many = db_commit.submit_many):
+	z = f"db_{op}"
+	if op == 'add_bulk':
+		try:
+			manifest = json.load(open(args[0], 'r'))
+			d = os.path.dirname(os.path.abspath(args[0]))
+			items = [ ('add', [ os.path.join(d, x['ekpub']),
+					x['hostname'], x['profile'] ])
+				for x in manifest ]
+			outcomes = enroll_bulk(items, db_jobs.num_workers,
+					submit_many)
+		except Exception as ex:
+			log(f"FAIL: {z}: {type(ex).__name__}: {ex}")
+			return 1, ''
+		log(f"{z}: JSON output produced, exit code 200")
+		return http2exit(200), json.dumps({ 'returncode': 0,
+				'entries': outcomes }, sort_keys = True) + '\n'
+	try:
+		output = enroll(op, args, submit_many)
+	except HcpErrorPolicyRefused as ex:
+		log(f"{z}: {ex}")
+		return http2exit(403), ''
+	except Exception as ex:
+		log(f"FAIL: {z}: {type(ex).__name__}: {ex}")
+		return 1, ''
+
+	# The point of this entire file: produce a JSON to stdout that confirms
+	# the transaction. This gets returned to the client.
+	log(f"{z}: JSON output produced, exit code 201")
+	return http2exit(201), json.dumps(output, sort_keys = True) + '\n'
+
+# Usage: either
+#     db_add.py add <path-to-ekpub> <hostname> <clientjson>
+# or
+#     db_add.py reenroll <clientjson>
+# or
+#     db_add.py add_bulk <path-to-manifest>
+# where the manifest is a JSON list of { 'ekpub', 'hostname', 'profile' }
+# dicts, 'ekpub' being a path (relative to the manifest, as db_jobs.py writes
+# it) and 'profile' being the clientjson. The output of 'add_bulk' is
+# { 'returncode': 0, 'entries': [...] }, where 'entries' are the per-entry
+# outcomes from enroll_bulk(), and it exits with 200 even if some (or all) of
+# them failed.
+if __name__ == '__main__':
+	nargs = { 'add': 3, 'reenroll': 1, 'add_bulk': 1 }
+	if len(sys.argv) < 2 or sys.argv[1] not in nargs:
+		bail("First argument must be 'add', 'reenroll', or 'add_bulk'")
+	cmdname = sys.argv[1]
+	z = f"db_{cmdname}"
+	log(f"db_add: starting '{cmdname}'")
+	if len(sys.argv) != 2 + nargs[cmdname]:
+		bail(f"{z}: wrong number of arguments: {len(sys.argv)}")
+	init()
+	exitcode, output = job(cmdname, sys.argv[2:])
+	sys.stdout.write(output)
+	sys.stdout.flush()
+	sys.exit(exitcode)
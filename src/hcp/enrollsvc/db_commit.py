@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+from uuid import uuid4
+
+sys.path.insert(1, '/hcp/common')
+from hcp_common import log
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_common
+import db_due
+import db_manifest
+
+# Group commit. Adding (or reenrolling) an entry used to mean taking the repo
+# lock, making the change, and committing it, one enrollment per commit. When
+# enrollments arrive concurrently, they serialize on that lock and each pays
+# for a full commit. Instead, callers 'submit()' their already-generated
+# enrollment to a spool directory (outside the lock) and then take the lock.
+# Whoever gets the lock first applies _everything_ that's in the spool at that
+# point, commits the lot as a single commit, and writes a per-entry result
+# into each spool entry. Each caller then finds its own result (either having
+# done the work itself or having had it done by someone ahead of it in the
+# queue) and returns it, so every caller still gets its own success/failure.
+#
+# Spool layout, under {db_dir}/commitq/;
+#   .tmp-<uuid>/          being populated, ignored by everyone else
+#   .done-<name>/         result collected, being removed by its submitter
+#   <time_ns>-<uuid>/     ready, applied in name (ie. arrival) order
+#     request.json        { 'op', 'ekpubhash', 'hostname', 'clientjson' }
+#     assets/             the enrollment dir, renamed into the repo on apply
+#     result.json         written by whoever applied it
+#
+# The spool lives alongside the repo (same file-system), so the assets get
+# renamed into place rather than copied while holding the lock. If the DB is
+# sharded, each shard has its own spool ({db_dir}/commitq-<shard>/), lock, and
+# commits, and submissions are routed to the shard of their ekpubhash.
+#
+# Config: '.enrollsvc.group_commit.window' (seconds, default 0) is how long a
+# submitter waits after spooling (and before locking) to let others join the
+# batch. Under contention this isn't needed, batches form naturally while
+# the previous batch holds the lock.
+
+class HcpErrorTPMalreadyEnrolled(Exception):
+	pass
+class HcpErrorTPMnotEnrolled(Exception):
+	pass
+class HcpErrorCommitFailed(Exception):
+	pass
+
+errors = {
+	'HcpErrorTPMalreadyEnrolled': HcpErrorTPMalreadyEnrolled,
+	'HcpErrorTPMnotEnrolled': HcpErrorTPMnotEnrolled,
+	'HcpErrorCommitFailed': HcpErrorCommitFailed
+}
+
+# For the selected shard
+def commitq_dir():
+	return db_common.state_path('commitq')
+
+group_commit_window = 0
+if 'group_commit' in db_common.enrollsvc_ctx:
+	_gc = db_common.enrollsvc_ctx['group_commit']
+	if 'window' in _gc:
+		group_commit_window = float(_gc['window'])
+
+# Results that were never picked up (the submitter died) get removed after
+# this long.
+stale_result_secs = 3600
+
+def __write_json(path, data):
+	with open(f"{path}.tmp", 'w') as f:
+		json.dump(data, f, sort_keys = True)
+	os.rename(f"{path}.tmp", path)
+
+def __read_json(path):
+	with open(path, 'r') as f:
+		return json.load(f)
+
+# Spools the enrollment in 'srcdir' (which is copied, not consumed) and returns
+# the path of the spool entry.
+def spool(op, ekpubhash, hostname, clientjson, srcdir):
+	os.makedirs(commitq_dir(), exist_ok = True)
+	uuid = uuid4().hex
+	tmp = f"{commitq_dir()}/.tmp-{uuid}"
+	os.mkdir(tmp)
+	try:
+		# Copy rather than move out of the ephemeral dir. (a)
+		# TemporaryDirectory() garbage-collects it and we don't want
+		# any surprises from that, and (b) umasks or sticky-bits or
+		# group-ids or mount options may differ between there and
+		# here, and creating all the destination dirs and files
+		# ourselves is less prone to oddity. The later move, from the
+		# spool into the repo, doesn't cross any such boundary.
+		shutil.copytree(srcdir, f"{tmp}/assets")
+		open(f"{tmp}/assets/ekpubhash", 'w').write(f"{ekpubhash}")
+		open(f"{tmp}/assets/clientprofile", 'w').write(f"{clientjson}")
+		db_manifest.write(f"{tmp}/assets")
+		__write_json(f"{tmp}/request.json", {
+			'op': op,
+			'ekpubhash': ekpubhash,
+			'hostname': hostname,
+			'clientjson': clientjson
+		})
+		entry = f"{commitq_dir()}/{time.time_ns():020d}-{uuid}"
+		os.rename(tmp, entry)
+	except Exception:
+		shutil.rmtree(tmp, ignore_errors = True)
+		raise
+	return entry
+
+def __pending():
+	entries = []
+	for path in sorted(glob.glob(f"{commitq_dir()}/[0-9]*")):
+		if os.path.exists(f"{path}/result.json"):
+			try:
+				age = time.time() - os.path.getmtime(
+						f"{path}/result.json")
+			except FileNotFoundError:
+				continue
+			if age > stale_result_secs:
+				log(f"db_commit: removing stale {path}")
+				done = f"{commitq_dir()}/.done-{os.path.basename(path)}"
+				os.rename(path, done)
+				shutil.rmtree(done, ignore_errors = True)
+			continue
+		# No result, but it may have been collected (and renamed out of
+		# the way) since the glob. Results only get written under the
+		# lock, which we hold, so if it's still here it's pending.
+		if not os.path.isdir(path):
+			continue
+		entries.append(path)
+	return entries
+
+# Applies one spooled entry to the working tree. Problems that are the
+# entry's own fault are detected before anything is touched, and returned as
+# a result. Anything raised is a problem with the batch as a whole.
+def __apply(path, hn2ek, seen, changed, hints):
+	req = __read_json(f"{path}/request.json")
+	op = req['op']
+	ekpubhash = req['ekpubhash']
+	hostname = req['hostname']
+	halfhash = db_common.halfhash(ekpubhash)
+	fpath = db_common.fpath(ekpubhash)
+	def fail(cls, msg):
+		log(f"db_commit: {path}: {cls.__name__}: {msg}")
+		return { 'error': cls.__name__, 'message': msg }, None
+	if not os.path.isdir(f"{path}/assets"):
+		# Most likely an earlier holder died after moving the assets
+		# into the working tree, and that got rolled back.
+		return fail(HcpErrorCommitFailed, f"assets lost: {halfhash}")
+	if op == 'add':
+		# For 'add', the TPM must _not_ already be enrolled
+		if ekpubhash in seen or os.path.isdir(fpath):
+			return fail(HcpErrorTPMalreadyEnrolled,
+				f"existing ekpub: {halfhash}")
+		hn2ek += [ { 'hostname': hostname, 'ekpubhash': ekpubhash } ]
+	else: # op == 'reenroll'
+		# For 'reenroll', the TPM _must_ already be enrolled
+		if not os.path.isdir(fpath):
+			return fail(HcpErrorTPMnotEnrolled,
+				f"unknown ekpub: {halfhash}")
+		# If anything goes wrong, git_reset() restores what was
+		# removed, and this never gets committed.
+		shutil.rmtree(fpath)
+	hint = db_due.hint_of(os.listdir(f"{path}/assets"))
+	os.makedirs(os.path.dirname(fpath), exist_ok = True)
+	os.rename(f"{path}/assets", fpath)
+	seen.add(ekpubhash)
+	if hint:
+		hints.append((hint, ekpubhash))
+	changed.append(fpath)
+	return { 'returncode': 0 }, f"map {halfhash} to {hostname}"
+
+# Must be called with the repo lock held, and the repo as the working
+# directory. Applies and commits everything that's pending in the spool, and
+# writes all the results.
+def __drain():
+	entries = __pending()
+	if not entries:
+		return
+	log(f"db_commit: draining {len(entries)} entries")
+	results = {}
+	msgs = []
+	hints = []
+	committed = False
+	try:
+		hn2ek = db_common.hn2ek_read()
+		seen = set()
+		changed = [ db_common.hn2ek_path, db_common.hn2ek_rev_path ]
+		for path in entries:
+			result, msg = __apply(path, hn2ek, seen, changed, hints)
+			results[path] = result
+			if msg:
+				msgs.append(msg)
+		if msgs:
+			db_common.hn2ek_write(hn2ek)
+			if len(msgs) == 1:
+				db_common.git_commit(msgs[0], changed)
+			else:
+				db_common.git_commit(f"batch of {len(msgs)}\n\n" +
+						'\n'.join(msgs), changed)
+			committed = True
+	except Exception as e:
+		log(f"db_commit: batch failed: {e}")
+		# recover the git repo before we release the lock
+		try:
+			db_common.git_reset()
+		except Exception as e2:
+			log(f"db_commit: rollback failed!! {e2}")
+			db_common.bail(f"CATASTROPHIC! DB stays locked for manual intervention")
+		log("db_commit: rollback complete")
+		for path in entries:
+			if path not in results or 'error' not in results[path]:
+				results[path] = {
+					'error': 'HcpErrorCommitFailed',
+					'message': f"{e}"
+				}
+	# Committed, so the new entries go in the reenrollment schedule. (Not
+	# before, a rollback would leave them in there.)
+	if committed and hints:
+		try:
+			db_due.add(hints)
+		except Exception as e:
+			log(f"db_commit: reenroll schedule update failed: {e}")
+			db_due.invalidate()
+	for path in entries:
+		__write_json(f"{path}/result.json", results[path])
+
+# submit_many() for items that all belong to the selected shard
+def __submit_shard(items):
+	entries = []
+	try:
+		for op, ekpubhash, hostname, clientjson, srcdir in items:
+			entries.append(spool(op, ekpubhash, hostname, clientjson,
+						srcdir))
+			log(f"db_commit: spooled {entries[-1]}")
+		if not entries:
+			return []
+		if group_commit_window > 0:
+			time.sleep(group_commit_window)
+		cwd = os.getcwd()
+		os.chdir(db_common.repo_path)
+		db_common.repo_lock()
+		try:
+			if not all(os.path.exists(f"{entry}/result.json")
+						for entry in entries):
+				__drain()
+		finally:
+			db_common.repo_unlock()
+			os.chdir(cwd)
+		results = []
+		for entry in entries:
+			result = __read_json(f"{entry}/result.json")
+			log(f"db_commit: {os.path.basename(entry)} result={result}")
+			if 'error' in result:
+				result = errors[result['error']](result['message'])
+			results.append(result)
+		return results
+	finally:
+		# We don't hold the lock here, so get the entries out of sight
+		# of drainers (atomically) before deleting them.
+		for entry in entries:
+			done = f"{commitq_dir()}/.done-{os.path.basename(entry)}"
+			try:
+				os.rename(entry, done)
+			except FileNotFoundError:
+				done = entry
+			shutil.rmtree(done, ignore_errors = True)
+
+# Submits many enrollments at once, each being a tuple of the submit()
+# arguments (below). They're all spooled before the lock is taken, so (unless
+# someone else is draining at the same time) they get committed together, one
+# commit per shard. Returns a list of results in the same order, each being the
+# result dict or the exception explaining why that one wasn't committed. One
+# enrollment's failure doesn't affect the others, unless the commit itself
+# fails.
+def submit_many(items):
+	byshard = {}
+	for i, item in enumerate(items):
+		byshard.setdefault(db_common.shard_of(item[1]), []).append(i)
+	results = [ None for i in items ]
+	for shard in byshard:
+		db_common.select_shard(shard)
+		indices = byshard[shard]
+		for i, result in zip(indices,
+				__submit_shard([ items[i] for i in indices ])):
+			results[i] = result
+	return results
+
+# The main API. Submits an enrollment (the assets in 'srcdir', as produced by
+# attest-enroll) and returns once it has been committed, or raises the
+# exception describing why it wasn't. 'op' is 'add' or 'reenroll'.
+def submit(op, ekpubhash, hostname, clientjson, srcdir):
+	result, = submit_many([ (op, ekpubhash, hostname, clientjson, srcdir) ])
+	if isinstance(result, Exception):
+		raise result
+	return result
@@ -3,12 +3,17 @@ import sys
 import subprocess
 import re
 import json
-import time
+import hashlib
 
 sys.path.insert(1, '/hcp/common')
 from hcp_common import log, bail, env_get, env_get_or_none, http2exit, \
 	hcp_config_extract
 
+sys.path.insert(1, '/hcp/xtra')
+import HcpGitRepo
+import HcpFairLock
+import HcpPemHelper
+
 enrollsvc_ctx = hcp_config_extract('.enrollsvc', must_exist = True)
 
 # The two non-root users we may be acting on behalf of
@@ -22,13 +27,76 @@ if 'emgmtflask' in enrollsvc_ctx:
 # The following environment elements are required by all db ops
 enrollsvc_state = enrollsvc_ctx['state']
 db_dir = f"{enrollsvc_state}/db"
-repo_name = 'enrolldb.git'
-repo_path = f"{db_dir}/{repo_name}"
-repo_lockdir = f"{db_dir}/lock-{repo_name}"
 ek_basename = 'ekpubhash'
-ek_path = f"{repo_path}/{ek_basename}"
 hn2ek_basename = 'hn2ek'
-hn2ek_path = f"{repo_path}/{hn2ek_basename}"
+hn2ek_rev_basename = 'hn2ek-rev'
+
+# Sharding. By default the DB is a single git repo, 'enrolldb.git'. If
+# '.enrollsvc.shards' is 16 or 256, it is instead split by the first 1 or 2
+# hex digits of the ekpubhash into that many repos, 'enrolldb-<shard>.git',
+# each of which is a complete DB in its own right (with its own hn2ek, lock,
+# commit spool, reenroll index, and commit history), so writes to different
+# shards proceed in parallel, and replicas (attestsvc) can replicate a subset
+# of them. The number of shards is fixed when the DB is created (see
+# init_repo.sh), it can't be changed on an existing DB.
+#
+# Most of the module-level paths below (repo_path, ek_path, hn2ek_path, ...)
+# refer to the "selected" shard, see select_shard(). Operations that only
+# concern one ekpubhash don't need to worry about that, fpath() routes to the
+# right shard regardless. Operations that span shards (query, delete, find,
+# the janitor, the reenroller, ...) loop over the shards, selecting each in
+# turn. Selection is per-process state, so don't switch shards from multiple
+# threads. Without sharding, there's one shard, called None, and everything
+# is as it always was.
+shards = 1
+if 'shards' in enrollsvc_ctx:
+	shards = int(enrollsvc_ctx['shards'])
+if shards not in [ 1, 16, 256 ]:
+	bail(f"Invalid number of shards: {shards}")
+shard_digits = { 1: 0, 16: 1, 256: 2 }[shards]
+if shards == 1:
+	shard_names = [ None ]
+else:
+	shard_names = [ f"{i:0{shard_digits}x}" for i in range(shards) ]
+
+def shard_of(ekpubhash):
+	if shards == 1:
+		return None
+	return ekpubhash[:shard_digits]
+
+# The shards that can hold enrollments with the given ekpubhash prefix
+def shards_for_prefix(prefix):
+	return [ s for s in shard_names
+		if s is None or s[:len(prefix)] == prefix[:len(s)] ]
+
+def shard_suffix(shard):
+	if shard is None:
+		return ''
+	return f"-{shard}"
+
+def shard_repo_path(shard):
+	return f"{db_dir}/enrolldb{shard_suffix(shard)}.git"
+
+# Per-shard state that lives alongside the repo (eg. 'commitq'), for the
+# selected shard.
+def state_path(name):
+	return f"{db_dir}/{name}{shard_suffix(current_shard)}"
+
+def select_shard(shard):
+	global current_shard, repo_name, repo_path, repo_lockdir
+	global repo_lockdir_legacy, ek_path, hn2ek_path, hn2ek_rev_path
+	current_shard = shard
+	repo_name = f"enrolldb{shard_suffix(shard)}.git"
+	repo_path = f"{db_dir}/{repo_name}"
+	repo_lockdir = f"{db_dir}/lockq-{repo_name}"
+	# The pre-HcpFairLock mutex (a directory, created and removed)
+	repo_lockdir_legacy = f"{db_dir}/lock-{repo_name}"
+	ek_path = f"{repo_path}/{ek_basename}"
+	hn2ek_path = f"{repo_path}/{hn2ek_basename}"
+	hn2ek_rev_path = f"{repo_path}/{hn2ek_rev_basename}"
+
+select_shard(shard_names[0])
+
 valid_ekpubhash_re = '[a-f0-9_-]{64}'
 valid_ekpubhash_prefix_re = '[a-f0-9_-]*'
 valid_ekpubhash_prog = re.compile(valid_ekpubhash_re)
@@ -49,18 +117,24 @@ def valid_ekpubhash_prefix(ekpubhash):
 def halfhash(ekpubhash):
 	return ekpubhash[:16]
 
-def fpath_parent(ekpubhash):
-	ply1 = ekpubhash[:2]
-	ply2 = ekpubhash[:6]
-	return f"{ek_path}/{ply1}/{ply2}"
-
 def fpath_base(ekpubhash):
 	return ekpubhash[:32]
 
+# The path of the enrollment, relative to the top of its repo
+def fpath_rel(ekpubhash):
+	ply1 = ekpubhash[:2]
+	ply2 = ekpubhash[:6]
+	return f"{ek_basename}/{ply1}/{ply2}/{fpath_base(ekpubhash)}"
+
+# The path of the enrollment, in whichever shard it belongs to
 def fpath(ekpubhash):
-	return f"{fpath_parent(ekpubhash)}/{fpath_base(ekpubhash)}"
+	return f"{shard_repo_path(shard_of(ekpubhash))}/{fpath_rel(ekpubhash)}"
+
+def fpath_parent(ekpubhash):
+	return os.path.dirname(fpath(ekpubhash))
 
-# Given a prefix, figure out a wildcard to match on all matching fpaths
+# Given a prefix, figure out a wildcard to match on all matching fpaths (in the
+# selected shard)
 def fpath_mask(prefix):
 	if len(prefix) < 2:
 		return f"{ek_path}/{prefix}*/*/*"
@@ -73,23 +147,40 @@ def fpath_mask(prefix):
 	ply3 = prefix[:32]
 	return f"{ek_path}/{ply1}/{ply2}/{ply3}"
 
+# We want to serialize all attempts to commit enrollments to the git repo. This
+# uses HcpFairLock, so waiters are served in arrival order and are woken by the
+# kernel as soon as the lock is released (rather than polling). If a previous
+# holder died while holding the lock (kill -9, OOM, "CATASTROPHIC!" bail-out),
+# the lock is handed on anyway and we find out about it here. In that case,
+# the working tree may have been left with a half-done transaction, so we roll
+# it back before returning. NB, callers chdir() to repo_path before locking.
+# Each shard has its own lock, and this locks the selected one. (Don't switch
+# shards while holding it.)
+#
+# 'db_lock.py' is the operator's view of this: who holds it, who's waiting,
+# what the wait/hold statistics look like, and recovery of a dead holder.
+__repo_locks = {}
+__repo_lock = None
+
 def repo_lock():
-	# We want to serialize all attempts to commit enrollments to the git
-	# repo. We use directory-creation as a mutex. I know, this isn't
-	# perfect. But it's pretty stable, doesn't add dependencies, and if
-	# something catastrophic happens, it's easy for an admin to figure out.
-	# ("I kill -9'd the service, restarted, and now it's not accepting
-	# enrollments, plus there's a weird "lock" directory in the repo...")
-	while True:
+	global __repo_lock
+	if repo_lockdir not in __repo_locks:
+		__repo_locks[repo_lockdir] = HcpFairLock.FairLock(repo_lockdir)
+	__repo_lock = __repo_locks[repo_lockdir]
+	__repo_lock.acquire()
+	log(f"repo_lock: acquired after {__repo_lock.wait_time:.6f}s")
+	if __repo_lock.stale_holder is not None:
+		log(f"repo_lock: previous holder died: {__repo_lock.stale_holder}")
 		try:
-			os.mkdir(repo_lockdir)
-			break
-		except FileExistsError:
-			pass
-		time.sleep(0.2)
+			git_reset()
+		except Exception as e:
+			log(f"repo_lock: failed to recover!: {e}")
+			bail(f"CATASTROPHIC! DB stays locked for manual intervention")
+		log(f"repo_lock: recovery complete")
 
 def repo_unlock():
-	os.rmdir(repo_lockdir)
+	__repo_lock.release()
+	log(f"repo_unlock: released after {__repo_lock.hold_time:.6f}s")
 
 # We use TPM ekpubhash to determine paths to files (including the "hostname"
 # file), so the DB is inherently indexed by ekpubhash and inherently maps
@@ -119,33 +210,182 @@ def repo_unlock():
 # them back in.) Instead, we use an array, where each entry is a dict having
 # exactly two key-value pairs - one for "ekpubhash", another for "hostname".
 # Order is irrelevant, but we can't make it vanish.
+#
+# The hn2ek file is kept sorted by hostname (then ekpubhash), and alongside it
+# we keep 'hn2ek-rev', which is an array of indices into hn2ek, ordered by
+# _reversed_ hostname. Between them, "find" can use bisection to narrow the
+# candidates whenever the hostname regex has a literal prefix (eg. "^web") or
+# a literal (domain) suffix (eg. "\.hcphacking\.xyz$"), and only run the regex
+# against those candidates. If 'hn2ek-rev' is missing (an older DB that
+# hasn't been through the janitor yet), suffix queries simply scan.
 def hn2ek_new():
 	return []
 def __hn2ek_sort_cb(entry):
-	return entry['hostname']
+	return (entry['hostname'], entry['ekpubhash'])
 def hn2ek_sort(data):
 	data.sort(key = __hn2ek_sort_cb)
 	return data
+def hn2ek_rev_build(data):
+	rev = list(range(len(data)))
+	rev.sort(key = lambda i: data[i]['hostname'][::-1])
+	return rev
 def hn2ek_read():
 	with open(hn2ek_path, 'r') as f:
 		return json.load(f)
+def hn2ek_rev_read():
+	try:
+		with open(hn2ek_rev_path, 'r') as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return None
 def hn2ek_write(data):
+	data = hn2ek_sort(data)
 	with open(hn2ek_path, 'w') as f:
-		return json.dump(hn2ek_sort(data), f)
-def hn2ek_query(data, hostname_regex):
+		json.dump(data, f)
+	with open(hn2ek_rev_path, 'w') as f:
+		json.dump(hn2ek_rev_build(data), f)
+
+# Given a hostname regex (as used with search(), not match()), return a
+# 2-tuple of the literal prefix and literal suffix that any matching hostname
+# must have. Either can be None. We're deliberately conservative: anything we
+# don't fully understand (alternation, inline flags, lookarounds, ...) means no
+# narrowing, and the regex still gets run against whatever candidates remain,
+# so getting this wrong can only cost speed, never correctness.
+__regex_meta = '.^$*+?{}[]\\|()'
+__regex_quant = '*+?{'
+def hn2ek_regex_affixes(hostname_regex):
+	r = hostname_regex
+	if '|' in r or '(?' in r:
+		return None, None
+	prefix = None
+	if r.startswith('^') or r.startswith('\\A'):
+		i = 1 if r[0] == '^' else 2
+		lits = []
+		while i < len(r):
+			c = r[i]
+			if c == '\\':
+				if i + 1 >= len(r) or r[i + 1].isalnum():
+					break
+				c = r[i + 1]
+				step = 2
+			elif c in __regex_meta:
+				break
+			else:
+				step = 1
+			if i + step < len(r) and r[i + step] in __regex_quant:
+				# The literal is quantified; '+' still guarantees
+				# one instance, the others don't.
+				if r[i + step] == '+':
+					lits.append(c)
+				break
+			lits.append(c)
+			i += step
+		prefix = ''.join(lits)
+	suffix = None
+	def escaped(j):
+		n = 0
+		while j > 0 and r[j - 1] == '\\':
+			n += 1
+			j -= 1
+		return n % 2 == 1
+	if r.endswith('$') and not escaped(len(r) - 1):
+		i = len(r) - 2
+		lits = []
+		while i >= 0:
+			c = r[i]
+			if escaped(i):
+				if c.isalnum():
+					# An escape sequence (\d, \w, ...), so
+					# the literal run ends with what we have.
+					break
+				lits.append(c)
+				i -= 2
+				continue
+			if c in __regex_meta:
+				break
+			lits.append(c)
+			i -= 1
+		suffix = ''.join(reversed(lits))
+	return prefix or None, suffix or None
+
+# Cursors let "find" results be paginated. A cursor is the sort-key of the
+# last entry returned, "<hostname>/<ekpubhash>" ('/' can't appear in either),
+# and the next page resumes with whatever sorts after it.
+def hn2ek_cursor(entry):
+	return f"{entry['hostname']}/{entry['ekpubhash']}"
+def hn2ek_cursor_key(cursor):
+	hostname, _, ekpubhash = cursor.rpartition('/')
+	return (hostname, ekpubhash)
+
+# Bisection helpers. (bisect's 'key' argument only showed up in python 3.10,
+# and we still support older distros, so we roll our own.)
+def __bisect_left(n, key, target):
+	lo, hi = 0, n
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if key(mid) < target:
+			lo = mid + 1
+		else:
+			hi = mid
+	return lo
+
+# Returns a 2-tuple of the matching entries (at most 'limit' of them, or all
+# of them if 'limit' is None) and the cursor to continue from (None if there
+# are no more results).
+def hn2ek_query(data, hostname_regex, rev = None, cursor = None, limit = None):
 	hostname_prog = re.compile(hostname_regex)
+	prefix, suffix = hn2ek_regex_affixes(hostname_regex)
+	def fwdkey(i):
+		return __hn2ek_sort_cb(data[i])
+	start = 0
+	if cursor:
+		# Strictly after the cursor entry
+		ckey = hn2ek_cursor_key(cursor)
+		start = __bisect_left(len(data), fwdkey, ckey)
+		if start < len(data) and fwdkey(start) == ckey:
+			start += 1
+	if prefix:
+		start = max(start, __bisect_left(len(data),
+				lambda i: data[i]['hostname'], prefix))
+		candidates = range(start, len(data))
+	elif suffix and rev is not None and len(rev) == len(data):
+		revsuffix = suffix[::-1]
+		def revkey(i):
+			return data[rev[i]]['hostname'][::-1]
+		i = __bisect_left(len(rev), revkey, revsuffix)
+		picks = []
+		while i < len(rev) and revkey(i).startswith(revsuffix):
+			if rev[i] >= start:
+				picks.append(rev[i])
+			i += 1
+		# hn2ek is in sort order, so its indices are too
+		picks.sort()
+		candidates = picks
+	else:
+		candidates = range(start, len(data))
 	results = []
-	for i in data:
-		if hostname_prog.search(i['hostname']):
-			results += [i]
-	return results
+	for i in candidates:
+		entry = data[i]
+		hostname = entry['hostname']
+		if prefix and not hostname.startswith(prefix):
+			# We've walked off the end of the prefix range
+			break
+		if suffix and not hostname.endswith(suffix):
+			continue
+		if not hostname_prog.search(hostname):
+			continue
+		if limit is not None and len(results) >= limit:
+			return results, hn2ek_cursor(results[-1])
+		results.append(entry)
+	return results, None
 def hn2ek_add(data, hostname, ekpubhash):
 	return data + [ { 'hostname': hostname, 'ekpubhash': ekpubhash } ]
 def hn2ek_delete(data, hostname, ekpubhash):
 	x = { 'hostname': hostname, 'ekpubhash': ekpubhash }
 	return [i for i in data if i != x]
-def hn2ek_xquery(hostname_regex):
-	return hn2ek_query(hn2ek_read(), hostname_regex)
+def hn2ek_xquery(hostname_regex, cursor = None, limit = None):
+	return hn2ek_query(hn2ek_read(), hostname_regex, rev = hn2ek_rev_read(),
+			cursor = cursor, limit = limit)
 def hn2ek_xadd(hostname, ekpubhash):
 	data = hn2ek_add(hn2ek_read(), hostname, ekpubhash)
 	hn2ek_write(data)
@@ -153,6 +393,135 @@ def hn2ek_xdelete(hostname, ekpubhash):
 	data = hn2ek_delete(hn2ek_read(), hostname, ekpubhash)
 	hn2ek_write(data)
 
+# Read-only operations ("query", "find") don't take the repo lock. Instead
+# they read a snapshot of the DB, which is the tree of whatever commit HEAD
+# pointed to when the snapshot was taken. That's always a consistent view,
+# because writers only move HEAD once a transaction is fully committed, and
+# anything they do to the working tree before then (or roll back after a
+# failure) is invisible to snapshot readers. So readers never block on a
+# writer (or on each other), and writers never block on readers.
+#
+# Paths given to the snapshot are relative to the top of the repo, eg.
+# 'hn2ek', or 'ekpubhash/ab/abcdef/abcdef...'. The snapshot is of the selected
+# shard, unless 'path' says which repo to use.
+class DbSnapshot:
+	def __init__(self, path = None):
+		if not path:
+			path = repo_path
+		self.repo = HcpGitRepo.GitRepo(path)
+		self.commit = self.repo.read_ref('HEAD')
+		if not self.commit:
+			raise HcpGitError(f"no HEAD commit in {path}")
+		self.tree = self.repo.commit_tree(self.commit)
+		log(f"DbSnapshot: commit={self.commit}")
+
+	# Returns the (mode, sha) of 'path', or None if it doesn't exist
+	def lookup(self, path):
+		return self.repo.tree_lookup(self.tree, path)
+
+	def read_file(self, path):
+		x = self.lookup(path)
+		if not x or x[0] == HcpGitRepo.MODE_TREE:
+			return None
+		return self.repo.read_blob(x[1])
+
+	def read_blob(self, sha):
+		return self.repo.read_blob(sha)
+
+	def hn2ek(self):
+		return json.loads(self.read_file(hn2ek_basename))
+
+	def hn2ek_rev(self):
+		data = self.read_file(hn2ek_rev_basename)
+		if data is None:
+			return None
+		return json.loads(data)
+
+	# Generator, the snapshot equivalent of glob.glob(fpath_mask(prefix)).
+	# For each enrollment whose ekpubhash matches the prefix, this yields
+	# a 2-tuple of its path and a dict mapping each of its file (and
+	# subdirectory) names to (mode, sha).
+	def entries(self, prefix):
+		def subtrees(sha):
+			return [ (n, s) for m, n, s in self.repo.read_tree(sha)
+					if m == HcpGitRepo.MODE_TREE and
+					n[:len(prefix)] == prefix[:len(n)] ]
+		x = self.lookup(ek_basename)
+		if not x or x[0] != HcpGitRepo.MODE_TREE:
+			return
+		for ply1, sha1 in subtrees(x[1]):
+			for ply2, sha2 in subtrees(sha1):
+				for ply3, sha3 in subtrees(sha2):
+					files = { n: (m, s) for m, n, s in
+						self.repo.read_tree(sha3) }
+					path = f"{ek_basename}/{ply1}/{ply2}/{ply3}"
+					yield path, files
+
+	# Generator, like entries(''), but only for the enrollments that are
+	# different from those in commit 'since', ie. that have been added,
+	# changed, or deleted since. Git records each subtree by the hash of
+	# its contents, so any subtree whose hash hasn't changed is skipped
+	# without being read, and the cost depends on the size of the change
+	# rather than the size of the DB. Deleted enrollments are yielded with
+	# 'files' set to None.
+	def changed(self, since):
+		def subtrees(sha):
+			if not sha:
+				return {}
+			return { n: s for m, n, s in self.repo.read_tree(sha)
+					if m == HcpGitRepo.MODE_TREE }
+		def walk(new, old, depth, path):
+			if new == old:
+				return
+			if depth == 3:
+				files = None
+				if new:
+					files = { n: (m, s) for m, n, s in
+						self.repo.read_tree(new) }
+				yield path, files
+				return
+			a = subtrees(new)
+			b = subtrees(old)
+			for name in sorted(set(a) | set(b)):
+				yield from walk(a.get(name), b.get(name), depth + 1,
+						f"{path}/{name}")
+		def ektree(tree):
+			x = self.repo.tree_lookup(tree, ek_basename)
+			if not x or x[0] != HcpGitRepo.MODE_TREE:
+				return None
+			return x[1]
+		yield from walk(ektree(self.tree),
+				ektree(self.repo.commit_tree(since)), 0, ek_basename)
+
+def snapshot():
+	return DbSnapshot()
+
+# Whether 'ekpubhash' is enrolled, as of the latest commit. This neither takes
+# the lock nor selects a shard, so it's fine to call from threads (eg. the
+# web API's), but the answer can be out of date by the time the caller acts on
+# it, so it's only good for turning requests away early. The authoritative
+# check is the one made when committing (see db_commit.py).
+def enrolled(ekpubhash):
+	snap = DbSnapshot(shard_repo_path(shard_of(ekpubhash)))
+	return snap.lookup(fpath_rel(ekpubhash)) is not None
+
+# The same, given an ekpub as uploaded (bytes), ie. before attest-enroll has
+# converted it into the ek.pub whose hash is the ekpubhash. We can't predict
+# that in general (attest-enroll accepts other forms of EK), but if the upload
+# is a PEM public key, either as-is or re-encoded the way openssl would write
+# it, its hash is the ekpubhash of that key, so a match against the DB is
+# proof that the key is already enrolled. Returns the ekpubhash that matched,
+# or None. ('raw' is the hash of 'data', if the caller already has it.)
+def enrolled_ekpub(data, raw = None):
+	hashes = [ raw or hashlib.sha256(data).hexdigest() ]
+	pem = HcpPemHelper.pem_normalize(data)
+	if pem and pem != data:
+		hashes.append(hashlib.sha256(pem).hexdigest())
+	for ekpubhash in hashes:
+		if enrolled(ekpubhash):
+			return ekpubhash
+	return None
+
 class HcpGitError(Exception):
 	pass
 
@@ -168,14 +537,66 @@ def __git_cmd(args):
 		raise HcpGitError(f"Failed: {expanded}")
 	return c
 
-def git_commit(msg):
-	c = __git_cmd(['status', '--porcelain'])
-	if len(c.stdout) > 0:
+# Commits the working tree. If 'paths' is given, it lists everything that
+# changed (files or directories, absolute or relative to the repo, including
+# things that were deleted), and the commit is made in-process by HcpGitRepo:
+# blobs and trees are written only for those paths, only the subtrees on the
+# way to them (eg. ekpubhash/<ply1>/<ply2>/) are rewritten, the ref is moved
+# atomically, and the index is patched to match. No 'git' processes, and
+# nothing walks the ekpubhash tree, so the cost of a commit depends on the
+# size of the change rather than the size of the DB. Objects are written
+# loose, so we run git's own 'gc --auto' when git's heuristic says it's due.
+# Once the ref has moved, failing to patch the index or gc only gets logged.
+#
+# Without 'paths' (eg. the janitor), everything gets staged by git.
+def git_commit(msg, paths = None):
+	if paths is None:
+		__git_cmd(['add', '-A', '.'])
+		tree = __git_cmd(['write-tree']).stdout.strip()
+		head, headtree = __git_cmd(['rev-parse', 'HEAD',
+					'HEAD^{tree}']).stdout.split()
+		if tree == headtree:
+			log('git_commit(): no changes to commit')
+			return
 		log('git_commit(): committing changes')
-		__git_cmd(['add', '.'])
-		__git_cmd(['commit', '-a', '-m', msg])
-	else:
+		commit = __git_cmd(['commit-tree', tree, '-p', head, '-m',
+					msg]).stdout.strip()
+		__git_cmd(['update-ref', '-m', f"commit: {msg.splitlines()[0]}",
+			'HEAD', commit, head])
+		return
+	repo = HcpGitRepo.GitRepo(repo_path)
+	head = repo.read_ref('HEAD')
+	headtree = repo.commit_tree(head)
+	changes = {}
+	removed = []
+	added = []
+	for p in paths:
+		rel = os.path.relpath(p, repo_path)
+		removed.append(rel)
+		changes[rel] = repo.write_path(f"{repo_path}/{rel}", added, rel)
+	tree = repo.update_tree(headtree, changes)
+	if tree == headtree:
 		log('git_commit(): no changes to commit')
+		return
+	log('git_commit(): committing changes')
+	commit = repo.write_commit(tree, [ head ], msg)
+	repo.update_ref('HEAD', commit, head, f"commit: {msg.splitlines()[0]}")
+	# The commit is made, so nothing after this may fail it (the caller
+	# would roll back, and report a failure for what's in HEAD). Commits
+	# don't come from the index (even 'git add -A' restages the working
+	# tree), so a stale one only misleads whoever runs 'git status', until
+	# git_reset() or a later 'reset -q' here.
+	try:
+		if not repo.update_index(removed, added):
+			log('git_commit(): index not patchable, resetting it')
+			__git_cmd(['reset', '-q'])
+	except Exception as e:
+		log(f"git_commit(): couldn't refresh the index, leaving it: {e}")
+	try:
+		if repo.needs_gc():
+			__git_cmd(['gc', '--auto', '--quiet'])
+	except Exception as e:
+		log(f"git_commit(): gc failed, leaving it for later: {e}")
 
 def git_reset():
 	__git_cmd(['reset', '--hard'])
@@ -0,0 +1,167 @@
+import os
+import re
+import sys
+import glob
+import shutil
+
+sys.path.insert(1, '/hcp/common')
+from hcp_common import log
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_common
+import db_manifest
+
+# The reenrollment schedule. Each enrollment has a 'hint-reenroll-<hint>' file
+# (produced by the 'genreenroll' genprog), where <hint> is the time it's due
+# to be reenrolled, in datetime2hint() form ("YYYYMMDDhhmmss"). Rather than
+# have the reenroller glob the entire DB for those files every time it runs,
+# we keep an index of them alongside the repo, bucketed by the hour;
+#
+#   {db_dir}/reenroll-due/
+#     .complete           exists once the index has been bootstrapped
+#     <YYYYMMDDhh>        one line per enrollment due in that hour, of the
+#                         form "<hint> <ekpubhash>"
+#
+# Lines get appended (by db_commit.py) when enrollments are committed, and
+# removed (by the reenroller) once they've been dealt with. Both happen with
+# the repo lock held. Lines are never updated in place, so when an enrollment
+# gets reenrolled or deleted, its old line goes stale rather than away. The
+# reenroller checks each due line against the DB before acting on it (see
+# current()), and removes the ones that no longer match.
+#
+# Until the index is bootstrapped (from a scan of the DB, see bootstrap()),
+# nothing gets added to it.
+#
+# Each shard (see db_common.select_shard()) has its own index, and these
+# functions use the selected shard's.
+
+def due_dir():
+	return db_common.state_path('reenroll-due')
+
+def complete_path():
+	return f"{due_dir()}/.complete"
+
+# Only the hint files themselves, not any signatures (etc) of them
+hint_prog = re.compile('hint-reenroll-([0-9]+)')
+
+def hint_of(names):
+	for name in names:
+		m = hint_prog.fullmatch(name)
+		if m:
+			return m.group(1)
+	return None
+
+def bucket(hint):
+	return hint[:10]
+
+def ready():
+	return os.path.exists(complete_path())
+
+def __parse(line):
+	x = line.split()
+	if len(x) != 2 or not x[0].isdigit() or \
+			not db_common.valid_ekpubhash_prog.fullmatch(x[1]):
+		return None
+	return x[0], x[1]
+
+def __read(path):
+	result = []
+	try:
+		with open(path, 'r') as f:
+			for line in f:
+				x = __parse(line)
+				if x:
+					result.append(x)
+	except FileNotFoundError:
+		pass
+	return result
+
+def __append(basedir, pairs):
+	buckets = {}
+	for hint, ekpubhash in pairs:
+		buckets.setdefault(bucket(hint), []).append(f"{hint} {ekpubhash}\n")
+	for b in buckets:
+		with open(f"{basedir}/{b}", 'a') as f:
+			f.write(''.join(buckets[b]))
+
+# Must be called with the repo lock held. 'pairs' is a list of (hint,
+# ekpubhash) 2-tuples for enrollments that have just been committed.
+def add(pairs):
+	if not pairs or not ready():
+		return
+	__append(due_dir(), pairs)
+
+# Must be called with the repo lock held. (Re)builds the index from the
+# committed DB.
+def bootstrap():
+	log(f"db_due: bootstrapping {due_dir()}")
+	snap = db_common.snapshot()
+	pairs = []
+	for path, files in snap.entries(''):
+		hint = hint_of(files.keys())
+		if not hint:
+			continue
+		m = db_manifest.read_snapshot(snap, files)
+		if m:
+			ekpubhash = m['ekpubhash']
+		else:
+			ekpubhash = snap.read_blob(files['ekpubhash'][1]).decode()
+		pairs.append((hint, ekpubhash.strip('\n')))
+	tmp = f"{due_dir()}.tmp"
+	shutil.rmtree(tmp, ignore_errors = True)
+	os.makedirs(tmp)
+	__append(tmp, pairs)
+	open(f"{tmp}/.complete", 'w').close()
+	shutil.rmtree(due_dir(), ignore_errors = True)
+	os.rename(tmp, due_dir())
+	log(f"db_due: bootstrapped with {len(pairs)} entries")
+
+# Doesn't need the lock. Returns the (hint, ekpubhash) 2-tuples that are due
+# as of 'hintnow', earliest first, reading only the buckets up to the current
+# one.
+def due(hintnow):
+	result = []
+	now = bucket(hintnow)
+	for path in sorted(glob.glob(f"{due_dir()}/[0-9]*")):
+		name = os.path.basename(path)
+		if not name.isdigit():
+			continue
+		if name > now:
+			break
+		result += [ x for x in __read(path) if x[0] <= hintnow ]
+	result.sort()
+	return result
+
+# Checks a due line against a DbSnapshot, ie. that the enrollment still
+# exists and still has that hint.
+def current(snap, hint, ekpubhash):
+	path = db_common.fpath_rel(ekpubhash)
+	return snap.lookup(f"{path}/hint-reenroll-{hint}") is not None
+
+# Must be called with the repo lock held. Removes the given (hint, ekpubhash)
+# 2-tuples from the index.
+def remove(pairs):
+	buckets = {}
+	for x in pairs:
+		buckets.setdefault(bucket(x[0]), set()).add(x)
+	for b in buckets:
+		path = f"{due_dir()}/{b}"
+		keep = [ x for x in __read(path) if x not in buckets[b] ]
+		if not keep:
+			try:
+				os.unlink(path)
+			except FileNotFoundError:
+				pass
+			continue
+		with open(f"{path}.tmp", 'w') as f:
+			f.write(''.join(f"{h} {e}\n" for h, e in keep))
+		os.rename(f"{path}.tmp", path)
+
+# Something went wrong with the index (eg. we couldn't add to it), so force a
+# rebuild next time around.
+def invalidate():
+	log(f"db_due: invalidating {due_dir()}")
+	try:
+		os.unlink(complete_path())
+	except FileNotFoundError:
+		pass
@@ -1,5 +1,4 @@
 import sys
-import os
 import json
 
 sys.path.insert(1, '/hcp/common')
@@ -14,8 +13,14 @@ http2exit = db_common.http2exit
 # db_find.py <clientjson>
 # where clientjson is;
 #   {
-#       'hostname_regex': <regular expression>
+#       'hostname_regex': <regular expression>,
+#       'cursor': <optional, 'next_cursor' from the previous page>,
+#       'limit': <optional, max number of entries to return>
 #   }
+# Results are paginated. If there are more results than fit in one page, the
+# output has a 'next_cursor' field that the client passes back as 'cursor' to
+# get the next page. The page size is the smaller of the client's 'limit' and
+# the server's '.enrollsvc.find_page_size' (default 1000).
 
 if len(sys.argv) != 2:
 	bail(f"Wrong number of arguments: {len(sys.argv)}")
@@ -27,26 +32,50 @@ if len(clientjson) == 0:
 clientdata = json.loads(clientjson)
 
 hostname_regex = clientdata['hostname_regex']
+cursor = None
+if 'cursor' in clientdata and clientdata['cursor']:
+	cursor = clientdata['cursor']
+limit = 1000
+if 'find_page_size' in db_common.enrollsvc_ctx:
+	limit = int(db_common.enrollsvc_ctx['find_page_size'])
+if 'limit' in clientdata and clientdata['limit']:
+	limit = min(limit, int(clientdata['limit']))
+if limit < 1:
+	bail(f"Invalid page size: {limit}")
 
-# Change working directory to the git repo
-os.chdir(db_common.repo_path)
-
-# Critical section, same basic idea as in db_add.py
-db_common.repo_lock()
-caught = None
-try:
-	hn2ek_data = db_common.hn2ek_read()
-except Exception as e:
-	caught = e
-db_common.repo_unlock()
-if caught:
-	raise caught
-
-entries = db_common.hn2ek_query(hn2ek_data, hostname_regex)
+# No lock required, we read the hn2ek index (and its reverse) from the most
+# recent commit, not from the working tree. See db_common.DbSnapshot.
+#
+# If the DB is sharded, each shard has its own hn2ek. Each gives us (up to) a
+# page of results following the cursor, in sort order, and the page we return
+# is the first 'limit' of those, merged. There are more results if we had to
+# leave some out, or if any shard had more.
+entries = []
+more = False
+for shard in db_common.shard_names:
+	db_common.select_shard(shard)
+	snap = db_common.snapshot()
+	hn2ek_data = snap.hn2ek()
+	hn2ek_rev = snap.hn2ek_rev()
+	x, x_cursor = db_common.hn2ek_query(hn2ek_data, hostname_regex,
+			rev = hn2ek_rev, cursor = cursor, limit = limit)
+	entries += x
+	if x_cursor:
+		more = True
+if len(db_common.shard_names) > 1:
+	db_common.hn2ek_sort(entries)
+if len(entries) > limit:
+	entries = entries[:limit]
+	more = True
+next_cursor = None
+if more:
+	next_cursor = db_common.hn2ek_cursor(entries[-1])
 
 result = {
 	'hostname_regex': hostname_regex,
 	'entries': entries
 }
+if next_cursor:
+	result['next_cursor'] = next_cursor
 print(json.dumps(result, sort_keys = True))
 sys.exit(http2exit(200))
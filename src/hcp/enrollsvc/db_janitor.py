@@ -1,7 +1,6 @@
 import sys
 import os
 import json
-import glob
 
 sys.path.insert(1, '/hcp/common')
 import hcp_common
@@ -10,68 +9,264 @@ http2exit = hcp_common.http2exit
 
 sys.path.insert(1, '/hcp/enrollsvc')
 import db_common
+import db_manifest
 bail = db_common.bail
 git_commit = db_common.git_commit
 git_reset = db_common.git_reset
 
-if len(sys.argv) != 1:
+# The janitor looks for known problems in the DB and fixes them, and makes sure
+# that hn2ek agrees with the enrollments.
+#
+# Usage: db_janitor.py [incremental|full]
+#
+# In 'incremental' mode (the default), it only looks at the enrollments that
+# have been added, changed, or deleted since the commit that the previous run
+# looked at (recorded in {db_dir}/janitor-state), as determined by git (see
+# DbSnapshot.changed()). In 'full' mode, it looks at everything, and also
+# removes hn2ek entries that have no enrollment and rebuilds hn2ek-rev if it's
+# missing or out of date. If there's no (usable) record of a previous run,
+# incremental becomes full.
+#
+# Either way, the looking is done on a snapshot, without the repo lock. Only
+# the entries that need fixing are then revisited with the lock held, 'chunk'
+# at a time (the lock gets released between chunks, so enrollments don't wait
+# behind the whole sweep), and only the files that need scrubbing get written.
+# Each chunk is its own commit.
+#
+# The output reports how many entries were scanned and fixed. If the DB is
+# sharded (see db_common.select_shard()), each shard is done in turn, with its
+# own state, and the output also has the per-shard results, in 'shards'.
+
+chunk = 200
+if 'janitor_chunk' in db_common.enrollsvc_ctx:
+	chunk = int(db_common.enrollsvc_ctx['janitor_chunk'])
+
+if len(sys.argv) > 2:
 	bail(f"Wrong number of arguments: {len(sys.argv)}")
+mode = 'incremental'
+if len(sys.argv) == 2:
+	mode = sys.argv[1]
+if mode not in [ 'incremental', 'full' ]:
+	bail(f"Unknown mode: {mode}")
+
+def state_read():
+	try:
+		with open(db_common.state_path('janitor-state'), 'r') as f:
+			return json.load(f)['commit']
+	except (FileNotFoundError, ValueError, KeyError) as e:
+		log(f"db_janitor: no usable state: {e}")
+		return None
 
-log("db_janitor: starting in {db_common.repo_path}")
-# Change working directory to the git repo
-os.chdir(db_common.repo_path)
+def state_write(commit):
+	state_path = db_common.state_path('janitor-state')
+	with open(f"{state_path}.tmp", 'w') as f:
+		json.dump({ 'commit': commit }, f)
+	os.rename(f"{state_path}.tmp", state_path)
 
-# Get a wildcard pattern for all matching entries
-fpath = db_common.fpath_mask('')
-log(f"db_janitor: fpath={fpath}")
+# The known problems, right now, are that ekpubhash and hostname shouldn't be
+# \n-terminated. This could be soooo much more ... umm ... 'validating'.
+def scrub(value):
+	return value.replace('\n', '')
 
-# This function gets run on each DB entry and is expected to return a 2-tuple
-# of the (possibly-altered) ekpubhash and hostname.
+# This function gets run (with the lock held) on each DB entry that needs it
+# and is expected to return a 3-tuple of the (possibly-altered) ekpubhash and
+# hostname, and whether anything got altered. Files only get rewritten if they
+# change.
 def scrub_entry(path):
-	ekpubhash = open(f"{path}/ekpubhash", 'r').read()
-	hostname = open(f"{path}/hostname", 'r').read()
-	# This could be soooo much more ... umm ... 'validating'. Right now
-	# we're only looking out for known problems, namely that ekpubhash and
-	# hostname shouldn't be \n-terminated.
-	log(f"db_janitor:  prescrub: ekpubhash={ekpubhash}, hostname={hostname}")
-	ekpubhash = ekpubhash.replace('\n', '')
-	hostname = hostname.replace('\n', '')
-	log(f"db_janitor: postscrub: ekpubhash={ekpubhash}, hostname={hostname}")
-	open(f"{path}/ekpubhash", 'w').write(f"{ekpubhash}")
-	open(f"{path}/hostname", 'w').write(f"{hostname}")
-	return ekpubhash, hostname
-
-# Critical section, same basic idea as in db_add.py
-db_common.repo_lock()
-caught = None
-try:
-	hn2ek = db_common.hn2ek_new()
-	matches = glob.glob(fpath)
-	log(f"db_janitor: matches={matches}")
-	for path in matches:
-		log(f"db_janitor: loop start, path={path}")
-		ekpubhash, hostname = scrub_entry(path)
-		hn2ek += [ { 'hostname': hostname, 'ekpubhash': ekpubhash } ]
-	db_common.hn2ek_write(hn2ek)
-	git_commit("Janitor")
-except Exception as e:
-	caught = e
-	log(f"db_janitor: failed enrollment DB update: {caught}")
-	# recover the git repo before we release the lock
-	try:
-		git_reset()
-	except Exception as e:
-		log(f"db_janitor: failed to recover!: {e}")
-		bail(f"CATASTROPHIC! DB stays locked for manual intervention")
-	log(f"db_janitor: enrollment DB rollback complete")
-
-# Remove the lock, then reraise any exception we intercepted
-db_common.repo_unlock()
-if caught:
-	log(f"db_janitor: enrollment DB exception continuation: {caught}")
-	raise caught
-
-result = json.dumps({ 'hn2ek': hn2ek}, sort_keys = True)
+	result = []
+	altered = False
+	for name in [ 'ekpubhash', 'hostname' ]:
+		before = open(f"{path}/{name}", 'r').read()
+		after = scrub(before)
+		if after != before:
+			log(f"db_janitor: scrubbing {path}/{name}: {before!r}")
+			open(f"{path}/{name}", 'w').write(after)
+			altered = True
+		result.append(after)
+	return result[0], result[1], altered
+
+# hn2ek entries, grouped by the directory name (fpath_base()) of the
+# enrollment they refer to.
+def hn2ek_bybase(data):
+	result = {}
+	for x in data:
+		result.setdefault(db_common.fpath_base(x['ekpubhash']), []).append(x)
+	return result
+
+def hn2ek_sorted(entries):
+	return sorted(entries, key = lambda x: (x['hostname'], x['ekpubhash']))
+
+# Phase 1, no lock. Work out which entries need attention. Returns the
+# snapshot, the commit it was compared with (if any), the number of entries
+# scanned, the paths that need fixing, and whether hn2ek needs rewriting.
+def scan(mode):
+	snap = db_common.snapshot()
+	since = None
+	if mode == 'incremental':
+		since = state_read()
+		if since and not snap.repo.has_object(since):
+			log(f"db_janitor: previous commit {since} is gone")
+			since = None
+		if not since:
+			mode = 'full'
+	log(f"db_janitor: commit={snap.commit}, since={since}")
+
+	hn2ek = snap.hn2ek()
+	bybase = hn2ek_bybase(hn2ek)
+	if since:
+		candidates = snap.changed(since)
+	else:
+		candidates = snap.entries('')
+	scanned = 0
+	todo = []
+	present = set()
+	for path, files in candidates:
+		scanned += 1
+		base = os.path.basename(path)
+		if files is None:
+			# Deleted, so it shouldn't be in hn2ek
+			if base in bybase:
+				todo.append(path)
+			continue
+		present.add(base)
+		try:
+			# The manifest mirrors the files, so one read does,
+			# if the entry has one. (If not, 'db_manifest.py
+			# backfill'.)
+			m = db_manifest.read_snapshot(snap, files)
+			if m:
+				ekpubhash = m['ekpubhash']
+				hostname = m['hostname']
+			else:
+				ekpubhash = snap.read_blob(
+					files['ekpubhash'][1]).decode()
+				hostname = snap.read_blob(
+					files['hostname'][1]).decode()
+		except KeyError as e:
+			log(f"db_janitor: {path} is missing {e}")
+			todo.append(path)
+			continue
+		want = [ { 'hostname': scrub(hostname),
+			'ekpubhash': scrub(ekpubhash) } ]
+		if scrub(ekpubhash) != ekpubhash or \
+				scrub(hostname) != hostname or \
+				hn2ek_sorted(bybase.get(base, [])) != want:
+			todo.append(path)
+	rebuild_rev = False
+	if mode == 'full':
+		for base in bybase:
+			if base not in present:
+				todo.append(db_common.fpath_rel(
+					bybase[base][0]['ekpubhash']))
+		rev = snap.hn2ek_rev()
+		data = db_common.hn2ek_sort(list(hn2ek))
+		rebuild_rev = hn2ek != data or \
+			rev != db_common.hn2ek_rev_build(data)
+	log(f"db_janitor: scanned={scanned}, todo={len(todo)}, "
+		f"rebuild_rev={rebuild_rev}")
+	return snap, since, scanned, todo, rebuild_rev
+
+# Phase 2, a chunk at a time under the lock. Entries are re-read from the
+# working tree (which, with the lock held, is HEAD), in case they've changed
+# since the snapshot.
+def fix_chunk(paths, rewrite):
+	fixed = 0
+	changes = []
+	data = db_common.hn2ek_read()
+	bybase = hn2ek_bybase(data)
+	bases = set()
+	wants = []
+	for rel in paths:
+		log(f"db_janitor: fixing {rel}")
+		path = f"{db_common.repo_path}/{rel}"
+		base = os.path.basename(rel)
+		bases.add(base)
+		want = []
+		altered = False
+		if os.path.isdir(path):
+			ekpubhash, hostname, altered = scrub_entry(path)
+			if altered:
+				# The manifest has to follow the files
+				db_manifest.write(path)
+				changes += [ f"{path}/ekpubhash", f"{path}/hostname",
+					f"{path}/{db_manifest.manifest_basename}" ]
+			want = [ { 'hostname': hostname, 'ekpubhash': ekpubhash } ]
+		if hn2ek_sorted(bybase.get(base, [])) != want:
+			rewrite = True
+			altered = True
+		if altered:
+			fixed += 1
+		wants += want
+	if rewrite:
+		data = [ x for x in data
+			if db_common.fpath_base(x['ekpubhash']) not in bases ]
+		db_common.hn2ek_write(data + wants)
+		changes += [ db_common.hn2ek_path, db_common.hn2ek_rev_path ]
+	if changes:
+		git_commit("Janitor", changes)
+	return fixed
+
+# Critical section(s), same basic idea as in db_add.py
+def janitor_shard(mode):
+	log(f"db_janitor: starting in {db_common.repo_path}, mode={mode}")
+	# Change working directory to the git repo
+	os.chdir(db_common.repo_path)
+	snap, since, scanned, todo, rebuild_rev = scan(mode)
+	fixed = 0
+	chunks = [ todo[i:i + chunk] for i in range(0, len(todo), chunk) ]
+	if rebuild_rev and not chunks:
+		chunks = [ [] ]
+	for paths in chunks:
+		db_common.repo_lock()
+		caught = None
+		try:
+			fixed += fix_chunk(paths, rebuild_rev)
+			rebuild_rev = False
+		except Exception as e:
+			caught = e
+			log(f"db_janitor: failed enrollment DB update: {caught}")
+			# recover the git repo before we release the lock
+			try:
+				git_reset()
+			except Exception as e:
+				log(f"db_janitor: failed to recover!: {e}")
+				bail(f"CATASTROPHIC! DB stays locked for manual "
+					"intervention")
+			log(f"db_janitor: enrollment DB rollback complete")
+
+		# Remove the lock, then reraise any exception we intercepted
+		db_common.repo_unlock()
+		if caught:
+			log(f"db_janitor: enrollment DB exception continuation: "
+				f"{caught}")
+			raise caught
+
+	# Next time, pick up from what this run looked at. (Our own commits, and
+	# anything else that's happened since the snapshot, get looked at then.)
+	state_write(snap.commit)
+
+	return {
+		'mode': 'full' if not since else 'incremental',
+		'since': since,
+		'commit': snap.commit,
+		'scanned': scanned,
+		'fixed': fixed
+	}
+
+results = {}
+for shard in db_common.shard_names:
+	db_common.select_shard(shard)
+	results[shard] = janitor_shard(mode)
+if db_common.shards == 1:
+	output = results[None]
+else:
+	output = {
+		'mode': mode,
+		'scanned': sum(x['scanned'] for x in results.values()),
+		'fixed': sum(x['fixed'] for x in results.values()),
+		'shards': results
+	}
+result = json.dumps(output, sort_keys = True)
 log(f"db_janitor: emitting result={result}")
 print(result)
 sys.exit(http2exit(200))
@@ -0,0 +1,536 @@
+import os
+import sys
+import json
+import time
+import glob
+import re
+import fcntl
+import errno
+import select
+import shutil
+import base64
+import subprocess
+from uuid import uuid4
+
+sys.path.insert(1, '/hcp/common')
+from hcp_common import log, bail, http2exit, exit2http
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_common
+
+# IMPORTANT: when run as a command (by mgmt_sudo.sh), this file must send any
+# miscellaneous output to stderr _only_. The stdout and exit code of the job
+# are passed through to the web-app, exactly as if it had run db_add.py
+# itself.
+
+# Enrollment job queue. Generating an enrollment (attest-enroll and the
+# genprogs it runs) is CPU-bound and takes a while, and used to be run by
+# whichever uwsgi worker received the request, so the number of enrollments in
+# flight was capped by the webapi's processes*threads. Instead, requests are
+# queued here and run by the 'enroll_worker' service (enroll_worker.py), which
+# runs as many at once as it is configured to. The resulting commits still get
+# serialized (and batched) by db_commit.py.
+#
+# Queue layout, under {db_dir}/jobq/;
+#   worker.lock           flock()d by the worker for as long as it runs
+#   wakeup                FIFO, submitters poke it when a job is queued
+#   gc                    touched whenever gc() runs, see gc_maybe()
+#   .tmp-<uuid>/          being populated, ignored by everyone else
+#   .done-<id>/           result collected (or expired), being removed
+#   <id>/                 a job, where <id> is <time_ns>-<uuid> so that jobs
+#                         sort in arrival order
+#     request.json        { 'op', 'args', 'async', 'submitted' }
+#     ekpub               for 'add', a copy of the uploaded ekpub
+#     manifest.json       for 'add_bulk', the db_add.py manifest, whose
+#                         entries' ekpubs are ...
+#     ekpub-<i>           ... copies of the uploaded ekpubs
+#     notify              FIFO, the runner pokes it when the job is done
+#     running             flock()d by whoever is running the job
+#     result.json         { 'exitcode', 'stdout', 'finished' }
+#
+# A job is claimed by taking the flock on its 'running' file (which is never
+# removed), so if a runner dies its claim goes with it, and the job gets run
+# again by whoever claims it next. If the worker isn't running at all (eg. it
+# isn't configured as a service), submitters run their jobs themselves (or
+# start a process to run them, if they're asynchronous, see spawn()).
+#
+# Jobs can also be submitted asynchronously, in which case the submitter
+# returns the job id straight away and the job (and its result) stays in the
+# queue until it is polled for (see 'job' in the usage at the bottom) and
+# expires. As the queue is on disk, so are the results, so a restart of the
+# webapi (or the worker) doesn't lose them.
+#
+# Config: '.enrollsvc.workers' is the number of jobs the worker runs in
+# parallel (default: the number of CPUs), and '.enrollsvc.job_retention' is
+# how long (in seconds) finished jobs are kept (default: a day).
+
+jobq_dir = f"{db_common.db_dir}/jobq"
+worker_lockpath = f"{jobq_dir}/worker.lock"
+wakeup_path = f"{jobq_dir}/wakeup"
+
+num_workers = os.cpu_count() or 1
+if 'workers' in db_common.enrollsvc_ctx:
+	num_workers = int(db_common.enrollsvc_ctx['workers'])
+
+job_retention = 86400
+if 'job_retention' in db_common.enrollsvc_ctx:
+	job_retention = int(db_common.enrollsvc_ctx['job_retention'])
+
+# How often a waiting submitter checks that there's still a worker
+poll_secs = 5
+
+# The longest a poller can wait (long-poll) for a job
+max_wait = 60
+
+# How often submitters and pollers expire old jobs, see gc_maybe()
+gc_secs = 300
+
+valid_jobid_prog = re.compile('[0-9]{20}-[0-9a-f]{32}')
+
+ops = {
+	'add': 3,
+	'reenroll': 1,
+	'add_bulk': 0
+}
+
+class HcpJobError(Exception):
+	pass
+
+def __write_json(path, data):
+	with open(f"{path}.tmp", 'w') as f:
+		json.dump(data, f, sort_keys = True)
+	os.rename(f"{path}.tmp", path)
+
+def __read_json(path):
+	with open(path, 'r') as f:
+		return json.load(f)
+
+def __mkfifo(path):
+	try:
+		os.mkfifo(path, 0o600)
+	except FileExistsError:
+		pass
+
+# Writes a byte to a FIFO, if anyone is listening. Never blocks.
+def __poke(path):
+	try:
+		fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+	except OSError as e:
+		if e.errno in (errno.ENXIO, errno.ENOENT):
+			return
+		raise
+	try:
+		os.write(fd, b'.')
+	except BlockingIOError:
+		pass
+	finally:
+		os.close(fd)
+
+def __locked(path):
+	try:
+		fd = os.open(path, os.O_RDONLY)
+	except FileNotFoundError:
+		return False
+	try:
+		fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+		return False
+	except BlockingIOError:
+		return True
+	finally:
+		os.close(fd)
+
+def init():
+	os.makedirs(jobq_dir, exist_ok = True)
+	__mkfifo(wakeup_path)
+
+def worker_alive():
+	return __locked(worker_lockpath)
+
+# Called by the worker on startup. Returns the fd that keeps the lock, or
+# raises if there's another worker already.
+def worker_lock():
+	init()
+	fd = os.open(worker_lockpath, os.O_RDWR | os.O_CREAT, 0o644)
+	try:
+		fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except BlockingIOError:
+		os.close(fd)
+		raise HcpJobError(f"another worker holds {worker_lockpath}")
+	os.ftruncate(fd, 0)
+	os.pwrite(fd, f"{os.getpid()}\n".encode(), 0)
+	return fd
+
+# Opens the worker's end of the wakeup FIFO. O_RDWR so that it never sees EOF
+# and never blocks on open.
+def wakeup_open():
+	init()
+	return os.open(wakeup_path, os.O_RDWR | os.O_NONBLOCK)
+
+def wakeup_drain(fd):
+	try:
+		while os.read(fd, 4096):
+			pass
+	except BlockingIOError:
+		pass
+
+def path(jobid):
+	return f"{jobq_dir}/{jobid}"
+
+# Returns the ids of queued jobs that have no result and that nobody is
+# running, in arrival order.
+def pending():
+	result = []
+	for p in sorted(glob.glob(f"{jobq_dir}/[0-9]*")):
+		if os.path.exists(f"{p}/result.json"):
+			continue
+		if __locked(f"{p}/running"):
+			continue
+		result.append(os.path.basename(p))
+	return result
+
+# Queues a job and returns its id. 'args' are the db_add.py arguments that
+# follow 'op'. For 'add', the first of these is the path to the ekpub, which
+# gets copied into the job (so the caller's copy needn't outlive this call),
+# or "-" to read the ekpub from stdin. For 'add_bulk', there are no args, the
+# entries are read from stdin (see the usage at the bottom).
+def submit(op, args, _async = False):
+	if op not in ops or len(args) != ops[op]:
+		raise HcpJobError(f"bad job: {op} {args}")
+	init()
+	uuid = uuid4().hex
+	tmp = f"{jobq_dir}/.tmp-{uuid}"
+	os.mkdir(tmp)
+	try:
+		args = list(args)
+		if op == 'add' and args[0] == '-':
+			with open(f"{tmp}/ekpub", 'wb') as f:
+				shutil.copyfileobj(sys.stdin.buffer, f)
+			args[0] = None
+		elif op == 'add':
+			shutil.copyfile(args[0], f"{tmp}/ekpub")
+			args[0] = None
+		elif op == 'add_bulk':
+			__write_manifest(tmp, sys.stdin.read())
+		__write_json(f"{tmp}/request.json", {
+			'op': op,
+			'args': args,
+			'async': _async,
+			'submitted': time.time()
+		})
+		__mkfifo(f"{tmp}/notify")
+		jobid = f"{time.time_ns():020d}-{uuid}"
+		os.rename(tmp, path(jobid))
+	except Exception:
+		shutil.rmtree(tmp, ignore_errors = True)
+		raise
+	log(f"db_jobs: queued {jobid} ({op})")
+	__poke(wakeup_path)
+	gc_maybe()
+	return jobid
+
+# Writes the db_add.py manifest for an 'add_bulk' job, from the JSON list of
+# { 'ekpub', 'hostname', 'profile' } dicts that the web API sends, where
+# 'ekpub' is base64. The ekpubs become files in the job, which the manifest
+# refers to (relative to the job).
+def __write_manifest(jobdir, data):
+	try:
+		entries = json.loads(data)
+	except json.JSONDecodeError as e:
+		raise HcpJobError(f"add_bulk: bad JSON: {e}")
+	if not isinstance(entries, list):
+		raise HcpJobError("add_bulk: entries must be a list")
+	manifest = []
+	for i, entry in enumerate(entries):
+		if not isinstance(entry, dict) or \
+				not all(isinstance(entry.get(x), str) for x in
+					[ 'ekpub', 'hostname', 'profile' ]):
+			raise HcpJobError(f"add_bulk: entry {i} is malformed")
+		try:
+			ekpub = base64.b64decode(entry['ekpub'], validate = True)
+		except ValueError:
+			raise HcpJobError(f"add_bulk: entry {i} ekpub isn't base64")
+		with open(f"{jobdir}/ekpub-{i}", 'wb') as f:
+			f.write(ekpub)
+		manifest.append({
+			'ekpub': f"ekpub-{i}",
+			'hostname': entry['hostname'],
+			'profile': entry['profile']
+		})
+	__write_json(f"{jobdir}/manifest.json", manifest)
+
+# Claims and runs a job, if nobody else has it. Returns False if the job was
+# already running or finished. Called from the worker's threads, and by
+# submitters when there's no worker. The job is a db_add.py process, unless
+# 'runner' is given, in which case runner(op, args) runs it (in-process) and
+# returns what the process would have, ie. (exitcode, stdout).
+def run(jobid, runner = None):
+	jobdir = path(jobid)
+	try:
+		fd = os.open(f"{jobdir}/running", os.O_RDWR | os.O_CREAT, 0o644)
+	except FileNotFoundError:
+		# Collected and removed since it was listed
+		return False
+	try:
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			return False
+		if os.path.exists(f"{jobdir}/result.json"):
+			return False
+		os.ftruncate(fd, 0)
+		os.pwrite(fd, json.dumps({ 'pid': os.getpid(),
+				'started': time.time() }).encode(), 0)
+		req = __read_json(f"{jobdir}/request.json")
+		args = req['args']
+		if req['op'] == 'add':
+			args[0] = f"{jobdir}/ekpub"
+		elif req['op'] == 'add_bulk':
+			args = [ f"{jobdir}/manifest.json" ]
+		log(f"db_jobs: running {jobid} ({req['op']})")
+		if runner:
+			# As though the process had crashed
+			try:
+				exitcode, stdout = runner(req['op'], args)
+			except Exception as e:
+				log(f"db_jobs: {jobid} raised {type(e).__name__}: {e}")
+				exitcode, stdout = 1, ''
+			stderr = None
+		else:
+			c = subprocess.run(
+				[ 'python3', '/hcp/enrollsvc/db_add.py',
+					req['op'] ] + args,
+				stdout = subprocess.PIPE,
+				stderr = subprocess.PIPE,
+				text = True)
+			exitcode, stdout, stderr = c.returncode, c.stdout, c.stderr
+		httpcode = exit2http(exitcode)
+		if httpcode < 200 or httpcode >= 300:
+			log(f"db_jobs: {jobid} failed, exitcode={exitcode}")
+			if stderr is not None:
+				log(f" - stderr: {stderr}")
+		__write_json(f"{jobdir}/result.json", {
+			'exitcode': exitcode,
+			'stdout': stdout,
+			'finished': time.time()
+		})
+	finally:
+		os.close(fd)
+	__poke(f"{jobdir}/notify")
+	return True
+
+# Starts a process that runs the job (see 'run' in the usage at the bottom)
+# and outlives us. For asynchronous submitters when there's no worker, which
+# can't run the job themselves without holding up the response.
+def spawn(jobid):
+	log(f"db_jobs: no worker, starting a runner for {jobid}")
+	subprocess.Popen([ 'python3', '/hcp/enrollsvc/db_jobs.py', 'run', jobid ],
+		stdin = subprocess.DEVNULL,
+		stdout = subprocess.DEVNULL,
+		stderr = subprocess.DEVNULL,
+		start_new_session = True)
+
+# Returns the job's result, or None if it hasn't finished. Raises
+# FileNotFoundError for unknown jobs.
+def result(jobid):
+	jobdir = path(jobid)
+	if not os.path.isdir(jobdir):
+		raise FileNotFoundError(jobid)
+	try:
+		return __read_json(f"{jobdir}/result.json")
+	except FileNotFoundError:
+		return None
+
+# Blocks until the job is done, and returns its result, or returns None if
+# 'timeout' (seconds) is given and expires first. If the worker goes away while
+# we wait, we run the job ourselves.
+def wait(jobid, timeout = None):
+	jobdir = path(jobid)
+	deadline = None
+	if timeout is not None:
+		deadline = time.monotonic() + timeout
+	fd = os.open(f"{jobdir}/notify", os.O_RDONLY | os.O_NONBLOCK)
+	try:
+		while True:
+			r = result(jobid)
+			if r is not None:
+				return r
+			if not worker_alive():
+				log(f"db_jobs: no worker, running {jobid} inline")
+				if run(jobid):
+					continue
+			secs = poll_secs
+			if deadline is not None:
+				secs = min(secs, deadline - time.monotonic())
+				if secs <= 0:
+					return None
+			readable, _, _ = select.select([ fd ], [], [], secs)
+			if readable:
+				try:
+					os.read(fd, 4096)
+				except BlockingIOError:
+					pass
+	finally:
+		os.close(fd)
+
+# Returns what the web API reports about a job (see 'job' in the usage
+# below). Raises FileNotFoundError for unknown jobs.
+def status(jobid, r = None):
+	jobdir = path(jobid)
+	req = __read_json(f"{jobdir}/request.json")
+	if r is None:
+		r = result(jobid)
+	data = {
+		'id': jobid,
+		'op': req['op'],
+		'submitted': req['submitted']
+	}
+	if r is None:
+		if __locked(f"{jobdir}/running"):
+			data['state'] = 'running'
+		else:
+			data['state'] = 'queued'
+		return data
+	data['state'] = 'done'
+	data['finished'] = r['finished']
+	data['http_status'] = exit2http(r['exitcode'])
+	data['result'] = None
+	if data['http_status'] >= 200 and data['http_status'] < 300:
+		try:
+			data['result'] = json.loads(r['stdout'])
+		except json.JSONDecodeError:
+			log(f"db_jobs: {jobid} produced bad JSON")
+			data['http_status'] = 500
+	return data
+
+def remove(jobid):
+	done = f"{jobq_dir}/.done-{jobid}"
+	try:
+		os.rename(path(jobid), done)
+	except FileNotFoundError:
+		return
+	shutil.rmtree(done, ignore_errors = True)
+
+# Removes jobs whose results are older than 'job_retention'. Synchronous
+# submitters remove their own jobs, so this is mostly for asynchronous ones
+# (whose results wait here to be polled), and for anything left behind by
+# processes that died. Called periodically by the worker, and by gc_maybe().
+def gc():
+	now = time.time()
+	for p in glob.glob(f"{jobq_dir}/[0-9]*/result.json"):
+		try:
+			age = now - os.path.getmtime(p)
+		except FileNotFoundError:
+			continue
+		if age > job_retention:
+			jobid = os.path.basename(os.path.dirname(p))
+			log(f"db_jobs: expiring {jobid}")
+			remove(jobid)
+	for p in glob.glob(f"{jobq_dir}/.tmp-*") + \
+			glob.glob(f"{jobq_dir}/.done-*"):
+		try:
+			age = now - os.path.getmtime(p)
+		except FileNotFoundError:
+			continue
+		if age > job_retention:
+			log(f"db_jobs: removing leftover {p}")
+			shutil.rmtree(p, ignore_errors = True)
+
+# Runs gc() if it hasn't run in the last 'gc_secs', so that old jobs expire
+# even if there's no worker (whose periodic gc() we'd otherwise rely on).
+# Called by submitters and pollers, whose requests don't fail if it does.
+def gc_maybe():
+	stamp = f"{jobq_dir}/gc"
+	try:
+		if time.time() - os.path.getmtime(stamp) < gc_secs:
+			return
+	except FileNotFoundError:
+		pass
+	try:
+		init()
+		open(stamp, 'a').close()
+		os.utime(stamp)
+		gc()
+	except Exception as e:
+		log(f"db_jobs: gc failed: {e}")
+
+# Usage (via mgmt_sudo.sh): either the same as db_add.py, ie.
+#     db_jobs.py add <path-to-ekpub> <hostname> <clientjson>
+#     db_jobs.py reenroll <clientjson>
+#     db_jobs.py add_bulk
+# in which case the job is queued for the worker, and this waits for it and
+# then relays its output and exit code, or
+#     db_jobs.py add_async <path-to-ekpub> <hostname> <clientjson>
+#     db_jobs.py reenroll_async <clientjson>
+#     db_jobs.py add_bulk_async
+# in which case the job is queued and this returns its status (with http 202)
+# straight away. (In the 'add' cases, <path-to-ekpub> can be "-", meaning the
+# ekpub is on stdin, which is how the web API passes it so that it needn't be
+# written anywhere that both users can read. For the same reason, 'add_bulk'
+# reads its entries from stdin, as a JSON list of { 'ekpub', 'hostname',
+# 'profile' } dicts, 'ekpub' being the ekpub in base64 and 'profile' being the
+# clientjson.) Or
+#     db_jobs.py job <id> <wait>
+# which returns the job's status, waiting up to <wait> seconds for it to finish
+# first. The status is a JSON dict with 'id', 'op', 'submitted', and 'state'
+# ('queued', 'running', or 'done'). Once done, it also has 'finished',
+# 'http_status' (what the synchronous request would have returned), and
+# 'result' (the JSON the synchronous request would have returned, if it
+# succeeded). Lastly,
+#     db_jobs.py run <id>
+# runs a queued job, see spawn().
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		bail("db_jobs: no command")
+	cmd = sys.argv[1]
+	args = sys.argv[2:]
+	if cmd == 'job':
+		if len(args) != 2:
+			bail(f"db_jobs: wrong number of arguments: {len(sys.argv)}")
+		jobid = args[0]
+		if not valid_jobid_prog.fullmatch(jobid):
+			log(f"db_jobs: invalid job id: {jobid}")
+			sys.exit(http2exit(400))
+		try:
+			timeout = min(float(args[1]), max_wait)
+		except ValueError:
+			log(f"db_jobs: invalid wait: {args[1]}")
+			sys.exit(http2exit(400))
+		gc_maybe()
+		try:
+			r = wait(jobid, timeout) if timeout > 0 else result(jobid)
+			data = status(jobid, r)
+		except FileNotFoundError:
+			log(f"db_jobs: unknown job: {jobid}")
+			sys.exit(http2exit(404))
+		print(json.dumps(data, sort_keys = True))
+		sys.exit(http2exit(200))
+	if cmd == 'run':
+		if len(args) != 1 or not valid_jobid_prog.fullmatch(args[0]):
+			bail(f"db_jobs: bad run arguments: {args}")
+		run(args[0])
+		sys.exit(0)
+	_async = cmd.endswith('_async')
+	op = cmd[:-len('_async')] if _async else cmd
+	if op not in ops:
+		bail("First argument must be 'add', 'reenroll', or 'add_bulk' (or _async)")
+	if len(args) != ops[op]:
+		bail(f"db_jobs: wrong number of arguments: {len(sys.argv)}")
+	try:
+		jobid = submit(op, args, _async = _async)
+	except HcpJobError as e:
+		log(f"{e}")
+		sys.exit(http2exit(400))
+	if _async:
+		if not worker_alive():
+			# Nobody else will run it
+			spawn(jobid)
+		print(json.dumps(status(jobid), sort_keys = True))
+		sys.exit(http2exit(202))
+	try:
+		r = wait(jobid)
+	finally:
+		remove(jobid)
+	log(f"db_jobs: {jobid} finished, exitcode={r['exitcode']}")
+	sys.stdout.write(r['stdout'])
+	sys.stdout.flush()
+	sys.exit(r['exitcode'])
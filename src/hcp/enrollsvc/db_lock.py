@@ -0,0 +1,88 @@
+import sys
+import os
+import json
+
+sys.path.insert(1, '/hcp/common')
+import hcp_common
+log = hcp_common.log
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_common
+bail = db_common.bail
+
+sys.path.insert(1, '/hcp/xtra')
+import HcpFairLock
+
+# Operator tool for the enrollment DB's writer lock (see repo_lock() in
+# db_common.py). Run it as the DB user, eg.
+#   su -c "python3 /hcp/enrollsvc/db_lock.py status" - emgmtdb
+#
+# Usage:
+# db_lock.py status
+#     Prints the lock queue (the holder, if any, and the waiters, each with
+#     pid and timestamps, and whether the process is still alive) and the
+#     accumulated wait/hold-time statistics.
+# db_lock.py break
+#     Recovers from a dead holder. If the queue has nobody alive in it, this
+#     takes and releases the lock, which rolls back whatever the dead holder
+#     left in the working tree and clears its entry. It also removes leftover
+#     temp files, and the old-style lock directory if one is lying around
+#     from before an upgrade. A live holder is never broken - if it's hung,
+#     kill it first (its lock goes with it).
+
+#
+# If the DB is sharded, each shard has its own lock. An optional third
+# argument names the shard (eg. "3f"), otherwise every shard is done, and the
+# output is keyed by shard.
+
+if len(sys.argv) not in [ 2, 3 ] or sys.argv[1] not in [ 'status', 'break' ]:
+	bail(f"Usage: db_lock.py <status|break> [shard]")
+cmd = sys.argv[1]
+shards = db_common.shard_names
+if len(sys.argv) == 3:
+	if sys.argv[2] not in shards:
+		bail(f"Unknown shard: {sys.argv[2]}")
+	shards = [ sys.argv[2] ]
+
+def status():
+	lock = HcpFairLock.FairLock(db_common.repo_lockdir)
+	return {
+		'lockdir': db_common.repo_lockdir,
+		'queue': lock.status(),
+		'stats': lock.stats(),
+		'legacy_lock': os.path.isdir(db_common.repo_lockdir_legacy)
+	}
+
+# Returns the result, and whether the break went ahead
+def lockbreak():
+	lock = HcpFairLock.FairLock(db_common.repo_lockdir)
+	queue = lock.status()
+	live = [ x for x in queue if x['alive'] ]
+	if live:
+		return { 'broken': False, 'live': live }, False
+	result = { 'broken': True, 'stale': queue }
+	if queue:
+		os.chdir(db_common.repo_path)
+		db_common.repo_lock()
+		db_common.repo_unlock()
+	result['tmpfiles'] = lock.cleanup()
+	if os.path.isdir(db_common.repo_lockdir_legacy):
+		log(f"db_lock: removing legacy lock {db_common.repo_lockdir_legacy}")
+		os.rmdir(db_common.repo_lockdir_legacy)
+		result['legacy_lock'] = db_common.repo_lockdir_legacy
+	return result, True
+
+results = {}
+ok = True
+for shard in shards:
+	db_common.select_shard(shard)
+	if cmd == 'status':
+		results[shard] = status()
+	else:
+		results[shard], x = lockbreak()
+		ok = ok and x
+if shards == [ None ]:
+	results = results[None]
+print(json.dumps(results, indent = 4, sort_keys = True))
+if not ok:
+	bail(f"Lock queue has live processes, refusing to break")
@@ -0,0 +1,227 @@
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+sys.path.insert(1, '/hcp/common')
+from hcp_common import log, hcp_config_extract, dict_timedelta
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_common
+bail = db_common.bail
+
+sys.path.insert(1, '/hcp/xtra')
+import HcpGitRepo
+
+# Every add, delete, reenroll, and janitor run is a commit, and reenrollment
+# churns the assets of every enrollment periodically, so the history (and the
+# objects it holds on to) grows without bound. That slows down clones and
+# fetches by the replicas (attestsvc), and everything that has to look through
+# the loose objects and packs. This is the housekeeping for that, run
+# periodically by maint.sh;
+#
+# - 'checkpoint' (optional, off by default). If '.maint.checkpoint' is set (a
+#   period, in dict_timedelta() form, eg. { "days": 90 }), history older than
+#   that gets squashed. Every squash rewrites the whole history, which each
+#   replica then has to fetch afresh, so it is only done once the oldest
+#   commit is older than the window by '.maint.checkpoint_margin' (the same
+#   form, default { "days": 30 }), ie. roughly once per margin rather than on
+#   every pass. The newest commit older than the window is replaced by a
+#   parentless "checkpoint" commit with the same tree, and the commits since
+#   then are replayed on top of it (same trees, authors, dates, and messages).
+#   The replaying is done without the repo lock, and then (with the lock) any
+#   commits that landed in the meantime are replayed too, and HEAD is moved.
+#   The trees don't change, so neither do the working tree and index, nor
+#   anything reading a snapshot. Replicas see a non-fast-forward update and
+#   follow it (updater_loop.sh resets to what it fetched, rather than merging).
+#
+# - 'repack'. Expires reflog entries for unreachable commits (so squashed
+#   history can actually go), repacks everything into one pack with a bitmap
+#   index (which is what makes serving clones and fetches cheap), and prunes
+#   unreachable objects. Both expiries use '.maint.expire' (default
+#   "2.weeks.ago", like git's own gc), so objects written by a transaction that
+#   hasn't moved HEAD yet aren't pruned out from under it. This doesn't need
+#   the lock, git and HcpGitRepo both cope with packs being replaced.
+#
+# The effect is measured before and after: commit count, loose objects and
+# packs (from 'git count-objects'), the time and size of a full clone (ie.
+# what a new replica fetches), and the time of a 'git status' (how long git
+# takes to check the working tree against the index, which commits that don't
+# list their paths pay, as do operators). That runs without the lock, so it
+# uses --no-optional-locks, which stops it taking index.lock to refresh the
+# index (where it would get in the way of commits). The clone is skipped if
+# '.maint.measure' is false. If the DB is sharded, each shard is done in turn,
+# and the output has the per-shard results in 'shards'.
+
+checkpoint = hcp_config_extract('.maint.checkpoint', or_default = True)
+if checkpoint:
+	checkpoint = dict_timedelta(checkpoint)
+checkpoint_margin = dict_timedelta(hcp_config_extract(
+				'.maint.checkpoint_margin', or_default = True,
+				default = { 'days': 30 }))
+expire = hcp_config_extract('.maint.expire', or_default = True,
+				default = '2.weeks.ago')
+measure_clone = hcp_config_extract('.maint.measure', or_default = True,
+				default = True)
+
+if len(sys.argv) != 1:
+	bail(f"Wrong number of arguments: {len(sys.argv)}")
+
+def git(args):
+	args = [ 'git' ] + args
+	expanded = ' '.join(args)
+	log(f"db_maint: running '{expanded}'")
+	c = subprocess.run(args, stdout = subprocess.PIPE, text = True)
+	if c.returncode != 0:
+		raise db_common.HcpGitError(f"Failed: {expanded}")
+	return c.stdout
+
+def timed(fn, *args):
+	t = time.monotonic()
+	fn(*args)
+	return round(time.monotonic() - t, 3)
+
+def du_kib(path):
+	total = 0
+	for root, dirs, files in os.walk(path):
+		for name in files:
+			total += os.lstat(os.path.join(root, name)).st_size
+	return total // 1024
+
+def measure():
+	stats = {}
+	for line in git([ 'count-objects', '-v' ]).splitlines():
+		k, _, v = line.partition(': ')
+		stats[k] = v
+	result = {
+		'commits': int(git([ 'rev-list', '--count', 'HEAD' ])),
+		'loose': int(stats['count']),
+		'loose_kib': int(stats['size']),
+		'packs': int(stats['packs']),
+		'pack_kib': int(stats['size-pack']),
+		'status_seconds': timed(git, [ '--no-optional-locks', 'status',
+						'--porcelain' ])
+	}
+	if measure_clone:
+		tmp = tempfile.mkdtemp(dir = db_common.db_dir,
+					prefix = 'maint-clone-')
+		try:
+			result['clone_seconds'] = timed(git, [ 'clone', '-q',
+				'--bare', '--no-local', db_common.repo_path,
+				f"{tmp}/clone" ])
+			result['clone_kib'] = du_kib(f"{tmp}/clone")
+		finally:
+			shutil.rmtree(tmp)
+	return result
+
+# The committer time of a commit, from its 'committer' line, which ends with
+# "<seconds> <tz>".
+def committed(commit):
+	return int(commit['committer'].rsplit(' ', 2)[1])
+
+# Writes a copy of 'sha' with 'parent' as its (only) parent, and returns it
+def reparent(repo, sha, parent):
+	data = repo.read_typed(sha, 'commit')
+	header, sep, message = data.partition(b'\n\n')
+	lines = [ x for x in header.split(b'\n')
+		if not x.startswith(b'parent ') ]
+	lines.insert(1, f"parent {parent}".encode())
+	return repo.write_object('commit', b'\n'.join(lines) + sep + message)
+
+# The commits from 'head' back to (but not including) 'stop', newest first.
+# Only follows linear history, which is all we ever write.
+def walk(repo, head, stop):
+	result = []
+	sha = head
+	while sha != stop:
+		c = repo.read_commit(sha)
+		if len(c['parents']) != 1:
+			raise db_common.HcpGitError(
+				f"{stop} isn't a linear ancestor of {head}")
+		result.append(sha)
+		sha = c['parents'][0]
+	return result
+
+# Squashes history older than 'cutoff', if the oldest commit is older than
+# 'due' (a time before 'cutoff').
+def squash(cutoff, due):
+	repo = HcpGitRepo.GitRepo(db_common.repo_path)
+	head = repo.read_ref('HEAD')
+	keep = []
+	sha = head
+	while True:
+		c = repo.read_commit(sha)
+		if len(c['parents']) > 1:
+			log(f"db_maint: {sha} is a merge, not squashing")
+			return None
+		if committed(c) < cutoff:
+			break
+		if not c['parents']:
+			break
+		keep.append(sha)
+		sha = c['parents'][0]
+	if not c['parents']:
+		# Nothing older than the window, other than (perhaps) the root,
+		# which is what a previous checkpoint looks like.
+		log(f"db_maint: nothing to squash")
+		return None
+	root = c
+	while root['parents']:
+		root = repo.read_commit(root['parents'][0])
+	if committed(root) >= due:
+		log(f"db_maint: oldest commit is within the margin, not squashing")
+		return None
+	when = datetime.fromtimestamp(committed(c), timezone.utc)
+	new = repo.write_commit(c['tree'], [], "Checkpoint\n\n"
+		f"History up to {sha} ({when:%Y-%m-%d %H:%M:%S} UTC) squashed "
+		"by db_maint.py")
+	for x in reversed(keep):
+		new = reparent(repo, x, new)
+	log(f"db_maint: replayed {len(keep)} commits onto the checkpoint")
+
+	db_common.repo_lock()
+	try:
+		current = repo.read_ref('HEAD')
+		extra = walk(repo, current, head)
+		for x in reversed(extra):
+			new = reparent(repo, x, new)
+		repo.update_ref('HEAD', new, current,
+			f"checkpoint: squashed history up to {sha}")
+	finally:
+		db_common.repo_unlock()
+	return { 'base': sha, 'kept': len(keep) + len(extra) }
+
+def repack():
+	git([ 'reflog', 'expire', '--all', f"--expire-unreachable={expire}" ])
+	git([ 'repack', '-a', '-d', '-q', '--write-bitmap-index' ])
+	git([ 'prune', f"--expire={expire}" ])
+	git([ 'pack-refs', '--all' ])
+
+def maint_shard():
+	log(f"db_maint: starting in {db_common.repo_path}")
+	os.chdir(db_common.repo_path)
+	result = { 'before': measure(), 'checkpoint': None }
+	if checkpoint:
+		cutoff = datetime.now(timezone.utc) - checkpoint
+		due = cutoff - checkpoint_margin
+		result['checkpoint'] = squash(cutoff.timestamp(),
+					due.timestamp())
+	repack()
+	result['after'] = measure()
+	return result
+
+results = {}
+for shard in db_common.shard_names:
+	db_common.select_shard(shard)
+	results[shard] = maint_shard()
+if db_common.shards == 1:
+	output = results[None]
+else:
+	output = { 'shards': results }
+result = json.dumps(output, sort_keys = True)
+log(f"db_maint: emitting result={result}")
+print(result)
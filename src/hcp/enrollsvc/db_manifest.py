@@ -0,0 +1,166 @@
+import sys
+import os
+import json
+import hashlib
+
+sys.path.insert(1, '/hcp/common')
+from hcp_common import log, http2exit
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_common
+bail = db_common.bail
+import db_due
+
+# Each enrollment directory has a '.manifest' file, which summarizes it in one
+# (compact) JSON document;
+#
+#   {
+#     'version': 1,
+#     'ekpubhash': <ekpubhash>,
+#     'hostname': <hostname>,
+#     'profile_sha256': <sha256 of 'clientprofile'>,
+#     'hint': <reenroll hint ("YYYYMMDDhhmmss"), or null>,
+#     'assets': { <name>: { 'size': <bytes>, 'sha256': <hex> }, ... }
+#   }
+#
+# where 'assets' covers every file in the directory other than the manifest
+# itself (names relative to the directory, including 'ekpubhash', 'hostname',
+# and 'clientprofile'). It gets written when the enrollment is committed (see
+# db_commit.spool()), so readers that want the metadata (query, delete, the
+# janitor, the reenroll index) need one read per entry, rather than one per
+# file plus a directory listing. Enrollments that predate manifests don't have
+# one, so readers fall back to the individual files when it's missing, and
+# 'db_manifest.py backfill' (below) adds them.
+#
+# The manifest is a dot-file, so it doesn't show up in the file-lists that
+# 'query' returns.
+
+manifest_basename = '.manifest'
+manifest_version = 1
+
+def sha256(data):
+	return hashlib.sha256(data).hexdigest()
+
+# Builds the manifest for the enrollment directory 'path', from what's in it.
+def build(path):
+	assets = {}
+	for root, dirs, files in os.walk(path):
+		dirs.sort()
+		for name in sorted(files):
+			full = os.path.join(root, name)
+			rel = os.path.relpath(full, path)
+			if rel == manifest_basename:
+				continue
+			with open(full, 'rb') as f:
+				data = f.read()
+			assets[rel] = { 'size': len(data), 'sha256': sha256(data) }
+	def text(name):
+		return open(f"{path}/{name}", 'r').read()
+	profile = None
+	if 'clientprofile' in assets:
+		profile = assets['clientprofile']['sha256']
+	return {
+		'version': manifest_version,
+		'ekpubhash': text('ekpubhash'),
+		'hostname': text('hostname'),
+		'profile_sha256': profile,
+		'hint': db_due.hint_of(assets.keys()),
+		'assets': assets
+	}
+
+def write(path):
+	m = build(path)
+	with open(f"{path}/{manifest_basename}", 'w') as f:
+		json.dump(m, f, sort_keys = True, separators = (',', ':'))
+	return m
+
+def parse(data):
+	m = json.loads(data)
+	if m.get('version') != manifest_version:
+		raise ValueError(f"unknown manifest version: {m.get('version')}")
+	return m
+
+# Reads the manifest of an enrollment in the working tree, or returns None if
+# it doesn't have one.
+def read(path):
+	try:
+		with open(f"{path}/{manifest_basename}", 'r') as f:
+			return parse(f.read())
+	except FileNotFoundError:
+		return None
+
+# The same, for an enrollment in a DbSnapshot, given the 'files' dict that
+# DbSnapshot.entries() yields for it.
+def read_snapshot(snap, files):
+	if manifest_basename not in files:
+		return None
+	return parse(snap.read_blob(files[manifest_basename][1]))
+
+# Usage: db_manifest.py backfill
+#
+# Adds manifests to the enrollments that don't have one (ie. those that were
+# committed before manifests were introduced). As with the janitor, the
+# looking is done on a snapshot, without the repo lock, and the writing is
+# done 'chunk' entries at a time, with the lock held, one commit per chunk.
+# (Shard by shard, if the DB is sharded.)
+chunk = 200
+
+def backfill():
+	result = { 'scanned': 0, 'written': 0 }
+	for shard in db_common.shard_names:
+		db_common.select_shard(shard)
+		x = backfill_shard()
+		result['scanned'] += x['scanned']
+		result['written'] += x['written']
+	return result
+
+def backfill_shard():
+	os.chdir(db_common.repo_path)
+	snap = db_common.snapshot()
+	scanned = 0
+	todo = []
+	for path, files in snap.entries(''):
+		scanned += 1
+		if manifest_basename not in files:
+			todo.append(path)
+	log(f"db_manifest: scanned={scanned}, todo={len(todo)}")
+	written = 0
+	for i in range(0, len(todo), chunk):
+		db_common.repo_lock()
+		caught = None
+		try:
+			changes = []
+			for rel in todo[i:i + chunk]:
+				path = f"{db_common.repo_path}/{rel}"
+				# It may have gone (or gained a manifest) since
+				# the snapshot
+				if not os.path.isdir(path) or \
+						os.path.exists(f"{path}/{manifest_basename}"):
+					continue
+				write(path)
+				changes.append(f"{path}/{manifest_basename}")
+			if changes:
+				db_common.git_commit("Manifest backfill", changes)
+			written += len(changes)
+		except Exception as e:
+			caught = e
+			log(f"db_manifest: failed enrollment DB update: {caught}")
+			# recover the git repo before we release the lock
+			try:
+				db_common.git_reset()
+			except Exception as e:
+				log(f"db_manifest: failed to recover!: {e}")
+				bail(f"CATASTROPHIC! DB stays locked for manual intervention")
+			log(f"db_manifest: enrollment DB rollback complete")
+		db_common.repo_unlock()
+		if caught:
+			raise caught
+	return { 'scanned': scanned, 'written': written }
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2 or sys.argv[1] != 'backfill':
+		bail("Usage: db_manifest.py backfill")
+	result = json.dumps(backfill(), sort_keys = True)
+	log(f"db_manifest: emitting result={result}")
+	print(result)
+	sys.exit(http2exit(200))
@@ -4,6 +4,8 @@ import re
 import json
 import glob
 import shutil
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.insert(1, '/hcp/common')
 import hcp_common
@@ -12,6 +14,7 @@ http2exit = hcp_common.http2exit
 
 sys.path.insert(1, '/hcp/enrollsvc')
 import db_common
+import db_manifest
 git_commit = db_common.git_commit
 git_reset = db_common.git_reset
 bail = db_common.bail
@@ -43,15 +46,11 @@ db_common.valid_ekpubhash_prefix(req_ekpubhash)
 no_files = clientdata['nofiles']
 log(f"db_querydelete: no_files={no_files}")
 
-# Change working directory to the git repo
-os.chdir(db_common.repo_path)
-
-# Get a wildcard pattern for all matching entries
-fpath = db_common.fpath_mask(req_ekpubhash)
-log(f"db_querydelete: fpath={fpath}")
-
-# The array of matches that gets returned to the client (in JSON form)
-entries = []
+# The shards (see db_common.select_shard()) that can have matching entries.
+# Shards are ekpubhash prefixes, so going through them in order produces the
+# entries in the same order as an unsharded DB would.
+shards = db_common.shards_for_prefix(req_ekpubhash)
+log(f"db_querydelete: shards={shards}")
 
 # The query logic doubles up as delete logic, based on an env-var
 is_delete = ('QUERY_PLEASE_ALSO_DELETE' in os.environ)
@@ -61,59 +60,161 @@ else:
 	cmdname = 'query'
 log(f"db_{cmdname}: cmdname={cmdname}")
 
-# Critical section, same basic idea as in db_add.py
-db_common.repo_lock()
-caught = None
-try:
-	matches = glob.glob(fpath)
-	log(f"db_{cmdname}: matches={matches}")
-	for path in matches:
-		log(f"db_{cmdname}: loop start, path={path}")
-		ekpubhash = open(f"{path}/ekpubhash", 'r').read().strip('\n')
-		hostname = open(f"{path}/hostname", 'r').read().strip('\n')
+# Matches are processed 'batch' at a time. Within a batch, the metadata reads
+# (ekpubhash, hostname, and the file-list) are spread across a thread pool, and
+# the resulting entries are written out (see emit()) before moving on to the
+# next batch. So a query over the whole DB (an empty prefix) doesn't build the
+# result in memory, and the client starts receiving it straight away.
+batch = 256
+pool = ThreadPoolExecutor()
+
+def batches(iterable):
+	it = iter(iterable)
+	while True:
+		x = list(islice(it, batch))
+		if not x:
+			return
+		yield x
+
+# The output is { 'entries': [ ... ] }, the same as json.dumps() would produce
+# from the complete list, but written an entry at a time. NB: we could've just
+# encoded the 'entries' list directly to JSON, rather than putting it as the
+# only field inside a dict, but that would involve going back in time (or
+# changing any/all affected client code). Maybe later, if/when we need to
+# change the API for some other reason. The closing brackets are only written
+# once everything has succeeded, so a failure part way through never looks
+# like a (shorter) valid result.
+num_emitted = 0
+def emit(entries):
+	global num_emitted
+	for entry in entries:
+		if num_emitted == 0:
+			sys.stdout.write('{"entries": [')
+		else:
+			sys.stdout.write(', ')
+		sys.stdout.write(json.dumps(entry, sort_keys = True))
+		num_emitted += 1
+	sys.stdout.flush()
+
+def emit_end():
+	if num_emitted == 0:
+		sys.stdout.write('{"entries": [')
+	sys.stdout.write(']}\n')
+	sys.stdout.flush()
+	log(f"db_{cmdname}: emitted {num_emitted} entries")
+
+def query_snapshot():
+	# A query doesn't need the lock, it reads from the most recent commit
+	# rather than the working tree. See db_common.DbSnapshot.
+	snap = db_common.snapshot()
+	def read_entry(x):
+		path, files = x
+		# One read if the entry has a manifest, otherwise two
+		m = db_manifest.read_snapshot(snap, files)
+		if m:
+			ekpubhash = m['ekpubhash'].strip('\n')
+			hostname = m['hostname'].strip('\n')
+		else:
+			ekpubhash = snap.read_blob(files['ekpubhash'][1]).decode().strip('\n')
+			hostname = snap.read_blob(files['hostname'][1]).decode().strip('\n')
 		entry = {
 			'ekpubhash': ekpubhash,
 			'hostname': hostname
 		}
-		log(f"db_{cmdname}: entry={entry}")
 		if not no_files:
-			files = [ x[len(path)+1:] for x in glob.glob(f"{path}/*") ]
-			files.sort()
-			entry['files'] = files
-		entries += [ entry ]
-		if is_delete:
-			# Remove the ekpubhash directory (and all its files)
-			shutil.rmtree(path)
-			# Remove the corresponding hn2ek entry
-			log(f"db_{cmdname}: delete, hostname={hostname}, ekpubhash={ekpubhash}")
-			log(f"db_{cmdname}:  pre: hn2ek={db_common.hn2ek_read()}")
-			db_common.hn2ek_xdelete(hostname, ekpubhash)
-			log(f"db_{cmdname}: post: hn2ek={db_common.hn2ek_read()}")
-	git_commit(f"delete {req_ekpubhash}")
-except Exception as e:
-	caught = e
-	log(f"db_{cmdname}: failed enrollment DB '{cmdname}': {caught}")
-	# recover the git repo before we release the lock
+			entry['files'] = sorted(n for n in files
+						if not n.startswith('.'))
+		return entry
+	for x in batches(snap.entries(req_ekpubhash)):
+		log(f"db_{cmdname}: batch of {len(x)}, from {x[0][0]}")
+		emit(pool.map(read_entry, x))
+
+if not is_delete:
+	for shard in shards:
+		db_common.select_shard(shard)
+		query_snapshot()
+	emit_end()
+	sys.exit(http2exit(200))
+
+# Deletes read from the working tree, with the lock held.
+def read_entry(path):
+	m = db_manifest.read(path)
+	if m:
+		ekpubhash = m['ekpubhash'].strip('\n')
+		hostname = m['hostname'].strip('\n')
+		names = set(n.split('/')[0] for n in m['assets'])
+	else:
+		ekpubhash = open(f"{path}/ekpubhash", 'r').read().strip('\n')
+		hostname = open(f"{path}/hostname", 'r').read().strip('\n')
+		names = os.listdir(path) if not no_files else []
+	entry = {
+		'ekpubhash': ekpubhash,
+		'hostname': hostname
+	}
+	if not no_files:
+		entry['files'] = sorted(n for n in names if not n.startswith('.'))
+	return entry
+
+# Critical section, same basic idea as in db_add.py. Each shard is its own
+# transaction, under its own lock.
+def delete_shard():
+	# Change working directory to the git repo
+	os.chdir(db_common.repo_path)
+	# Get a wildcard pattern for all matching entries
+	fpath = db_common.fpath_mask(req_ekpubhash)
+	log(f"db_{cmdname}: fpath={fpath}")
+	db_common.repo_lock()
+	caught = None
+	entries = []
 	try:
-		git_reset()
+		__delete(fpath, entries)
 	except Exception as e:
-		log(f"db_{cmdname}: failed to recover!: {e}")
-		bail(f"CATASTROPHIC! DB stays locked for manual intervention")
-	log(f"db_{cmdname}: enrollment DB rollback complete")
+		caught = e
+		log(f"db_{cmdname}: failed enrollment DB '{cmdname}': {caught}")
+		# recover the git repo before we release the lock
+		try:
+			git_reset()
+		except Exception as e:
+			log(f"db_{cmdname}: failed to recover!: {e}")
+			bail(f"CATASTROPHIC! DB stays locked for manual intervention")
+		log(f"db_{cmdname}: enrollment DB rollback complete")
 
-# Remove the lock, then reraise any exception we intercepted
-db_common.repo_unlock()
-if caught:
-	log(f"db_{cmdname}: enrollment DB exception continuation: {caught}")
-	raise caught
+	# Remove the lock, then reraise any exception we intercepted
+	db_common.repo_unlock()
+	if caught:
+		log(f"db_{cmdname}: enrollment DB exception continuation: {caught}")
+		raise caught
+	return entries
+
+def __delete(fpath, entries):
+	matches = glob.glob(fpath)
+	log(f"db_{cmdname}: {len(matches)} matches")
+	if not matches:
+		return
+	changed = [ db_common.hn2ek_path, db_common.hn2ek_rev_path ] + matches
+	for x in batches(matches):
+		entries += pool.map(read_entry, x)
+	# Remove the ekpubhash directories (and all their files)
+	for path in matches:
+		shutil.rmtree(path)
+	# Remove the corresponding hn2ek entries, in a single pass over hn2ek
+	# (rather than reading and rewriting it for each match).
+	gone = set((e['hostname'], e['ekpubhash']) for e in entries)
+	data = db_common.hn2ek_read()
+	data = [ x for x in data if (x['hostname'], x['ekpubhash']) not in gone ]
+	db_common.hn2ek_write(data)
+	log(f"db_{cmdname}: hn2ek has {len(data)} entries after delete")
+	git_commit(f"delete {req_ekpubhash}", changed)
+
+# If a shard fails, the ones before it have still been deleted from (and the
+# failure is what gets reported).
+entries = []
+for shard in shards:
+	db_common.select_shard(shard)
+	entries += delete_shard()
 
 # The point of this entire file: produce a JSON to stdout that confirms the
-# transaction. This gets returned to the client. NB: we could've just encoded
-# the 'entries' list directly to JSON, rather than putting it as the only field
-# inside a dict, but that would involve going back in time (or changing any/all
-# affected client code). Maybe later, if/when we need to change the API for
-# some other reason.
-result = json.dumps({ 'entries': entries }, sort_keys = True)
-log(f"db_{cmdname}: emitting result={result}")
-print(result)
+# transaction. This gets returned to the client.
+emit(entries)
+emit_end()
 sys.exit(http2exit(200))
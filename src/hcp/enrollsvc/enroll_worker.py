@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import queue
+import select
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+sys.path.insert(1, '/hcp/common')
+from hcp_common import log, bail
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_jobs
+import db_add
+import db_commit
+
+# The enrollment worker. It runs the jobs that get queued by db_jobs.py, up to
+# 'db_jobs.num_workers' of them at once, each in one of its threads. The jobs
+# run in-process, via db_add.job(), rather than as db_add.py processes, so the
+# interpreter start-up, the config load (db_add.init()), the merged-profile
+# cache, and the policy-checker connections (see HcpHttpClient) are paid for
+# once rather than per job. (So changes to the config take a restart of the
+# worker to take effect.) The attest-enroll and genprogs that each job runs are
+# still processes, so they parallelize across CPUs, and the number of workers
+# can be sized to the CPUs rather than to the DB.
+#
+# db_commit.py isn't thread-safe (it selects shards and changes directory), so
+# the commits all go through one 'committer' thread, which takes whatever the
+# job threads have submitted since its last commit and passes it to
+# db_commit.submit_many() in one go. So commits are batched across jobs, as
+# they are across processes.
+#
+# The worker wakes up when a job is queued (the 'wakeup' FIFO) and when a job
+# finishes, and otherwise rescans the queue every 'rescan_secs', which covers
+# any wakeups that got lost and jobs whose runners died, and expires old jobs.
+
+rescan_secs = 30
+
+try:
+	lockfd = db_jobs.worker_lock()
+except db_jobs.HcpJobError as e:
+	bail(f"enroll_worker: {e}")
+
+log(f"enroll_worker: starting, workers={db_jobs.num_workers}")
+db_add.init()
+
+commitq = queue.Queue()
+
+def committer():
+	try:
+		while True:
+			batch = [ commitq.get() ]
+			while True:
+				try:
+					batch.append(commitq.get_nowait())
+				except queue.Empty:
+					break
+			items = [ x for b in batch for x in b[0] ]
+			log(f"enroll_worker: committing {len(items)} items "
+				f"for {len(batch)} jobs")
+			try:
+				results = db_commit.submit_many(items)
+			except Exception as e:
+				for _, f in batch:
+					f.set_exception(e)
+				continue
+			for b_items, f in batch:
+				f.set_result(results[:len(b_items)])
+				results = results[len(b_items):]
+	except BaseException as e:
+		# Eg. db_commit bail()ing, with the DB left locked. The jobs
+		# can't finish without us, so neither can we, and their claims
+		# go with us.
+		log(f"enroll_worker: committer died: {type(e).__name__}: {e}")
+		os._exit(1)
+
+# db_commit.submit_many(), via the committer
+def submit_many(items):
+	if not items:
+		return []
+	f = Future()
+	commitq.put((items, f))
+	return f.result()
+
+threading.Thread(target = committer, daemon = True).start()
+
+def runner(op, args):
+	return db_add.job(op, args, submit_many)
+
+wakefd = db_jobs.wakeup_open()
+inflight = set()
+inflight_lock = threading.Lock()
+
+# Finishing jobs wake up the main loop via a pipe, so that it can dispatch the
+# next ones (if it's holding any back) without waiting for the rescan.
+donefd_r, donefd_w = os.pipe()
+os.set_blocking(donefd_r, False)
+
+def runjob(jobid):
+	try:
+		db_jobs.run(jobid, runner)
+	except Exception as e:
+		log(f"enroll_worker: {jobid} raised {e}")
+	finally:
+		with inflight_lock:
+			inflight.discard(jobid)
+		os.write(donefd_w, b'.')
+
+last_gc = 0
+with ThreadPoolExecutor(max_workers = db_jobs.num_workers) as pool:
+	while True:
+		# Only dispatch as many as we have workers for, the rest can
+		# wait in the queue (where they stay visible as 'pending').
+		with inflight_lock:
+			room = db_jobs.num_workers - len(inflight)
+			todo = [ x for x in db_jobs.pending() if x not in inflight ]
+			todo = todo[:max(room, 0)]
+			inflight.update(todo)
+		for jobid in todo:
+			log(f"enroll_worker: dispatching {jobid}")
+			pool.submit(runjob, jobid)
+		select.select([ wakefd, donefd_r ], [], [], rescan_secs)
+		if time.monotonic() - last_gc > rescan_secs:
+			db_jobs.gc()
+			last_gc = time.monotonic()
+		db_jobs.wakeup_drain(wakefd)
+		db_jobs.wakeup_drain(donefd_r)
@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# The enrollment worker runs with dropped privs, as the DB user. It sources
+# common.sh (for the signing-key and CA settings that db_add.py expects in its
+# environment) and then hands over to enroll_worker.py, which never exits.
+
+source /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+exec python3 /hcp/enrollsvc/enroll_worker.py
@@ -15,15 +15,22 @@ expect_db_user
 git config --global user.email 'do-not-reply@nowhere.special'
 git config --global user.name 'Host Cryptographic Provisioning (HCP)'
 
-# Now create the git repo
-cd $HCP_DB_DIR
-mkdir $REPO_PATH
-cd $REPO_PATH
-git init
-touch .git/git-daemon-export-ok
-echo "[]" > $HN2EK_PATH
-mkdir $EK_BASENAME
-touch $EK_BASENAME/do_not_remove
-git add .
-git commit -m "Initial commit"
-git log
+# Now create the git repo(s). Without sharding, that's just one, otherwise
+# there's one per shard. (See '.enrollsvc.shards' and db_common.py.)
+for name in $(repo_names); do
+	cd $HCP_DB_DIR
+	mkdir $name
+	cd $name
+	git init
+	touch .git/git-daemon-export-ok
+	# Replicas that only serve some prefixes make partial clones, see
+	# '.prefixes' in attestsvc/common.sh.
+	git config uploadpack.allowFilter true
+	echo "[]" > $HN2EK_BASENAME
+	echo "[]" > $HN2EK_REV_BASENAME
+	mkdir $EK_BASENAME
+	touch $EK_BASENAME/do_not_remove
+	git add .
+	git commit -m "Initial commit"
+	git log
+done
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(1, '/hcp/common')
+from hcp_common import log, bail, hcp_config_extract, dict_timedelta
+
+sys.path.insert(1, '/hcp/xtra')
+import HcpKeyPool
+
+# The key pool service. It keeps '.keypool.keys' (eg. { "rsa-2048": 16 }) keys
+# of each kind ready in '.keypool.dir' (see xtra/HcpKeyPool.py), for the
+# genprogs to take (see gencert-hxtool) rather than generating their own on
+# the request path. Whenever the pool is short, it tops it up, 'workers' keys
+# at a time (default 1), at a lower CPU priority than enrollments, so that the
+# refilling happens between bursts rather than competing with them. Otherwise
+# it checks every 'period' (default 5 seconds). If the pool runs dry, the
+# genprogs just generate keys themselves, as they would without a pool.
+#
+# It also removes keys that were claimed (or partially generated) more than
+# 'stale_secs' ago, whose claimers (or generators) must have died.
+
+stale_secs = 3600
+
+pool_dir = hcp_config_extract('.keypool.dir', must_exist = True)
+pool_keys = hcp_config_extract('.keypool.keys', must_exist = True)
+period = dict_timedelta(hcp_config_extract('.keypool.period',
+			or_default = True, default = { 'seconds': 5 }))
+period = period.total_seconds()
+workers = int(hcp_config_extract('.keypool.workers', or_default = True,
+			default = 1))
+
+for kind in pool_keys:
+	try:
+		HcpKeyPool.genpkey_args(kind)
+	except HcpKeyPool.HcpKeyPoolError as e:
+		bail(f"keypool: {e}")
+
+# Same protection as the other secrets, only the DB user gets to see them.
+os.umask(0o077)
+os.makedirs(pool_dir, mode = 0o700, exist_ok = True)
+os.chmod(pool_dir, 0o700)
+os.nice(10)
+pool = HcpKeyPool.KeyPool(pool_dir)
+
+log(f"keypool: starting, dir={pool_dir}, keys={pool_keys}, "
+	f"period={period}, workers={workers}")
+
+# The keys that are missing, taking turns between kinds, so that one kind
+# running low doesn't starve the others.
+def shortfall():
+	missing = { kind: max(int(pool_keys[kind]) - pool.count(kind), 0)
+		for kind in pool_keys }
+	todo = []
+	while any(missing.values()):
+		for kind in missing:
+			if missing[kind]:
+				todo.append(kind)
+				missing[kind] -= 1
+	return todo
+
+last_gc = 0
+with ThreadPoolExecutor(max_workers = workers) as executor:
+	while True:
+		if time.monotonic() - last_gc > stale_secs / 4:
+			removed = pool.gc(stale_secs)
+			if removed:
+				log(f"keypool: removed {removed} stale keys")
+			last_gc = time.monotonic()
+		todo = shortfall()
+		if not todo:
+			time.sleep(period)
+			continue
+		log(f"keypool: generating {len(todo)} keys")
+		# Check again after a round of 'workers' keys, claims may have
+		# happened in the meantime.
+		try:
+			list(executor.map(pool.generate, todo[:workers]))
+		except Exception as e:
+			log(f"keypool: generation failed: {e}")
+			time.sleep(period)
@@ -0,0 +1,10 @@
+#!/bin/bash
+
+# The key pool (see keypool.py) runs with dropped privs, as the DB user, which
+# is who the genprogs that take keys from it run as.
+
+source /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+exec python3 /hcp/enrollsvc/keypool.py
@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# DB maintenance (repacking, and optionally squashing old history, see
+# db_maint.py) runs with dropped privs, as the DB user. As with the
+# reenroller, we do the outer loop here, and db_maint.py does a single pass.
+
+source /hcp/enrollsvc/common.sh
+
+expect_db_user
+
+jperiod=$(hcp_config_extract '.maint.period')
+jretry=$(hcp_config_extract '.maint.retry')
+
+S_OK=$(dict_timedelta "$jperiod")
+S_ERR=$(dict_timedelta "$jretry")
+echo "maint running with period=$S_OK, retry=$S_ERR"
+
+while : ; do
+	# Unlike the reenroller, the output (the before/after measurements) is
+	# the point, so it goes to stdout. See reenroller.sh about stderr.
+	python3 /hcp/enrollsvc/db_maint.py 2> /dev/null &&
+		sleep $S_OK ||
+		(echo "Warning: maint encountered error: sleep $S_ERR" &&
+			sleep $S_ERR)
+done
@@ -4,11 +4,13 @@ from flask import request, abort, send_file, Response, make_response
 import subprocess
 import json
 import os, sys
-from stat import *
 from markupsafe import escape
-from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 import tempfile
 import requests
+import hashlib
+import base64
+import io
 
 sys.path.insert(1, '/hcp/common')
 from hcp_common import log, exit2http, current_tracefile
@@ -19,8 +21,59 @@ from HcpRecursiveUnion import union
 sys.path.insert(1, '/hcp/enrollsvc')
 import db_common
 
+# Uploaded files (ekpubs) are received straight into an anonymous, in-memory
+# file (a memfd, or an unlinked temp file if memfds aren't available), rather
+# than wherever werkzeug would otherwise buffer them, and hashed (SHA-256) as
+# the bytes arrive. So by the time a handler sees the upload, we already know
+# its hash, and the file can be handed to the sudo'd command as its stdin,
+# without it ever being written anywhere that anyone else could read. (ekpubs
+# are small, hence the limit.)
+max_upload = 65536
+
+class UploadFile(io.FileIO):
+    def __init__(self):
+        try:
+            fd = os.memfd_create('upload', os.MFD_CLOEXEC)
+        except (AttributeError, OSError):
+            with tempfile.TemporaryFile() as f:
+                fd = os.dup(f.fileno())
+        super().__init__(fd, 'r+')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > max_upload:
+            raise RequestEntityTooLarge()
+        self.sha256.update(data)
+        view = memoryview(data)
+        while view:
+            view = view[super().write(view):]
+        return len(data)
+
+    # If werkzeug gave us something else, copy it into one of ours
+    @classmethod
+    def of(cls, filestorage):
+        stream = filestorage.stream
+        if isinstance(stream, cls):
+            return stream
+        result = cls()
+        stream.seek(0)
+        while True:
+            chunk = stream.read(65536)
+            if not chunk:
+                break
+            result.write(chunk)
+        return result
+
+class HcpRequest(flask.Request):
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename = None, content_length = None):
+        return UploadFile()
+
 app = flask.Flask(__name__)
 app.config["DEBUG"] = False
+app.request_class = HcpRequest
 
 # Prepare the "request" object that lower-level calls (running behind the sudo
 # curtain) can use when making policy lookups. The caller of this function will
@@ -57,6 +110,22 @@ def home():
 <tr><td>hostname</td><td><input type=text name=hostname></td></tr>
 <tr><td>profile</td><td><input type=text name=profile></td></tr>
 <tr><td>paramfile</td><td><input type=file name=paramfile></td></tr>
+<tr><td>async</td><td><input type=checkbox name=async></td></tr>
+</table>
+<input type="submit" value="Enroll">
+</form>
+
+<h2>To add many host entries at once;</h2>
+<p>'entries' is a JSON list of {"ekpub": "&lt;name of a file field&gt;",
+"hostname": "&lt;hostname&gt;", "profile": {...}} (with 'profile' optional).
+Each ekpub is uploaded as a file field of that name. Entries that name the same
+field take its files in order, so with the form below, each entry's "ekpub" is
+"ekpub" and the files are selected in the same order as the entries. This is
+always asynchronous, the response has a job 'id' to pass to /v1/job.</p>
+<form method="post" enctype="multipart/form-data" action="/v1/add_bulk">
+<table>
+<tr><td>entries</td><td><input type=text name=entries></td></tr>
+<tr><td>ekpubs</td><td><input type=file name=ekpub multiple></td></tr>
 </table>
 <input type="submit" value="Enroll">
 </form>
@@ -85,17 +154,31 @@ def home():
 <input type="submit" value="Reenroll">
 </form>
 
+<h2>To check on an asynchronous add/reenroll;</h2>
+<form method="get" action="/v1/job">
+<table>
+<tr><td>job id</td><td><input type=text name=id></td></tr>
+<tr><td>wait (seconds, optional)</td><td><input type=text name=wait></td></tr>
+</table>
+<input type="submit" value="Check">
+</form>
+
 <h2>To find host entries by hostname regex;</h2>
 <form method="get" action="/v1/find">
 <table>
 <tr><td>hostname regex</td><td><input type=text name=hostname_regex></td></tr>
+<tr><td>cursor (optional)</td><td><input type=text name=cursor></td></tr>
+<tr><td>limit (optional)</td><td><input type=text name=limit></td></tr>
 </table>
 <input type="submit" value="Find">
 </form>
 
-<h2>To trigger the janitor (looks for known issues, regenerates the
-hn2ek table, etc);</h2>
+<h2>To trigger the janitor (looks for known issues in entries that changed
+since it last ran, keeps the hn2ek table in sync, etc);</h2>
 <form method="get" action="/v1/janitor">
+<table>
+<tr><td>full (check every entry)</td><td><input type=checkbox name=full value=1></td></tr>
+</table>
 <input type="submit" value="Janitor">
 </form>
 
@@ -155,6 +238,48 @@ def check_status_code(c):
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
+# For operations whose output can be large (eg. a query over the whole DB),
+# this relays stdout to the client as it's produced, rather than collecting it
+# first. The status code has to be sent before the body, so we wait for the
+# first byte of output: if the process exits without producing any, it failed
+# and we return its status as check_status_code() would. Otherwise it's a 200,
+# and if it fails part way through, the client gets a truncated (invalid) JSON
+# document. (db_query.py only completes the document once it has succeeded.)
+def stream_status_code(args):
+    c = subprocess.Popen(args,
+                         stdout = subprocess.PIPE,
+                         stderr = current_tracefile)
+    first = c.stdout.read(1)
+    if not first:
+        c.stdout.close()
+        c.wait()
+        httpcode = exit2http(c.returncode)
+        log(f"stream_status_code: no output, httpcode={httpcode}")
+        if httpcode >= 200 and httpcode < 300:
+            return ("Server JSON error", 500)
+        return make_response("Error", httpcode)
+    def relay():
+        # If the client goes away, closing the pipe stops the process
+        try:
+            yield first
+            while True:
+                chunk = c.stdout.read1(65536)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            c.stdout.close()
+            c.wait()
+            log(f"stream_status_code: returncode={c.returncode}")
+    return Response(relay(), 200, content_type = 'application/json')
+
+# 'add' and 'reenroll' can be asynchronous. If the request has a (non-empty)
+# 'async' field, the response is a 202 as soon as the job is queued, with a
+# JSON body containing the job 'id'. The outcome is then retrieved (and
+# optionally long-polled for) with '/v1/job'.
+def is_async(form):
+    return len(form.get('async', '')) > 0
+
 @app.route('/v1/add', methods=['POST'])
 def my_add():
     log(f"my_add: request={request}")
@@ -174,27 +299,90 @@ def my_add():
     request_data = get_request_data('/v1/add')
     request_data = union(form_data, request_data)
     request_json = json.dumps(request_data)
-    # Create a temporary directory (for the ek.pub file), and make it world
-    # readable+executable. The /hcp/enrollsvc/db_add.py script runs behind
-    # sudo, as another user, and it needs to be able to read the ek.pub.
-    tf = tempfile.TemporaryDirectory()
-    s = os.stat(tf.name)
-    os.chmod(tf.name, s.st_mode | S_IROTH | S_IXOTH)
-    # Sanitize the user-supplied filename, and join it to the temp directory,
-    # this is where the ek.pub file gets saved and is the path passed to the
-    # db_add.sh script.
-    local_ekpub = os.path.join(tf.name,
-                               secure_filename(form_ekpub.filename))
-    form_ekpub.save(local_ekpub)
-    opadd_args = sudoargs + [ 'add', local_ekpub, form_hostname, request_json]
+    upload = UploadFile.of(form_ekpub)
+    # If this ekpub is already enrolled (see db_common.enrolled_ekpub() for
+    # when we can tell), say so now, without going anywhere near sudo or
+    # attest-enroll. (The DB is readable to us, it's what the replicas
+    # clone.) Otherwise, it's up to db_add.py.
+    try:
+        upload.seek(0)
+        ekpubhash = db_common.enrolled_ekpub(upload.read(),
+                                             upload.sha256.hexdigest())
+        if ekpubhash:
+            log(f"my_add: already enrolled: {ekpubhash}")
+            return make_response("Error: ekpub already enrolled", 409)
+    except Exception as e:
+        log(f"my_add: couldn't check for existing enrollment: {e}")
+    # The ekpub goes to the sudo'd command on its stdin ("-").
+    upload.seek(0)
+    opadd = 'add_async' if is_async(request.form) else 'add'
+    opadd_args = sudoargs + [ opadd, '-', form_hostname, request_json]
     log(f"my_add: opadd_args={opadd_args}")
     c = subprocess.run(opadd_args,
+                       stdin = upload,
                        stdout = subprocess.PIPE,
                        stderr = current_tracefile,
                        text = True)
     foo = check_status_code(c)
     return foo
 
+# Enrolls many {ekpub, hostname, profile} tuples in one request. The form has
+# an 'entries' field, a JSON list of dicts, each with 'hostname', optionally
+# 'profile' (as for '/v1/add'), and 'ekpub', the name of the file field in the
+# same (multipart) request that holds that entry's ekpub. Entries can name the
+# same field, in which case they take its files in the order they were
+# uploaded (so one multi-file field can serve every entry). Enrolling many
+# entries takes a while, so this is always asynchronous: the response is a 202
+# with the job 'id', and the job's 'result' (see '/v1/job') is
+# { "returncode": 0, "entries": [...] }, with an outcome per entry (in the same
+# order), each with its own 'http_status' (201 for success). Entries that
+# fail don't affect the ones that don't.
+@app.route('/v1/add_bulk', methods=['POST'])
+def my_add_bulk():
+    log(f"my_add_bulk: request={request}")
+    if 'entries' not in request.form:
+        return make_response("Error: entries not in request", 400)
+    try:
+        form_entries = json.loads(request.form['entries'])
+    except json.JSONDecodeError:
+        return make_response("Error: entries must be JSON", 400)
+    if not isinstance(form_entries, list):
+        return make_response("Error: entries must be a list", 400)
+    request_data = get_request_data('/v1/add_bulk')
+    # As for my_add(), the ekpubs go to the sudo'd command on its stdin, along
+    # with the rest of the manifest.
+    files = {}
+    manifest = []
+    for i, entry in enumerate(form_entries):
+        if not isinstance(entry, dict) or 'hostname' not in entry or \
+                'ekpub' not in entry:
+            return make_response(f"Error: entry {i} is malformed", 400)
+        field = entry['ekpub']
+        if field not in files:
+            files[field] = request.files.getlist(field)
+        if not files[field]:
+            return make_response(f"Error: entry {i} has no ekpub", 400)
+        upload = UploadFile.of(files[field].pop(0))
+        form_data = entry.get('profile', {})
+        if isinstance(form_data, str):
+            try:
+                form_data = json.loads(form_data) if len(form_data) > 0 else {}
+            except json.JSONDecodeError:
+                return make_response(f"Error: entry {i} profile isn't JSON", 400)
+        upload.seek(0)
+        manifest.append({
+            'ekpub': base64.b64encode(upload.read()).decode(),
+            'hostname': entry['hostname'],
+            'profile': json.dumps(union(form_data, request_data))
+        })
+    log(f"my_add_bulk: {len(manifest)} entries")
+    c = subprocess.run(sudoargs + [ 'add_bulk' ],
+                       input = json.dumps(manifest),
+                       stdout = subprocess.PIPE,
+                       stderr = current_tracefile,
+                       text = True)
+    return check_status_code(c)
+
 @app.route('/v1/query', methods=['GET'])
 def my_query():
     log(f"my_query: request={request}")
@@ -208,11 +396,7 @@ def my_query():
         request_data['nofiles'] = False
     request_json = json.dumps(request_data)
     log(f"my_query: request_json={request_json}")
-    c = subprocess.run(sudoargs + [ 'query', request_json ],
-                       stdout = subprocess.PIPE,
-                       stderr = current_tracefile,
-                       text = True)
-    return check_status_code(c)
+    return stream_status_code(sudoargs + [ 'query', request_json ])
 
 @app.route('/v1/delete', methods=['POST'])
 def my_delete():
@@ -241,11 +425,33 @@ def my_reenroll():
     request_data['ekpubhash'] = request.form['ekpubhash']
     request_json = json.dumps(request_data)
     log(f"my_reenroll: request_json={request_json}")
-    c = subprocess.run(sudoargs + [ 'reenroll', request_json ],
+    opreenroll = 'reenroll_async' if is_async(request.form) else 'reenroll'
+    c = subprocess.run(sudoargs + [ opreenroll, request_json ],
                        stdout=subprocess.PIPE, stderr = subprocess.PIPE,
                        text=True)
     return check_status_code(c)
 
+# Returns the state of an asynchronous job. If 'wait' is given, the request
+# blocks until the job is done or that many seconds pass (the server caps it),
+# whichever comes first. Once the job's state is 'done', 'http_status' and
+# 'result' are what the synchronous request would have returned.
+@app.route('/v1/job', methods=['GET'])
+@app.route('/v1/job/<jobid>', methods=['GET'])
+def my_job(jobid = None):
+    log(f"my_job: request={request}")
+    if not jobid:
+        jobid = request.args.get('id')
+    if not jobid:
+        return make_response("Error: job id not in request", 400)
+    wait = request.args.get('wait', '0')
+    if len(wait) == 0:
+        wait = '0'
+    c = subprocess.run(sudoargs + [ 'job', jobid, wait ],
+                       stdout = subprocess.PIPE,
+                       stderr = current_tracefile,
+                       text = True)
+    return check_status_code(c)
+
 @app.route('/v1/find', methods=['GET'])
 def my_find():
     log(f"my_find: request={request}")
@@ -253,6 +459,13 @@ def my_find():
         return make_response("Error: hostname_regex not in request", 400)
     request_data = get_request_data('/v1/find')
     request_data['hostname_regex'] = request.args['hostname_regex']
+    if request.args.get('cursor'):
+        request_data['cursor'] = request.args['cursor']
+    if request.args.get('limit'):
+        try:
+            request_data['limit'] = int(request.args['limit'])
+        except ValueError:
+            return make_response("Error: limit must be an integer", 400)
     request_json = json.dumps(request_data)
     log(f"my_find: request_json={request_json}")
     c = subprocess.run(sudoargs + [ 'find', request_json],
@@ -263,7 +476,10 @@ def my_find():
 @app.route('/v1/janitor', methods=['GET'])
 def my_janitor():
     log(f"my_janitor: request={request}")
-    c = subprocess.run(sudoargs + [ 'janitor' ],
+    mode = 'incremental'
+    if len(request.args.get('full', '')) > 0:
+        mode = 'full'
+    c = subprocess.run(sudoargs + [ 'janitor', mode ],
                        stdout=subprocess.PIPE,
                        text=True)
     return check_status_code(c)
@@ -33,7 +33,27 @@ case $cmd in
 
 	add)
 		check_arg_num $# 3
-		exec python3 /hcp/enrollsvc/db_add.py add "$1" "$2" "$3"
+		exec python3 /hcp/enrollsvc/db_jobs.py add "$1" "$2" "$3"
+		;;
+
+	add_async)
+		check_arg_num $# 3
+		exec python3 /hcp/enrollsvc/db_jobs.py add_async "$1" "$2" "$3"
+		;;
+
+	reenroll_async)
+		check_arg_num $# 1
+		exec python3 /hcp/enrollsvc/db_jobs.py reenroll_async "$1"
+		;;
+
+	job)
+		check_arg_num $# 2
+		exec python3 /hcp/enrollsvc/db_jobs.py job "$1" "$2"
+		;;
+
+	add_bulk)
+		check_arg_num $# 0
+		exec python3 /hcp/enrollsvc/db_jobs.py add_bulk_async
 		;;
 
 	query | delete)
@@ -46,7 +66,7 @@ case $cmd in
 
 	reenroll)
 		check_arg_num $# 1
-		exec python3 /hcp/enrollsvc/db_add.py reenroll "$1"
+		exec python3 /hcp/enrollsvc/db_jobs.py reenroll "$1"
 		;;
 
 	find)
@@ -55,8 +75,8 @@ case $cmd in
 		;;
 
 	janitor)
-		check_arg_num $# 0
-		exec python3 /hcp/enrollsvc/db_janitor.py
+		check_arg_num $# 1
+		exec python3 /hcp/enrollsvc/db_janitor.py "$1"
 		;;
 
 	*)
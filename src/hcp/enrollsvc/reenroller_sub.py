@@ -2,105 +2,125 @@ import os
 import sys
 import time
 from datetime import datetime, timezone, timedelta
-import glob
 import json
-import re
-import subprocess
 
 sys.path.insert(1, '/hcp/common')
-from hcp_common import log, bail, datetime2hint, exit2http
+from hcp_common import log, bail, datetime2hint, hcp_config_extract
 
 sys.path.insert(1, '/hcp/enrollsvc')
 import db_common
+import db_due
+import db_add
 
 log("reenroller: starting")
 
-# We follow a series of steps in order to produce a list of enrollments that
-# should be reenrolled.
+# Reenrollments are scheduled by the index in db_due.py, which is maintained
+# when enrollments are committed. So all we need to look at are the buckets up
+# to the current hour, rather than the whole DB. If the index hasn't been
+# built yet (eg. the first run after an upgrade), build it now. (If the DB is
+# sharded, each shard has its own index.)
+def bootstrap_shard():
+	os.chdir(db_common.repo_path)
+	if not db_due.ready():
+		db_common.repo_lock()
+		try:
+			if not db_due.ready():
+				db_due.bootstrap()
+		finally:
+			db_common.repo_unlock()
 
-# 1. 'fpath' is a wildcard pattern for use by 'glob', which does not support
-# regular expressions, producing 'matches1', a superset of what we want.
-fpath = f"{db_common.fpath_mask('')}/hint-reenroll-*"
-log(f"reenroller: fpath={fpath}")
-matches1 = glob.glob(fpath)
+# Config: '.reenroller.concurrency' is how many reenrollments generate at once
+# (default: the number of CPUs), and '.reenroller.batch' is the most we take
+# on per pass (default 1000), the rest wait for the next pass.
+concurrency = hcp_config_extract('.reenroller.concurrency', or_default = True,
+				default = os.cpu_count() or 1)
+batch = hcp_config_extract('.reenroller.batch', or_default = True,
+				default = 1000)
 
-# 2. 'hintmatcher' is the regex to filter out surplus files, producing
-# 'matches2'.
-hintmatcher = re.compile('hint-reenroll-[0-9]*\.')
-matches2 = [m for m in matches1 if not hintmatcher.search(m)]
-
-# 3. convert each array entry (a path string) into a struct with the fields
-# we'll need: 'matches3'
-matches3 = [
-	{
-		'dirname': os.path.dirname(foo),
-		'basename': os.path.basename(foo),
-		'ekpubhash': open(f"{os.path.dirname(foo)}/ekpubhash",
-					'r').read().strip('\n'),
-		'hint': os.path.basename(foo).replace(
-				'hint-reenroll-', '')
-	} for foo in matches2 ]
+hintnow = datetime2hint(datetime.now(timezone.utc))
 
-# 4. put our list in 'basename' order - giving us the enrollments with the
-# earliest reenrollment hints first. Then we're done, so call it 'matches'.
-matches = matches3
-matches.sort(key = lambda x : x['basename'])
+# The index may have stale lines for enrollments that have since been
+# reenrolled or deleted, so check each against the (committed) DB. Each shard's
+# are in hint order, but if there's more than a batch's worth, it's the most
+# overdue (across all shards) that get done first.
+matches = []
+done = []
+for shard in db_common.shard_names:
+	db_common.select_shard(shard)
+	bootstrap_shard()
+	due = db_due.due(hintnow)
+	if not due:
+		continue
+	snap = db_common.snapshot()
+	for hint, ekpubhash in due:
+		if db_due.current(snap, hint, ekpubhash):
+			matches.append({ 'hint': hint, 'ekpubhash': ekpubhash })
+		else:
+			done.append((hint, ekpubhash))
+matches.sort(key = lambda x: x['hint'])
+matches = matches[:batch]
 
-hintnow = datetime2hint(datetime.now(timezone.utc))
 s = f"now={hintnow}, matches={[foo['ekpubhash'][0:16] for foo in matches]}"
-log(f"reenroller: loop-start: {s}")
+log(f"reenroller: loop-start: {s}, stale={len(done)}")
 
-for entry in matches:
-	hint = entry['hint']
-	ekpubhash = entry['ekpubhash']
-	shorthash = ekpubhash[0:16]
-	s = f"ekpubhash={shorthash}, hint={hint}"
+# The reenrollments are done in-process, as one batch, via db_add.py's
+# enroll_bulk(). That gets the profiles checked by the policy-checker in one
+# request, runs the genprogs 'concurrency' at a time, and commits everything
+# with a single acquisition of the repo lock (and a single commit, per shard),
+# rather than paying for an interpreter, a config load, a policy request, and a
+# commit per reenrollment.
+#
+# This is a departure from how db_add.py is otherwise used. The web API
+# deliberately runs flask handlers as a different non-root user from the
+# actual operations that manipulate the database (and issuer credentials), and
+# requests those operations through a pinholed, environment-cleansing sudo call
+# (to a bash script that demuxes on the other side). So each of those
+# operations is launched in a fresh interpreter, whose stdout provides the
+# return data (JSON) and whose exit code provides the http status code
+# (relative to the http2exit/exit2http stuff in common/hcp.sh and
+# common/hcp_common.py). That remains the case; the 'db_add.py' CLI is
+# unchanged for mgmt_sudo.sh (and self_enroll.sh). But the reenroller already
+# runs as the DB user, with the signing/issuer environment set up by
+# common.sh, and it's already a fresh process for each pass (see
+# reenroller.sh), so it gets the same benefits (fresh config, abort() as a
+# safe way to deal with errors, etc) without having to fork per entry.
+oks = []
+if matches:
+	db_add.init()
+	for entry in matches:
+		log(f"reenroller: reenrolling ekpubhash={entry['ekpubhash'][0:16]}, "
+			f"hint={entry['hint']}")
+	items = [ ('reenroll', [ json.dumps({ 'ekpubhash': entry['ekpubhash'] }) ])
+		for entry in matches ]
+	outcomes = db_add.enroll_bulk(items, concurrency)
+	for entry, outcome in zip(matches, outcomes):
+		ok = outcome['http_status'] == 201
+		if not ok:
+			log(f"FAILURE: 'reenroll' of '{entry['ekpubhash'][0:16]}';")
+			log(f" - http_status: {outcome['http_status']}")
+			log(f" - error: {outcome.get('error')}")
+			log(f" - message: {outcome.get('message')}")
+		oks.append(ok)
+done += [ (entry['hint'], entry['ekpubhash'])
+	for entry, ok in zip(matches, oks) if ok ]
 
-	if hintnow < hint:
-		log(f"reenroller: stopping on {s}")
-		break
-	log(f"reenroller: reenrolling {s}")
+# Take the ones we dealt with out of the index. The reenrollments put their
+# new hints in it when they got committed. Failures stay, so they're retried
+# next time.
+byshard = {}
+for hint, ekpubhash in done:
+	byshard.setdefault(db_common.shard_of(ekpubhash), []).append(
+		(hint, ekpubhash))
+for shard in byshard:
+	db_common.select_shard(shard)
+	os.chdir(db_common.repo_path)
+	db_common.repo_lock()
+	try:
+		db_due.remove(byshard[shard])
+	finally:
+		db_common.repo_unlock()
 
-	clientdata = {
-		'ekpubhash': ekpubhash
-	}
-	clientjson = json.dumps(clientdata)
-	# It might seem weird to be running a python program using subprocess,
-	# let me explain. The web API deliberately runs flask handlers as a
-	# different non-root user from the actual operations that manipulate
-	# the database (and issuer credentials). The web API handlers sanitize
-	# each request and then requests the real operations through a
-	# pinholed, environment-cleansing sudo call (to a bash script that
-	# demuxes on the other side).
-	#
-	# So by design, that bash script is launched (by sudo) for each
-	# individual operation, so the operations it calls are also launched in
-	# a fresh interpreter to process the requested operation and then exit.
-	# This has some security and reliability value: configuration is always
-	# fresh, log-rotation is a no-brainer, garbage collection too, abort()
-	# becomes a legitimate/safe/conservative way to deal with errors, etc).
-	# In fact, when the process exits and the sudo call returns to the web
-	# API handler, the stdout from the operation provides the return data
-	# (JSON) and the exit code from the process provides the http status
-	# code! (Relative to the http2exit/exit2http stuff defined in
-	# common/hcp.sh and common/hcp_common.py. That's why we're checking for
-	# '201' below, rather than the conventional posix '0'.)
-	#
-	# So _that's_ why the python operation is launched as a process, rather
-	# than as a library call. (BTW, the bash demuxer running behind sudo
-	# isn't the only other thing that launches db_add.py - self_enroll.sh
-	# does it too, if enabled. The thing is, they're both in bash, so
-	# nobody finds anything odd about them launching subprocesses.) :-)
-	c = subprocess.run([ 'python3', '/hcp/enrollsvc/db_add.py',
-			'reenroll', clientjson],
-		stdout = subprocess.PIPE,
-		stderr = subprocess.PIPE)
-	httpcode = exit2http(c.returncode)
-	if httpcode != 201:
-		log(f"FAILURE: 'reenroll' of '{shorthash}';")
-		log(f" - exitcode: {c.returncode}")
-		log(f" - stdout: {c.stdout}")
-		log(f" - stderr: {c.stderr}")
-		bail("reenroller")
+if not all(oks):
+	bail(f"reenroller: {oks.count(False)} of {len(oks)} failed")
 
 log("reenroller: loop-end")
@@ -49,6 +49,15 @@ done
 shift $((OPTIND - 1))
 (($# == 0)) || (echo 2> "Unexpected options: $@" && exit 1) || usage
 
+# If the DB is sharded, checking the first shard's repo will do
+shards=$(hcp_config_extract_or '.enrollsvc.shards' 1)
+case "$shards" in
+1)	repo=enrolldb;;
+16)	repo=enrolldb-0;;
+256)	repo=enrolldb-00;;
+*)	echo >&2 "Invalid number of shards: $shards"; exit 1;;
+esac
+
 tout=$(mktemp)
 terr=$(mktemp)
 onexit() {
@@ -71,7 +80,7 @@ fi
 while :; do
 	((VERBOSE > 0)) && echo >&2 "Running: git ls-remote --heads"
 	res=0
-	git ls-remote --heads git://localhost/enrolldb >$tout 2>$terr || res=$?
+	git ls-remote --heads git://localhost/$repo >$tout 2>$terr || res=$?
 	if [[ $res == 0 ]]; then
 		((VERBOSE > 0)) && echo >&2 "Success"
 		exit 0
@@ -0,0 +1,112 @@
+import sys
+import json
+import time
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(1, '/hcp/common')
+from hcp_common import log, hcp_config_extract
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_common
+
+sys.path.insert(1, '/hcp/xtra')
+import HcpGitRepo
+
+# Change notification for replicas (attestsvc's updater_loop.sh), so that they
+# fetch as soon as the DB changes, rather than polling it (with git fetch) on a
+# fixed period. It runs alongside the git-daemon that they fetch from, and
+# serves one (long-poll) request;
+#
+#   GET /v1/generation?since=<generation>&timeout=<seconds>
+#
+# which returns { 'generation': <token>, 'heads': { <repo>: <commit>, ... } }
+# as soon as the generation differs from 'since', or when 'timeout' seconds
+# (default and maximum 'max_timeout') have passed, whichever comes first.
+# Without 'since', it returns straight away. 'heads' has the HEAD commit of
+# each repo that git-daemon serves (one per shard, see db_common.py), by the
+# name it serves it under, and the generation is a token that changes whenever
+# any of them does. So a replica waits (cheaply, no fetching) while the DB is
+# idle, and can tell which repos it needs to fetch when it isn't.
+#
+# The HEADs are read every 'interval' seconds (default 0.1), by one thread,
+# however many replicas are waiting, so notification is sub-second and the
+# cost doesn't grow with the number of replicas.
+
+port = int(hcp_config_extract('.repl_notify.port', or_default = True,
+			default = 9419))
+interval = float(hcp_config_extract('.repl_notify.interval',
+			or_default = True, default = 0.1))
+max_timeout = int(hcp_config_extract('.repl_notify.max_timeout',
+			or_default = True, default = 300))
+
+repos = {}
+for shard in db_common.shard_names:
+	name = f"enrolldb{db_common.shard_suffix(shard)}"
+	repos[name] = HcpGitRepo.GitRepo(db_common.shard_repo_path(shard))
+
+def read_heads():
+	return { name: repos[name].read_ref('HEAD') for name in repos }
+
+def token(heads):
+	data = json.dumps(heads, sort_keys = True).encode()
+	return hashlib.sha256(data).hexdigest()[:16]
+
+cond = threading.Condition()
+heads = read_heads()
+generation = token(heads)
+
+def watch():
+	global heads, generation
+	while True:
+		time.sleep(interval)
+		try:
+			current = read_heads()
+		except Exception as e:
+			log(f"repl_notify: failed to read heads: {e}")
+			continue
+		if current == heads:
+			continue
+		with cond:
+			heads = current
+			generation = token(heads)
+			cond.notify_all()
+
+def wait(since, timeout):
+	with cond:
+		if since is not None:
+			cond.wait_for(lambda: generation != since, timeout)
+		return { 'generation': generation, 'heads': heads }
+
+class Handler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		url = urlparse(self.path)
+		if url.path != '/v1/generation':
+			self.send_error(404)
+			return
+		query = parse_qs(url.query)
+		since = query.get('since', [ None ])[0]
+		try:
+			timeout = int(query.get('timeout', [ max_timeout ])[0])
+		except ValueError:
+			self.send_error(400)
+			return
+		timeout = min(max(timeout, 0), max_timeout)
+		body = json.dumps(wait(since, timeout), sort_keys = True).encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		log(f"repl_notify: {self.address_string()} {format % args}")
+
+log(f"repl_notify: starting, port={port}, repos={list(repos)}, "
+	f"generation={generation}")
+threading.Thread(target = watch, daemon = True).start()
+server = ThreadingHTTPServer(('', port), Handler)
+server.daemon_threads = True
+server.serve_forever()
@@ -31,24 +31,42 @@ def healthcheck():
 <h1>Healthcheck</h1>
 '''
 
+# Requests can be sent as JSON (which is what enrollsvc sends), ie. an object
+# with the same fields as the form version, except that 'params' (and
+# 'request_uids') are JSON values rather than strings of JSON. Or as form data
+# (which is what kdcsvc sends), where those fields are strings of JSON. This
+# returns the fields either way, with those ones parsed, or raises ValueError.
+def request_fields():
+    if request.is_json:
+        fields = request.get_json(silent = True)
+        if not isinstance(fields, dict):
+            raise ValueError("request body isn't a JSON object")
+        return fields
+    fields = request.form.to_dict()
+    for k in [ 'params', 'request_uids' ]:
+        if k in fields:
+            fields[k] = json.loads(fields[k])
+    return fields
+
 @app.route('/run', methods=['POST'])
 def my_common():
-    log(f"my_common: request.form={request.form}")
-    params = {}
-    if 'params' in request.form:
-        try:
-            params = json.loads(request.form['params'])
-        except ValueError:
-            return "Bad JSON input", 401
+    try:
+        fields = request_fields()
+    except ValueError:
+        return "Bad JSON input", 401
+    log(f"my_common: fields={fields}")
+    params = fields.get('params', {})
+    if not isinstance(params, dict):
+        return "Bad JSON input", 401
 
     # Before passing the request "params" through the policy filters, take the
     # extra information and embed it. This implies that the parameters cannot
     # have fields conflicting with any of these.
-    if 'hookname' in request.form:
-        hookname = request.form['hookname']
+    if 'hookname' in fields:
+        hookname = fields['hookname']
         params['hookname'] = hookname
-    if 'request_uid' in request.form:
-        request_uid = request.form['request_uid']
+    if 'request_uid' in fields:
+        request_uid = fields['request_uid']
         params['request_uid'] = request_uid
 
     # Both the policy and the input data need to be in string (JSON)
@@ -63,5 +81,43 @@ def my_common():
     print(f"ALLOW: {paramsjson} -> {policy_result}")
     return jsonify(params)
 
+# The batch version of '/run', for callers with many requests to check at once
+# (eg. bulk enrollment), JSON or form data (see request_fields()). 'params' is a
+# list of the individual requests' params, and 'request_uids' (optional) is a
+# list of their request_uids, in the same order. 'hookname' applies to all of
+# them. The response is always 200 (unless the input is malformed), with a
+# JSON body of the form
+# { "results": [ { "status": <code> }, ... ] }, where each status is what
+# '/run' would have returned for that request (200 or 403).
+@app.route('/run_batch', methods=['POST'])
+def my_batch():
+    try:
+        fields = request_fields()
+    except ValueError:
+        return "Bad JSON input", 401
+    log(f"my_batch: fields={fields}")
+    batch = fields.get('params', [])
+    uids = fields.get('request_uids', None)
+    if not isinstance(batch, list) or \
+            not all(isinstance(x, dict) for x in batch) or \
+            (uids is not None and len(uids) != len(batch)):
+        return "Bad batch input", 401
+    results = []
+    for i, params in enumerate(batch):
+        if 'hookname' in fields:
+            params['hookname'] = fields['hookname']
+        if uids is not None:
+            params['request_uid'] = uids[i]
+        paramsjson = json.dumps(params)
+        policy_result = HcpJsonPolicy.run(policyjson, params,
+                                          dataKeepsVars = True)
+        if policy_result['action'] != "accept":
+            print(f"REJECT: {paramsjson} -> {policy_result}")
+            results.append({ 'status': 403 })
+        else:
+            print(f"ALLOW: {paramsjson} -> {policy_result}")
+            results.append({ 'status': 200 })
+    return jsonify({ 'results': results })
+
 if __name__ == "__main__":
     app.run()
@@ -8,6 +8,10 @@
 #               -F profile=<profile> \
 #               <enrollsvc-URL>/v1/add
 #
+# add_bulk: curl -v -F entries='[{"ekpub":"ek1","hostname":"<hostname>"},...]' \
+#               -F ek1=@</path/to/ek.pub> ... \
+#               <enrollsvc-URL>/v1/add_bulk
+#
 # query:   curl -v -G -d ekpubhash=<hexstring> \
 #               <enrollsvc-URL>/v1/query
 #
@@ -17,10 +21,16 @@
 # reenroll: curl -v -F ekpubhash=<hexstring> \
 #               <enrollsvc-URL>/v1/reenroll
 #
+# (add and reenroll are asynchronous if '-F async=1' is added, in which case
+# the response contains a job 'id' to pass to 'job'. add_bulk is always
+# asynchronous.)
+#
+# job:     curl -v -G -d wait=<secs> <enrollsvc-URL>/v1/job/<id>
+#
 # find:    curl -v -G -d hostname_regex=<hostname_regex> \
 #               <enrollsvc-URL>/v1/find
 #
-# janitor: curl -v -G <enrollsvc-URL>/v1/janitor
+# janitor: curl -v -G [-d full=1] <enrollsvc-URL>/v1/janitor
 #
 # get-asset-signer:  curl -v -G <enrollsvc-URL>/v1/get-asset-signer
 
@@ -102,6 +112,68 @@ def requester_loop(args, request_fn):
 # They all return a 2-tuple of {result,json}, where result is True iff the
 # operation was successful.
 
+# How long each long-poll asks the server to wait (the server may cap it)
+job_longpoll = 60
+
+# The status code that means a job succeeded, by its 'op'
+job_success = { 'add': 201, 'reenroll': 201, 'add_bulk': 200 }
+
+# Polls an asynchronous job. With 'wait', this keeps long-polling until the
+# job is done, and then returns what the synchronous request would have
+# returned (if its status code was the one in 'job_success'). Otherwise it
+# returns the job's current state.
+def job_poll(args, jobid, wait):
+    url = args.api + '/v1/job/' + jobid
+    while True:
+        form_data = {}
+        if wait:
+            form_data['wait'] = job_longpoll
+        debug("'job' handler about to call API")
+        debug(f" - url: {url}")
+        myrequest = lambda: requests.get(url,
+                                params=form_data,
+                                auth=auth,
+                                verify=args.requests_verify,
+                                cert=args.requests_cert,
+                                timeout=args.timeout + job_longpoll)
+        response = requester_loop(args, myrequest)
+        debug(f" - response: {response}")
+        debug(f" - response.content: {response.content}")
+        if response.status_code != 200:
+            err(f"Error, 'job' response status code was {response.status_code}")
+            return False, None
+        try:
+            jr = json.loads(response.content)
+        except Exception as e:
+            err(f"Error, JSON decoding of 'job' response failed: {e}")
+            return False, None
+        debug(f" - jr: {jr}")
+        if not wait:
+            return True, jr
+        if jr['state'] == 'done':
+            break
+        log(f"job {jobid} is {jr['state']}, waiting")
+    if jr['http_status'] != job_success[jr['op']]:
+        err(f"Error, job {jobid} status code was {jr['http_status']}")
+        return False, None
+    return True, jr['result']
+
+# For 'add' and 'reenroll'. Returns the status code that means success, and
+# adds 'async' to the form if needed.
+def async_form(args, form_data):
+    if args.async_ or args.wait:
+        form_data['async'] = (None, '1')
+        return 202
+    return 201
+
+def async_result(args, jr):
+    if args.wait:
+        return job_poll(args, jr['id'], True)
+    return True, jr
+
+def enroll_job(args):
+    return job_poll(args, args.id, args.wait)
+
 def enroll_add(args):
     form_data = {
         'ekpub': ('ek.pub', open(args.ekpub, 'rb')),
@@ -109,6 +181,7 @@ def enroll_add(args):
     }
     if args.profile is not None:
         form_data['profile'] = (None, args.profile)
+    expect = async_form(args, form_data)
     debug("'add' handler about to call API")
     debug(f" - url: {args.api + '/v1/add'}")
     debug(f" - files: {form_data}")
@@ -121,7 +194,7 @@ def enroll_add(args):
     response = requester_loop(args, myrequest)
     debug(f" - response: {response}")
     debug(f" - response.content: {response.content}")
-    if response.status_code != 201:
+    if response.status_code != expect:
         err(f"Error, 'add' response status code was {response.status_code}")
         return False, None
     try:
@@ -130,10 +203,55 @@ def enroll_add(args):
         err(f"Error, JSON decoding of 'add' response failed: {e}")
         return False, None
     debug(f" - jr: {jr}")
+    return async_result(args, jr)
+
+def enroll_add_bulk(args):
+    manifest = json.load(open(args.manifest, 'r'))
+    entries = []
+    form_data = {}
+    for i, item in enumerate(manifest):
+        field = f"ekpub{i}"
+        entry = { 'ekpub': field, 'hostname': item['hostname'] }
+        if 'profile' in item:
+            entry['profile'] = item['profile']
+        entries.append(entry)
+        form_data[field] = ('ek.pub', open(item['ekpub'], 'rb'))
+    form_data['entries'] = (None, json.dumps(entries))
+    debug("'add_bulk' handler about to call API")
+    debug(f" - url: {args.api + '/v1/add_bulk'}")
+    debug(f" - entries: {entries}")
+    myrequest = lambda: requests.post(args.api + '/v1/add_bulk',
+                             files=form_data,
+                             auth=auth,
+                             verify=args.requests_verify,
+                             cert=args.requests_cert,
+                             timeout=args.timeout)
+    response = requester_loop(args, myrequest)
+    debug(f" - response: {response}")
+    debug(f" - response.content: {response.content}")
+    if response.status_code != 202:
+        err(f"Error, 'add_bulk' response status code was {response.status_code}")
+        return False, None
+    try:
+        jr = json.loads(response.content)
+    except Exception as e:
+        err(f"Error, JSON decoding of 'add_bulk' response failed: {e}")
+        return False, None
+    debug(f" - jr: {jr}")
+    if args.async_:
+        return True, jr
+    ok, jr = job_poll(args, jr['id'], True)
+    if not ok:
+        return False, None
+    failed = [ x for x in jr['entries'] if x['http_status'] != 201 ]
+    if failed:
+        err(f"Error, {len(failed)} of {len(jr['entries'])} entries failed")
+        return False, jr
     return True, jr
 
 def enroll_reenroll(args):
     form_data = { 'ekpubhash': (None, args.ekpubhash) }
+    expect = async_form(args, form_data)
     debug("'reenroll' handler about to call API")
     debug(f" - url: {args.api + '/v1/reenroll'}")
     debug(f" - files: {form_data}")
@@ -146,7 +264,7 @@ def enroll_reenroll(args):
     response = requester_loop(args, myrequest)
     debug(f" - response: {response}")
     debug(f" - response.content: {response.content}")
-    if response.status_code != 201:
+    if response.status_code != expect:
         err(f"Error, 'reenroll' response status code was {response.status_code}")
         return False, None
     try:
@@ -155,7 +273,7 @@ def enroll_reenroll(args):
         err(f"Error, JSON decoding of 'add' response failed: {e}")
         return False, None
     debug(f" - jr: {jr}")
-    return True, jr
+    return async_result(args, jr)
 
 def do_query_or_delete(args, is_delete):
     if is_delete:
@@ -205,8 +323,12 @@ def enroll_query(args):
 def enroll_delete(args):
     return do_query_or_delete(args, True)
 
-def enroll_find(args):
+def enroll_find_page(args, cursor):
     form_data = { 'hostname_regex': args.hostname_regex }
+    if cursor:
+        form_data['cursor'] = cursor
+    if args.limit:
+        form_data['limit'] = args.limit
     debug("'find' handler about to call API")
     debug(f" - url: {args.api + '/v1/find'}")
     debug(f" - files: {form_data}")
@@ -230,10 +352,36 @@ def enroll_find(args):
     debug(f" - jr: {jr}")
     return True, jr
 
+# The server paginates 'find' results. If the caller asked for a specific page
+# (--cursor) or page size (--limit), we return just that page, including its
+# 'next_cursor' (if any). Otherwise we follow the cursors and return all the
+# results together, as though they came back in one response.
+def enroll_find(args):
+    if args.cursor or args.limit:
+        return enroll_find_page(args, args.cursor)
+    result = None
+    cursor = None
+    while True:
+        ok, jr = enroll_find_page(args, cursor)
+        if not ok:
+            return False, None
+        cursor = jr.pop('next_cursor', None)
+        if result:
+            result['entries'] += jr['entries']
+        else:
+            result = jr
+        if not cursor:
+            return True, result
+
 def enroll_janitor(args):
     debug("'janitor' handler about to call API")
     debug(f" - url: {args.api + '/v1/janitor'}")
+    form_data = {}
+    if args.full:
+        form_data['full'] = 1
+    debug(f" - form_data: {form_data}")
     myrequest = lambda: requests.get(args.api + '/v1/janitor',
+                            params=form_data,
                             auth=auth,
                             verify=args.requests_verify,
                             cert=args.requests_cert,
@@ -330,6 +478,9 @@ if __name__ == '__main__':
 
     # Subcommand details
 
+    async_help = 'return a job id as soon as the request is queued (see \'job\')'
+    async_help_wait = 'submit asynchronously, then poll the job until it is done'
+
     add_help = 'Enroll a {TPM,hostname} 2-tuple'
     add_epilog = """
     The 'add' subcommand invokes the '/v1/add' handler of the Enrollment Service's
@@ -340,6 +491,11 @@ if __name__ == '__main__':
     confused with the '--api' argument, which provides a URL to the Enrollment
     Service! Control over the enrollment, including the set of assets desired and
     configuration for it, is passed as a JSON string via the --profile argument.
+    With '--async', the service queues the enrollment and returns a job id
+    straight away, which can be passed to the 'job' subcommand to get the
+    outcome. '--wait' does the same and then polls the job until it is done,
+    so the result is the same as without either option, but no single HTTP
+    request has to stay open for the whole enrollment.
     """
     add_help_ekpub = 'path to the public key file for the TPM\'s Endorsement Key'
     add_help_hostname = 'hostname to be enrolled with (and bound to) the TPM'
@@ -348,8 +504,34 @@ if __name__ == '__main__':
     parser_a.add_argument('ekpub', help=add_help_ekpub)
     parser_a.add_argument('hostname', help=add_help_hostname)
     parser_a.add_argument('--profile', help=add_help_profile, required=False)
+    parser_a.add_argument('--async', dest='async_', action='store_true',
+                          help=async_help)
+    parser_a.add_argument('--wait', action='store_true', help=async_help_wait)
     parser_a.set_defaults(func=enroll_add)
 
+    add_bulk_help = 'Enroll many {TPM,hostname} 2-tuples in one request'
+    add_bulk_epilog = """
+    The 'add_bulk' subcommand invokes the '/v1/add_bulk' handler of the
+    Enrollment Service's management API, to enroll many TPM+hostname 2-tuples
+    at once. The manifest is a JSON file containing a list of entries, each of
+    the form {"ekpub": "<path>", "hostname": "<hostname>", "profile": {...}}
+    (where "profile" is optional), with the same meanings as the arguments to
+    'add'. The service generates the enrollments in parallel and commits them
+    together, which is much faster than one 'add' per entry. The service runs
+    them as a job (see 'job'), which this polls until it is done, unless
+    '--async' is given. The output has an outcome for each entry, in the same
+    order, each with its own 'http_status' (201 meaning success). A failed
+    entry doesn't prevent the others from succeeding, but this command exits
+    non-zero if any failed.
+    """
+    add_bulk_help_manifest = 'path to the JSON manifest of entries to enroll'
+    parser_ab = subparsers.add_parser('add_bulk', help=add_bulk_help,
+                                      epilog=add_bulk_epilog)
+    parser_ab.add_argument('manifest', help=add_bulk_help_manifest)
+    parser_ab.add_argument('--async', dest='async_', action='store_true',
+                           help=async_help)
+    parser_ab.set_defaults(func=enroll_add_bulk)
+
     reenroll_help = 'Re-enroll a TPM/host based on hash(EKpub)'
     reenroll_epilog = """
     The 'reenroll' subcommand invokes the '/v1/reenroll' handler of the Enrollment
@@ -358,8 +540,28 @@ if __name__ == '__main__':
     reenroll_help_ekpubhash = 'hexidecimal "ekpubhash" of the TPM'
     parser_d = subparsers.add_parser('reenroll', help=reenroll_help, epilog=reenroll_epilog)
     parser_d.add_argument('ekpubhash', help=reenroll_help_ekpubhash)
+    parser_d.add_argument('--async', dest='async_', action='store_true',
+                          help=async_help)
+    parser_d.add_argument('--wait', action='store_true', help=async_help_wait)
     parser_d.set_defaults(func=enroll_reenroll)
 
+    job_help = "Get the state of an asynchronous 'add', 'reenroll', or 'add_bulk'"
+    job_epilog = """
+    The 'job' subcommand invokes the '/v1/job' handler of the Enrollment
+    Service's management API, to get the state of a job returned by 'add',
+    'reenroll', or 'add_bulk' with '--async'. Without '--wait', the job's
+    state is returned as-is ('queued', 'running', or 'done', along with the
+    result if it's done). With '--wait', it long-polls until the job is done,
+    and returns the result of the 'add', 'reenroll', or 'add_bulk', as though
+    it had not been asynchronous.
+    """
+    job_help_id = "the job 'id' returned by 'add', 'reenroll', or 'add_bulk'"
+    job_help_wait = 'poll until the job is done, and return its result'
+    parser_jb = subparsers.add_parser('job', help=job_help, epilog=job_epilog)
+    parser_jb.add_argument('id', help=job_help_id)
+    parser_jb.add_argument('--wait', action='store_true', help=job_help_wait)
+    parser_jb.set_defaults(func=enroll_job)
+
     query_help = 'Query (and list) enrollments based on prefix-search of hash(EKpub)'
     query_epilog = """
     The 'query' subcommand invokes the '/v1/query' handler of the Enrollment
@@ -406,22 +608,38 @@ if __name__ == '__main__':
     Note, the array returned from this command consists of solely of 'ekpubhash'
     values for matching enrollments. To obtain details about the matching entries
     (including the hostnames that matched), subsequent API calls (using 'query')
-    should be performed using the 'ekpubhash' fields.
+    should be performed using the 'ekpubhash' fields. The server returns results
+    a page at a time. By default all pages are retrieved and returned together,
+    but '--limit' and '--cursor' can be used to walk through the pages one at a
+    time. Regular expressions anchored with a literal prefix (eg. '^web') or a
+    literal suffix (eg. '\\.hcphacking\\.xyz$') are much cheaper for the
+    server to process than unanchored ones.
     """
     find_help_regex = 'hostname regular expression'
+    find_help_cursor = "return the page following this cursor (from 'next_cursor')"
+    find_help_limit = 'return (at most) this many entries, plus a cursor for the rest'
     parser_f = subparsers.add_parser('find', help=find_help, epilog=find_epilog)
     parser_f.add_argument('hostname_regex', help=find_help_regex)
+    parser_f.add_argument('--cursor', metavar='<cursor>', default=None,
+                          help=find_help_cursor)
+    parser_f.add_argument('--limit', type=int, metavar='<num>', default=None,
+                          help=find_help_limit)
     parser_f.set_defaults(func=enroll_find)
 
-    janitor_help = 'Scrub the enrollment DB to fix known issues, and rebuild hn2ek'
+    janitor_help = 'Scrub the enrollment DB to fix known issues, and fix up hn2ek'
     janitor_epilog = """
     The 'janitor' subcommand invokes the '/v1/janitor' handler of the Enrollment
     Service's management API, to clean up known glitches that may be present in the
     enrollment DB (usually created by enrollment bugs
-    that have since been fixed). It also rebuilds the reverse-lookup table, hn2ek,
-    from first principles.
+    that have since been fixed). It also makes sure the reverse-lookup table, hn2ek,
+    agrees with the enrollments. By default, only the entries that changed since
+    the janitor last ran are checked. With '--full', every entry is checked, and
+    hn2ek is also purged of entries that have no enrollment. The output reports
+    how many entries were scanned and how many were fixed.
     """
+    janitor_help_full = 'check every entry, not just those changed since the last run'
     parser_j = subparsers.add_parser('janitor', help=janitor_help, epilog=janitor_epilog)
+    parser_j.add_argument('--full', action='store_true', help=janitor_help_full)
     parser_j.set_defaults(func=enroll_janitor)
 
     getAssetSigner_help = 'Retrieve trust anchor for asset-signing'
@@ -39,6 +39,8 @@ myapp = webapi_param('app', str, required = True)
 myappcfg = webapi_param('config', str)
 myharakiri = webapi_param('harakiri', int, default = 600)
 myclienttimeout = webapi_param('clienttimeout', int, default = 600)
+myprocesses = webapi_param('processes', int, default = 2)
+mythreads = webapi_param('threads', int, default = 2)
 myenv = webapi_param('uwsgi_env', dict, default = {})
 myuid = webapi_param('uwsgi_uid', str, default = 'www-data')
 mygid = webapi_param('uwsgi_gid', str, default = 'www-data')
@@ -198,8 +200,8 @@ h.hlog(1, f"Producing uwsgi config: {etcuwsgi}")
 with open(etcuwsgi, 'w') as fp:
 	fp.write('''[uwsgi]
 master = true
-processes = 2
-threads = 2
+processes = {myprocesses}
+threads = {mythreads}
 uid = {myuid}
 gid = {mygid}
 wsgi-file = {myapp}
@@ -207,7 +209,8 @@ callable = app
 die-on-term = true
 route-if = equal:\${{PATH_INFO}};/healthcheck donotlog:
 harakiri = {myharakiri}
-'''.format(myuid = myuid, mygid = mygid, myapp = myapp, myharakiri = myharakiri))
+'''.format(myuid = myuid, mygid = mygid, myapp = myapp, myharakiri = myharakiri,
+		myprocesses = myprocesses, mythreads = mythreads))
 	for k in myenv:
 		fp.write(f"env = {k}={myenv[k]}\n")
 	if myhttps:
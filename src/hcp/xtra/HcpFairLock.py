@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import fcntl
+import glob
+import weakref
+
+# A fair (FIFO) inter-process mutex, built out of flock(2) on files in a lock
+# directory. It's a file-system take on the CLH queue lock;
+#
+# - 'ticket' is a counter. Taking a ticket is done under a (very short-lived)
+#   exclusive flock on that file, so tickets are handed out in arrival order.
+# - Each contender creates 'queue/<ticket>', exclusively flock()d _before_ it
+#   gets renamed into place, so nobody ever sees it unlocked while its owner
+#   is alive. The file contains JSON metadata about the owner (pid, when it
+#   queued, when it acquired).
+# - Each contender then blocks in flock(LOCK_SH) on its predecessor's file.
+#   The kernel wakes it the moment the predecessor lets go, no polling.
+# - To release, the holder unlinks its file and then closes it.
+#
+# If a process dies, the kernel drops its flock() for us, so a crashed
+# holder (or waiter) can't wedge the queue. Its successor can tell the
+# difference between a clean release and a death, because the file is still
+# linked in the latter case. If that was a waiter, the stale file gets
+# removed and the successor waits on whoever was in front of the dead one. If
+# it was the holder, the new holder inherits the lock with 'stale_holder' set
+# to the dead holder's metadata, so that the caller can roll back whatever was
+# left half-done before proceeding.
+#
+# flock()s belong to the open file (not the process), so a child that fork()s
+# (without exec()ing) would inherit our queue file and keep it locked after we
+# release it. To stop that, children close their copies straight after fork.
+#
+# Lock-wait and hold-time are accumulated into 'stats.json' (updated under the
+# ticket lock, on release).
+
+class HcpFairLockError(Exception):
+	pass
+
+def _now():
+	return time.time()
+
+def _read_json(path):
+	try:
+		with open(path, 'r') as f:
+			return json.load(f)
+	except (FileNotFoundError, json.JSONDecodeError):
+		return None
+
+_instances = weakref.WeakSet()
+
+def _after_fork_in_child():
+	for lock in list(_instances):
+		if lock.fd is not None:
+			os.close(lock.fd)
+			lock.fd = None
+			lock.path = None
+
+os.register_at_fork(after_in_child = _after_fork_in_child)
+
+class FairLock:
+	def __init__(self, lockdir):
+		self.lockdir = lockdir
+		self.queuedir = f"{lockdir}/queue"
+		self.ticketpath = f"{lockdir}/ticket"
+		self.statspath = f"{lockdir}/stats.json"
+		os.makedirs(self.queuedir, exist_ok = True)
+		self.fd = None
+		self.path = None
+		self.meta = None
+		self.stale_holder = None
+		self.wait_time = None
+		self.hold_time = None
+		_instances.add(self)
+
+	def _ticket_lock(self):
+		fd = os.open(self.ticketpath, os.O_RDWR | os.O_CREAT, 0o644)
+		fcntl.flock(fd, fcntl.LOCK_EX)
+		return fd
+
+	def _write_meta(self):
+		data = json.dumps(self.meta).encode()
+		os.ftruncate(self.fd, 0)
+		os.pwrite(self.fd, data, 0)
+
+	# Returns the sorted list of (ticket, path) currently in the queue.
+	def queue(self):
+		result = []
+		for p in glob.glob(f"{self.queuedir}/*"):
+			name = os.path.basename(p)
+			if name.isdigit():
+				result.append((int(name), p))
+		result.sort()
+		return result
+
+	def acquire(self):
+		if self.fd is not None:
+			raise HcpFairLockError(f"already holding {self.lockdir}")
+		t_queued = _now()
+		self.stale_holder = None
+		tfd = self._ticket_lock()
+		try:
+			raw = os.pread(tfd, 64, 0).strip()
+			ticket = int(raw) if raw else 0
+			tmppath = f"{self.queuedir}/.tmp-{os.getpid()}-{ticket}"
+			fd = os.open(tmppath, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+					0o644)
+			fcntl.flock(fd, fcntl.LOCK_EX)
+			self.fd = fd
+			self.path = f"{self.queuedir}/{ticket:016d}"
+			self.meta = { 'pid': os.getpid(), 'ticket': ticket,
+					'queued': t_queued }
+			self._write_meta()
+			os.rename(tmppath, self.path)
+			os.ftruncate(tfd, 0)
+			os.pwrite(tfd, f"{ticket + 1}\n".encode(), 0)
+		finally:
+			os.close(tfd)
+		# Wait on whoever is in front of us, until there's nobody.
+		while True:
+			ahead = [ x for x in self.queue() if x[0] < ticket ]
+			if not ahead:
+				break
+			_, pred = ahead[-1]
+			try:
+				pfd = os.open(pred, os.O_RDONLY)
+			except FileNotFoundError:
+				# Released between listing and opening
+				continue
+			try:
+				fcntl.flock(pfd, fcntl.LOCK_SH)
+				if os.fstat(pfd).st_nlink == 0:
+					# Clean release
+					continue
+				# The owner died without releasing.
+				meta = _read_json(pred)
+				if meta is None or 'acquired' in meta:
+					self.stale_holder = meta or {}
+				try:
+					os.unlink(pred)
+				except FileNotFoundError:
+					pass
+			finally:
+				os.close(pfd)
+		self.meta['acquired'] = _now()
+		self._write_meta()
+		self.wait_time = self.meta['acquired'] - t_queued
+
+	def release(self):
+		if self.fd is None:
+			raise HcpFairLockError(f"not holding {self.lockdir}")
+		self.hold_time = _now() - self.meta['acquired']
+		os.unlink(self.path)
+		os.close(self.fd)
+		self.fd = None
+		self.path = None
+		self._update_stats()
+
+	def _update_stats(self):
+		tfd = self._ticket_lock()
+		try:
+			stats = _read_json(self.statspath) or {
+				'acquisitions': 0,
+				'stale_recoveries': 0,
+				'wait_total': 0.0,
+				'wait_max': 0.0,
+				'hold_total': 0.0,
+				'hold_max': 0.0
+			}
+			stats['acquisitions'] += 1
+			if self.stale_holder is not None:
+				stats['stale_recoveries'] += 1
+			stats['wait_total'] += self.wait_time
+			stats['wait_max'] = max(stats['wait_max'], self.wait_time)
+			stats['hold_total'] += self.hold_time
+			stats['hold_max'] = max(stats['hold_max'], self.hold_time)
+			stats['last'] = {
+				'pid': self.meta['pid'],
+				'acquired': self.meta['acquired'],
+				'wait': self.wait_time,
+				'hold': self.hold_time
+			}
+			tmppath = f"{self.statspath}.tmp"
+			with open(tmppath, 'w') as f:
+				json.dump(stats, f, sort_keys = True)
+			os.rename(tmppath, self.statspath)
+		finally:
+			os.close(tfd)
+
+	# Operator helpers. These don't require (or take) the lock.
+
+	# Returns a list of dicts, one per queue entry (in order), with the
+	# owner's metadata and whether or not its owner is still 'alive'. The
+	# first live entry with 'acquired' set is the holder.
+	def status(self):
+		result = []
+		for ticket, path in self.queue():
+			entry = _read_json(path) or {}
+			entry['ticket'] = ticket
+			entry['alive'] = self._is_alive(path)
+			result.append(entry)
+		return result
+
+	def stats(self):
+		return _read_json(self.statspath)
+
+	def _is_alive(self, path):
+		try:
+			fd = os.open(path, os.O_RDONLY)
+		except FileNotFoundError:
+			return False
+		try:
+			fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+			return False
+		except BlockingIOError:
+			return True
+		finally:
+			os.close(fd)
+
+	# Removes temp files left behind by processes that died while queueing
+	# (between creating their file and renaming it into the queue). Dead
+	# entries in the queue itself are cleaned up by whoever is queued behind
+	# them, and a dead holder's entry is deliberately left for the next
+	# acquirer, so that it knows to recover (see 'stale_holder').
+	def cleanup(self):
+		removed = []
+		for path in glob.glob(f"{self.queuedir}/.tmp-*"):
+			if self._is_alive(path):
+				continue
+			try:
+				os.unlink(path)
+				removed.append(path)
+			except FileNotFoundError:
+				pass
+		return removed
@@ -0,0 +1,764 @@
+import os
+import zlib
+import mmap
+import glob
+import time
+import struct
+import hashlib
+import tempfile
+import heapq
+import threading
+
+# A minimal, dependency-free reader for git object databases. The enrollment
+# DB is a git repo, and HCP treats the most recent commit as the authoritative
+# "snapshot" of the DB. Reading that snapshot straight out of the object store
+# (rather than from the working tree, or by spawning 'git' processes) means
+# readers see a consistent view without taking the repo lock: objects are
+# immutable once written, and git only ever moves a ref atomically, after all
+# the objects it points to are in place.
+#
+# Only what HCP needs is supported: SHA-1 repos, loose objects, and packs (idx
+# v1/v2, with OFS_DELTA and REF_DELTA entries). Notably, 'alternates' aren't
+# supported.
+#
+# There's also a writer side, so that a commit can be made without spawning
+# 'git' (several times) and without git scanning the working tree. Objects are
+# written loose, exactly as git writes them, refs are updated with git's own
+# lock-file protocol (and reflog), and the index is patched in place. The
+# result is indistinguishable from what 'git commit' would have produced, so
+# clones and fetches (eg. by attestsvc's updater_loop.sh) see no difference.
+
+class HcpGitRepoError(Exception):
+	pass
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+type_names = { OBJ_COMMIT: 'commit', OBJ_TREE: 'tree', OBJ_BLOB: 'blob',
+		OBJ_TAG: 'tag' }
+
+MODE_TREE = '40000'
+MODE_FILE = '100644'
+MODE_EXEC = '100755'
+MODE_LINK = '120000'
+
+def _zlib_inflate_at(buf, pos):
+	d = zlib.decompressobj()
+	out = []
+	chunk = 65536
+	while not d.eof:
+		data = buf[pos:pos + chunk]
+		if len(data) == 0:
+			raise HcpGitRepoError("truncated zlib stream in pack")
+		out.append(d.decompress(data))
+		pos += chunk
+	return b''.join(out)
+
+def _delta_varint(delta, pos):
+	result = 0
+	shift = 0
+	while True:
+		c = delta[pos]
+		pos += 1
+		result |= (c & 0x7f) << shift
+		shift += 7
+		if not c & 0x80:
+			return result, pos
+
+def _delta_apply(base, delta):
+	src_size, pos = _delta_varint(delta, 0)
+	if src_size != len(base):
+		raise HcpGitRepoError("delta base size mismatch")
+	dst_size, pos = _delta_varint(delta, pos)
+	out = bytearray()
+	while pos < len(delta):
+		op = delta[pos]
+		pos += 1
+		if op & 0x80:
+			offset = 0
+			size = 0
+			for i in range(4):
+				if op & (1 << i):
+					offset |= delta[pos] << (8 * i)
+					pos += 1
+			for i in range(3):
+				if op & (0x10 << i):
+					size |= delta[pos] << (8 * i)
+					pos += 1
+			if size == 0:
+				size = 0x10000
+			out += base[offset:offset + size]
+		elif op:
+			out += delta[pos:pos + op]
+			pos += op
+		else:
+			raise HcpGitRepoError("invalid delta opcode")
+	if len(out) != dst_size:
+		raise HcpGitRepoError("delta result size mismatch")
+	return bytes(out)
+
+class _Pack:
+	def __init__(self, idxpath):
+		self.idxpath = idxpath
+		self.packpath = idxpath[:-4] + '.pack'
+		with open(idxpath, 'rb') as f:
+			self.idx = f.read()
+		with open(self.packpath, 'rb') as f:
+			self.pack = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		if self.idx[:4] == b'\377tOc':
+			if struct.unpack('>I', self.idx[4:8])[0] != 2:
+				raise HcpGitRepoError(f"unsupported idx: {idxpath}")
+			self.version = 2
+			self.fanout = struct.unpack('>256I', self.idx[8:8 + 1024])
+			self.nr = self.fanout[255]
+			self.sha_base = 8 + 1024
+			self.ofs_base = self.sha_base + 24 * self.nr
+			self.big_base = self.ofs_base + 4 * self.nr
+		else:
+			self.version = 1
+			self.fanout = struct.unpack('>256I', self.idx[:1024])
+			self.nr = self.fanout[255]
+
+	def _sha_at(self, i):
+		if self.version == 2:
+			p = self.sha_base + 20 * i
+			return self.idx[p:p + 20]
+		p = 1024 + 24 * i + 4
+		return self.idx[p:p + 20]
+
+	def _offset_at(self, i):
+		if self.version == 2:
+			p = self.ofs_base + 4 * i
+			ofs = struct.unpack('>I', self.idx[p:p + 4])[0]
+			if ofs & 0x80000000:
+				p = self.big_base + 8 * (ofs & 0x7fffffff)
+				ofs = struct.unpack('>Q', self.idx[p:p + 8])[0]
+			return ofs
+		p = 1024 + 24 * i
+		return struct.unpack('>I', self.idx[p:p + 4])[0]
+
+	def find(self, binsha):
+		first = binsha[0]
+		lo = self.fanout[first - 1] if first > 0 else 0
+		hi = self.fanout[first]
+		while lo < hi:
+			mid = (lo + hi) // 2
+			s = self._sha_at(mid)
+			if s < binsha:
+				lo = mid + 1
+			elif s > binsha:
+				hi = mid
+			else:
+				return self._offset_at(mid)
+		return None
+
+	def shas(self):
+		for i in range(self.nr):
+			yield self._sha_at(i).hex()
+
+class GitRepo:
+	def __init__(self, path):
+		if os.path.isdir(f"{path}/.git"):
+			path = f"{path}/.git"
+		if not os.path.isdir(f"{path}/objects"):
+			raise HcpGitRepoError(f"not a git repo: {path}")
+		self.gitdir = path
+		self.objdir = f"{path}/objects"
+		self.packs = {}
+		self.lock = threading.Lock()
+		self._scan_packs()
+
+	def _scan_packs(self):
+		with self.lock:
+			current = set(glob.glob(f"{self.objdir}/pack/pack-*.idx"))
+			for p in list(self.packs):
+				if p not in current:
+					# Other threads may still be reading from
+					# it, so let garbage-collection close it.
+					self.packs.pop(p)
+			for p in current:
+				if p not in self.packs:
+					try:
+						self.packs[p] = _Pack(p)
+					except FileNotFoundError:
+						# Raced with a repack
+						pass
+
+	# Refs
+
+	def read_ref(self, name = 'HEAD'):
+		for _ in range(10):
+			path = f"{self.gitdir}/{name}"
+			try:
+				with open(path, 'r') as f:
+					v = f.read().strip()
+			except FileNotFoundError:
+				v = self._packed_ref(name)
+				if not v:
+					return None
+			if v.startswith('ref: '):
+				name = v[5:]
+				continue
+			return v
+		raise HcpGitRepoError(f"symbolic ref loop: {name}")
+
+	def _packed_ref(self, name):
+		try:
+			with open(f"{self.gitdir}/packed-refs", 'r') as f:
+				for line in f:
+					if line.startswith('#') or line.startswith('^'):
+						continue
+					parts = line.strip().split(' ', 1)
+					if len(parts) == 2 and parts[1] == name:
+						return parts[0]
+		except FileNotFoundError:
+			pass
+		return None
+
+	# Objects
+
+	def _read_loose(self, sha):
+		path = f"{self.objdir}/{sha[:2]}/{sha[2:]}"
+		try:
+			with open(path, 'rb') as f:
+				raw = zlib.decompress(f.read())
+		except FileNotFoundError:
+			return None
+		nul = raw.index(b'\0')
+		kind, size = raw[:nul].split(b' ')
+		data = raw[nul + 1:]
+		if int(size) != len(data):
+			raise HcpGitRepoError(f"corrupt loose object: {sha}")
+		return kind.decode(), data
+
+	def _read_packed(self, pack, offset):
+		buf = pack.pack
+		c = buf[offset]
+		pos = offset + 1
+		kind = (c >> 4) & 7
+		size = c & 0x0f
+		shift = 4
+		while c & 0x80:
+			c = buf[pos]
+			pos += 1
+			size |= (c & 0x7f) << shift
+			shift += 7
+		if kind == OBJ_OFS_DELTA:
+			c = buf[pos]
+			pos += 1
+			rel = c & 0x7f
+			while c & 0x80:
+				c = buf[pos]
+				pos += 1
+				rel = ((rel + 1) << 7) | (c & 0x7f)
+			basekind, base = self._read_packed(pack, offset - rel)
+			return basekind, _delta_apply(base, _zlib_inflate_at(buf, pos))
+		if kind == OBJ_REF_DELTA:
+			basesha = buf[pos:pos + 20].hex()
+			pos += 20
+			basekind, base = self.read_object(basesha)
+			return basekind, _delta_apply(base, _zlib_inflate_at(buf, pos))
+		if kind not in type_names:
+			raise HcpGitRepoError(f"bad pack entry type {kind}")
+		data = _zlib_inflate_at(buf, pos)
+		if len(data) != size:
+			raise HcpGitRepoError("pack entry size mismatch")
+		return type_names[kind], data
+
+	def _find_packed(self, sha):
+		binsha = bytes.fromhex(sha)
+		for pack in list(self.packs.values()):
+			offset = pack.find(binsha)
+			if offset is not None:
+				return self._read_packed(pack, offset)
+		return None
+
+	# Returns a 2-tuple of type ('commit', 'tree', 'blob', 'tag') and data
+	# (bytes). If the object can't be found, we rescan the packs once
+	# before giving up, in case a repack/gc moved it out from under us.
+	def read_object(self, sha):
+		for attempt in range(2):
+			obj = self._read_loose(sha)
+			if obj:
+				return obj
+			obj = self._find_packed(sha)
+			if obj:
+				return obj
+			self._scan_packs()
+		raise HcpGitRepoError(f"object not found: {sha}")
+
+	def has_object(self, sha):
+		if os.path.exists(f"{self.objdir}/{sha[:2]}/{sha[2:]}"):
+			return True
+		binsha = bytes.fromhex(sha)
+		for pack in list(self.packs.values()):
+			if pack.find(binsha) is not None:
+				return True
+		return False
+
+	def read_typed(self, sha, kind):
+		k, data = self.read_object(sha)
+		if k != kind:
+			raise HcpGitRepoError(f"{sha} is a {k}, not a {kind}")
+		return data
+
+	def read_blob(self, sha):
+		return self.read_typed(sha, 'blob')
+
+	# Returns a dict of the commit headers, 'tree' (str), 'parents' (list),
+	# and the message, as 'message'.
+	def read_commit(self, sha):
+		data = self.read_typed(sha, 'commit').decode()
+		header, _, message = data.partition('\n\n')
+		result = { 'parents': [], 'message': message }
+		for line in header.split('\n'):
+			if line.startswith(' '):
+				# Continuation (eg. gpgsig), not something we use
+				continue
+			k, _, v = line.partition(' ')
+			if k == 'parent':
+				result['parents'].append(v)
+			else:
+				result[k] = v
+		return result
+
+	# Returns a list of (mode, name, sha) 3-tuples, in tree order. 'mode'
+	# is the octal string as git stores it, so subtrees are '40000'.
+	def read_tree(self, sha):
+		data = self.read_typed(sha, 'tree')
+		entries = []
+		pos = 0
+		while pos < len(data):
+			sp = data.index(b' ', pos)
+			nul = data.index(b'\0', sp)
+			mode = data[pos:sp].decode()
+			name = data[sp + 1:nul].decode()
+			entries.append((mode, name, data[nul + 1:nul + 21].hex()))
+			pos = nul + 21
+		return entries
+
+	# Walks 'path' (a '/'-separated string, relative to the tree) and returns
+	# the (mode, sha) 2-tuple of what it names, or None.
+	def tree_lookup(self, tree_sha, path):
+		mode = MODE_TREE
+		sha = tree_sha
+		for name in [ p for p in path.split('/') if p ]:
+			if mode != MODE_TREE:
+				return None
+			for emode, ename, esha in self.read_tree(sha):
+				if ename == name:
+					mode, sha = emode, esha
+					break
+			else:
+				return None
+		return mode, sha
+
+	def commit_tree(self, commit_sha):
+		return self.read_commit(commit_sha)['tree']
+
+	# Writer
+
+	def write_object(self, kind, data):
+		raw = f"{kind} {len(data)}\0".encode() + data
+		sha = hashlib.sha1(raw).hexdigest()
+		path = f"{self.objdir}/{sha[:2]}/{sha[2:]}"
+		if self.has_object(sha):
+			return sha
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		# A unique temp name (as git does), as other threads or
+		# processes may be writing the same object at the same time.
+		fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path),
+				prefix = 'tmp_obj_')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(zlib.compress(raw))
+			os.chmod(tmp, 0o444)
+			os.rename(tmp, path)
+		except Exception:
+			try:
+				os.unlink(tmp)
+			except FileNotFoundError:
+				pass
+			raise
+		return sha
+
+	def write_blob(self, data):
+		return self.write_object('blob', data)
+
+	# 'entries' is a list of (mode, name, sha) 3-tuples, in any order.
+	def write_tree(self, entries):
+		def order(e):
+			mode, name, _ = e
+			name = name.encode()
+			return name + b'/' if mode == MODE_TREE else name
+		data = b''.join(f"{mode} {name}\0".encode() + bytes.fromhex(sha)
+				for mode, name, sha in sorted(entries, key = order))
+		return self.write_object('tree', data)
+
+	def write_commit(self, tree, parents, message):
+		ident = self.identity()
+		lines = [ f"tree {tree}" ]
+		lines += [ f"parent {p}" for p in parents ]
+		lines += [ f"author {ident}", f"committer {ident}", '', message ]
+		data = '\n'.join(lines)
+		if not data.endswith('\n'):
+			data += '\n'
+		return self.write_object('commit', data.encode())
+
+	# Writes whatever is at 'path' in the working tree (file, symlink, or
+	# directory, recursively) as blobs and trees, and returns its (mode,
+	# sha), or None if there's nothing to write (it doesn't exist, or it's
+	# a directory with no files in it - git doesn't track those). If
+	# 'stats' is given, (relpath, mode, sha, stat_result) gets appended to
+	# it for each file, which is what update_index() wants.
+	def write_path(self, path, stats = None, relpath = None):
+		try:
+			st = os.lstat(path)
+		except FileNotFoundError:
+			return None
+		if os.path.islink(path):
+			mode = MODE_LINK
+			sha = self.write_blob(os.readlink(path).encode())
+		elif os.path.isdir(path):
+			entries = []
+			for name in os.listdir(path):
+				rel = f"{relpath}/{name}" if relpath else name
+				x = self.write_path(f"{path}/{name}", stats, rel)
+				if x:
+					entries.append((x[0], name, x[1]))
+			if not entries:
+				return None
+			return MODE_TREE, self.write_tree(entries)
+		else:
+			mode = MODE_EXEC if st.st_mode & 0o100 else MODE_FILE
+			with open(path, 'rb') as f:
+				sha = self.write_blob(f.read())
+		if stats is not None:
+			stats.append((relpath, mode, sha, st))
+		return mode, sha
+
+	# Returns a new tree, derived from 'tree_sha' (which can be None, for
+	# an empty tree) with 'changes' applied. 'changes' maps paths to a
+	# (mode, sha) 2-tuple, or to None for removal. Only the subtrees on
+	# the way to each change are read and rewritten, everything else is
+	# shared with the original tree. Returns None if the result is empty.
+	def update_tree(self, tree_sha, changes):
+		entries = {}
+		if tree_sha:
+			entries = { name: (mode, sha) for mode, name, sha in
+					self.read_tree(tree_sha) }
+		sub = {}
+		for path, v in changes.items():
+			head, _, rest = path.strip('/').partition('/')
+			if rest:
+				sub.setdefault(head, {})[rest] = v
+			elif v is None:
+				entries.pop(head, None)
+			else:
+				entries[head] = v
+		for head, subchanges in sub.items():
+			cur = entries.get(head)
+			base = cur[1] if cur and cur[0] == MODE_TREE else None
+			new = self.update_tree(base, subchanges)
+			if new:
+				entries[head] = (MODE_TREE, new)
+			else:
+				entries.pop(head, None)
+		if not entries:
+			return None
+		return self.write_tree([ (mode, name, sha) for name, (mode, sha) in
+				entries.items() ])
+
+	def _config_get(self, section, key):
+		value = None
+		for path in [ os.path.expanduser('~/.gitconfig'),
+				f"{self.gitdir}/config" ]:
+			try:
+				with open(path, 'r') as f:
+					lines = f.readlines()
+			except FileNotFoundError:
+				continue
+			current = None
+			for line in lines:
+				line = line.strip()
+				if not line or line[0] in '#;':
+					continue
+				if line.startswith('['):
+					current = line[1:line.index(']')].strip().lower()
+					continue
+				k, _, v = line.partition('=')
+				if current == section and k.strip().lower() == key:
+					value = v.strip().strip('"')
+		return value
+
+	# The "name <email> timestamp tz" string for commits and reflogs, from
+	# the usual git env-vars or config.
+	def identity(self):
+		name = os.environ.get('GIT_COMMITTER_NAME',
+				self._config_get('user', 'name'))
+		email = os.environ.get('GIT_COMMITTER_EMAIL',
+				self._config_get('user', 'email'))
+		if not name or not email:
+			raise HcpGitRepoError("no git user.name/user.email configured")
+		now = int(time.time())
+		off = time.localtime(now).tm_gmtoff // 60
+		sign = '-' if off < 0 else '+'
+		off = abs(off)
+		return f"{name} <{email}> {now} {sign}{off // 60:02d}{off % 60:02d}"
+
+	# Resolves symbolic refs, so 'HEAD' returns eg. 'refs/heads/master'.
+	def resolve_ref_name(self, name = 'HEAD'):
+		for _ in range(10):
+			try:
+				with open(f"{self.gitdir}/{name}", 'r') as f:
+					v = f.read().strip()
+			except FileNotFoundError:
+				return name
+			if not v.startswith('ref: '):
+				return name
+			name = v[5:]
+		raise HcpGitRepoError(f"symbolic ref loop: {name}")
+
+	# Atomically moves ref 'name' from 'old' to 'new', using git's lock-file
+	# protocol, so this is safe against concurrent git processes too. Fails
+	# if the ref isn't currently 'old'. Appends to the reflogs if they
+	# exist (as they do by default in non-bare repos).
+	def update_ref(self, name, new, old, message):
+		target = self.resolve_ref_name(name)
+		path = f"{self.gitdir}/{target}"
+		lockpath = f"{path}.lock"
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		try:
+			fd = os.open(lockpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+					0o644)
+		except FileExistsError:
+			raise HcpGitRepoError(f"ref is locked: {lockpath}")
+		try:
+			current = self.read_ref(target)
+			if current != old:
+				raise HcpGitRepoError(
+					f"{target} is {current}, expected {old}")
+			os.write(fd, f"{new}\n".encode())
+			os.fsync(fd)
+			os.close(fd)
+			fd = None
+			os.rename(lockpath, path)
+		except Exception:
+			if fd is not None:
+				os.close(fd)
+			os.unlink(lockpath)
+			raise
+		entry = f"{old} {new} {self.identity()}\t{message}\n"
+		for log in set([ name, target ]):
+			logpath = f"{self.gitdir}/logs/{log}"
+			if os.path.exists(logpath):
+				with open(logpath, 'a') as f:
+					f.write(entry)
+
+	# git's own heuristic for 'gc --auto' (more than gc.auto/256 loose
+	# objects in objects/17), so callers that write objects themselves can
+	# decide when it's worth running git's housekeeping.
+	def needs_gc(self, limit = 6700):
+		try:
+			n = len(os.listdir(f"{self.objdir}/17"))
+		except FileNotFoundError:
+			return False
+		return n > (limit + 255) // 256
+
+	# Patches the index (the staging area) so that it matches a commit made
+	# via update_tree(), without git re-scanning the working tree. Every
+	# entry under (or equal to) a path in 'removed' is dropped, and the
+	# entries in 'added' ((path, mode, sha, stat_result) 4-tuples, as
+	# produced by write_path(), each of which must be under one of the
+	# 'removed' paths) are inserted. Only index versions 2 and 3 without
+	# mandatory extensions are handled (optional extensions, like the
+	# cache-tree, are simply dropped and git rebuilds them when it needs
+	# to). Returns False if the index can't be handled this way, and the
+	# caller should fall back to 'git reset -q'.
+	#
+	# The index has an entry for every file in the repo, so rather than
+	# parse all of them, we jump (with find()) to the directory of each
+	# change and only parse and rewrite that window, copying the rest of the
+	# index verbatim. That needs to know where the entries end and the
+	# extensions begin, which we only know for sure if the index is one we
+	# wrote (we write no extensions), so we remember its checksum. If git
+	# has rewritten the index since, we do a full pass (once).
+	def update_index(self, removed, added):
+		path = f"{self.gitdir}/index"
+		markerpath = f"{self.gitdir}/hcp-index"
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+		except FileNotFoundError:
+			return False
+		if data[:4] != b'DIRC':
+			return False
+		version, count = struct.unpack('>II', data[4:12])
+		if version not in (2, 3):
+			return False
+		removed = sorted(set(p.strip('/').encode() for p in removed))
+		new = { p: [] for p in removed }
+		for name, mode, sha, st in added:
+			name = name.encode()
+			for p in removed:
+				if name == p or name.startswith(p + b'/'):
+					new[p].append((name, _index_entry_pack(name,
+								mode, sha, st)))
+					break
+			else:
+				raise HcpGitRepoError(f"not under a removed path: {name}")
+		for p in removed:
+			new[p].sort()
+		out = None
+		try:
+			with open(markerpath, 'r') as f:
+				ours = (f.read().strip() == data[-20:].hex())
+		except FileNotFoundError:
+			ours = False
+		if ours:
+			out = _index_patch(data, len(data) - 20, count, removed, new)
+		if out is None:
+			out = _index_rewrite(data, count, removed, new)
+		if out is None:
+			return False
+		out = out + hashlib.sha1(out).digest()
+		lockpath = f"{path}.lock"
+		try:
+			fd = os.open(lockpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+					0o644)
+		except FileExistsError:
+			return False
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(out)
+			os.rename(lockpath, path)
+		except Exception:
+			os.unlink(lockpath)
+			raise
+		with open(f"{markerpath}.tmp", 'w') as f:
+			f.write(out[-20:].hex())
+		os.rename(f"{markerpath}.tmp", markerpath)
+		return True
+
+# Index helpers (see GitRepo.update_index()). Entries start at offset 12, and
+# are all a multiple of 8 bytes long.
+
+def _index_entry_at(data, pos):
+	flags = struct.unpack_from('>H', data, pos + 60)[0]
+	off = 64 if flags & 0x4000 else 62
+	namelen = flags & 0xfff
+	if namelen == 0xfff:
+		namelen = data.index(b'\0', pos + off) - (pos + off)
+	return data[pos + off:pos + off + namelen], (off + namelen + 8) & ~7
+
+def _index_entry_pack(name, mode, sha, st):
+	m = lambda x: int(x) & 0xffffffff
+	ent = struct.pack('>10I', m(st.st_ctime), st.st_ctime_ns % 10**9,
+			m(st.st_mtime), st.st_mtime_ns % 10**9,
+			m(st.st_dev), m(st.st_ino), int(mode, 8),
+			m(st.st_uid), m(st.st_gid), m(st.st_size))
+	ent += bytes.fromhex(sha)
+	ent += struct.pack('>H', min(len(name), 0xfff)) + name
+	return ent + b'\0' * (8 - (len(ent) % 8))
+
+# Returns the offset of the first entry (at or after 'pos') whose name starts
+# with 'prefix', or None. find() might match inside some other field, so
+# candidates have to be where an entry's name would start.
+def _index_find_prefix(data, pos, end, prefix):
+	q = data.find(prefix, pos, end)
+	while q != -1:
+		for off in (62, 64):
+			start = q - off
+			if start < pos or (start - 12) % 8:
+				continue
+			flags = struct.unpack_from('>H', data, start + 60)[0]
+			if (64 if flags & 0x4000 else 62) != off:
+				continue
+			name, _ = _index_entry_at(data, start)
+			if name.startswith(prefix):
+				return start
+		q = data.find(prefix, q + 1, end)
+	return None
+
+# Returns the offset of the first entry whose name is >= 'name'. We jump to
+# the first entry of the outermost enclosing directory, then (searching only
+# from there) to the next one in, and so on, then to the first entry starting
+# with 'name' itself, stopping at the first level that has no entries. Then
+# scan forward from the closest point found.
+def _index_seek(data, end, name):
+	parts = name.split(b'/')
+	candidates = [ b'/'.join(parts[:i]) + b'/' for i in
+			range(1, len(parts)) ] + [ name ]
+	pos = 12
+	for prefix in candidates:
+		q = _index_find_prefix(data, pos, end, prefix)
+		if q is None:
+			break
+		pos = q
+	while pos < end:
+		n, entlen = _index_entry_at(data, pos)
+		if n >= name:
+			break
+		pos += entlen
+	return pos
+
+# Patch just the windows of the index around each path in 'removed'. Each
+# window runs from the first entry >= the path, to the first entry >= the path
+# followed by '0' (the character after '/'), and is parsed, filtered, and
+# merged with the new entries. Returns None if the windows overlap.
+def _index_patch(data, end, count, removed, new):
+	windows = []
+	for p in removed:
+		start = _index_seek(data, end, p)
+		stop_name = p + b'0'
+		kept = []
+		pos = start
+		while pos < end:
+			name, entlen = _index_entry_at(data, pos)
+			if name >= stop_name:
+				break
+			if name == p or name.startswith(p + b'/'):
+				count -= 1
+			else:
+				kept.append((name, data[pos:pos + entlen]))
+			pos += entlen
+		count += len(new[p])
+		merged = b''.join(e[1] for e in heapq.merge(kept, new[p]))
+		windows.append((start, pos, p, merged))
+	windows.sort()
+	out = [ b'DIRC', data[4:8], struct.pack('>I', count) ]
+	pos = 12
+	for start, stop, _, merged in windows:
+		if start < pos:
+			return None
+		out += [ data[pos:start], merged ]
+		pos = stop
+	out.append(data[pos:end])
+	return b''.join(out)
+
+# The full pass, parsing every entry. Returns None if there's a mandatory
+# extension.
+def _index_rewrite(data, count, removed, new):
+	prefixes = tuple(p + b'/' for p in removed)
+	removed_set = set(removed)
+	kept = []
+	pos = 12
+	for _ in range(count):
+		name, entlen = _index_entry_at(data, pos)
+		if name not in removed_set and not name.startswith(prefixes):
+			kept.append((name, data[pos:pos + entlen]))
+		pos += entlen
+	while pos < len(data) - 20:
+		sig = data[pos:pos + 4]
+		if not (65 <= sig[0] <= 90):
+			# Mandatory extension (eg. split-index)
+			return None
+		size = struct.unpack_from('>I', data, pos + 4)[0]
+		pos += 8 + size
+	added = sorted(e for p in removed for e in new[p])
+	merged = list(heapq.merge(kept, added))
+	return b'DIRC' + data[4:8] + struct.pack('>I', len(merged)) + \
+		b''.join(e[1] for e in merged)
@@ -0,0 +1,94 @@
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# A client for talking to one of our own services (eg. the policy-checker)
+# from a process that makes many requests to it, possibly from several threads
+# at once (eg. the enroll_worker, or the reenroller's batches);
+#
+# - One requests.Session, so connections are pooled and kept alive, rather
+#   than connecting (and tearing down) per request.
+# - Explicit connect and read timeouts, so a hung server fails the request
+#   rather than hanging the caller forever.
+# - Bounded retries, with exponential backoff, for connection failures and
+#   for the statuses that mean "try again" (502, 503, 504). The requests we
+#   make this way are side-effect free (asking the policy-checker for a
+#   verdict), so that includes POSTs.
+# - A circuit breaker. After 'threshold' consecutive failures (once retries
+#   are exhausted), the circuit "opens" and requests fail immediately (with
+#   HcpHttpCircuitOpen) for 'cooldown' seconds, rather than every caller
+#   piling up behind the timeouts of a server that's down. After that, one
+#   request is let through to test the water ("half-open"), and the circuit
+#   closes again if it succeeds.
+#
+# Failures here mean the request didn't get a response (or got one of the
+# retryable 5xx statuses, after retrying). Any other response, eg. a 403 from
+# the policy-checker, is a perfectly good answer and is returned to the caller.
+
+class HcpHttpCircuitOpen(Exception):
+	pass
+
+class Client:
+	def __init__(self, base_url, *, connect_timeout = 3.05,
+			read_timeout = 30, retries = 3, backoff = 0.25,
+			threshold = 5, cooldown = 30, pool = 16):
+		self.base_url = base_url.rstrip('/')
+		self.timeout = (connect_timeout, read_timeout)
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.lock = threading.Lock()
+		self.failures = 0
+		self.opened = None
+		self.probing = False
+		retry = Retry(total = retries, connect = retries, read = retries,
+			status = retries, backoff_factor = backoff,
+			status_forcelist = [ 502, 503, 504 ],
+			allowed_methods = frozenset([ 'GET', 'POST' ]),
+			raise_on_status = False)
+		adapter = HTTPAdapter(max_retries = retry,
+			pool_connections = 1, pool_maxsize = pool)
+		self.session = requests.Session()
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+	def _admit(self):
+		with self.lock:
+			if self.opened is None:
+				return
+			if time.monotonic() - self.opened < self.cooldown or \
+					self.probing:
+				raise HcpHttpCircuitOpen(
+					f"circuit open for {self.base_url}")
+			self.probing = True
+
+	def _result(self, ok):
+		with self.lock:
+			self.probing = False
+			if ok:
+				self.failures = 0
+				self.opened = None
+				return
+			self.failures += 1
+			if self.opened is not None or \
+					self.failures >= self.threshold:
+				self.opened = time.monotonic()
+
+	# Whatever happens (including exceptions that aren't RequestExceptions),
+	# _result() gets called, or a half-open circuit would stay 'probing', and
+	# so stay open, forever.
+	def request(self, method, path, **kwargs):
+		self._admit()
+		ok = False
+		try:
+			response = self.session.request(method,
+				f"{self.base_url}{path}",
+				timeout = self.timeout, **kwargs)
+			ok = response.status_code not in [ 502, 503, 504 ]
+		finally:
+			self._result(ok)
+		return response
+
+	def post_json(self, path, body):
+		return self.request('POST', path, json = body)
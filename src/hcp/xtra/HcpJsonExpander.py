@@ -52,7 +52,12 @@ def vars_merge_files(ctxvars, ctxfiles, currentpath):
 # non-string-valued vars (eg. "key": [ 0, "whatever", null ]), we only
 # intervene if the _entire_ string is "{key}", in which case we return
 # immediately with the (non-string-valued) value.
+#
+# Nothing can match unless there's a "{" somewhere in the string, and most
+# strings don't have one, so those are returned without looking at the vars.
 def vars_expandstring(ctxvars, s):
+    if '{' not in s:
+        return s
     for k in ctxvars:
         v = ctxvars[k]
         if isinstance(v, str):
@@ -210,6 +215,48 @@ def process_obj(ctxvars, obj, currentpath = '.',
                         varskey = varskey, fileskey = fileskey)
     return newobj
 
+# process_obj(), for the case where there are no vars or files sections to
+# accumulate as we descend (varskey = fileskey = None), so the vars are the same
+# at every level. process_obj() still self-expands them at every dict it
+# visits, which for a large object and lots of vars is most of the cost. Here
+# we self-expand once, up front, and recurse with the result. That's only the
+# same thing if the self-expansion reached a fixed point (otherwise, ie. if the
+# vars reference each other cyclically, every re-self-expansion changes them
+# some more), so if it didn't, we hand over to process_obj().
+def expand_obj(ctxvars, obj, currentpath = '.'):
+    if isinstance(obj, dict):
+        ctxvars = vars_selfexpand(ctxvars, currentpath)
+        if vars_expand(ctxvars, ctxvars, currentpath) == ctxvars:
+            return _expand_obj(ctxvars, obj, currentpath)
+    return process_obj(ctxvars, obj, currentpath,
+                varskey = None, fileskey = None)
+
+def _expand_obj(ctxvars, obj, currentpath):
+    if isinstance(obj, dict):
+        newobj = {}
+        for k in obj:
+            v = obj[k]
+            newk = vars_expandstring(ctxvars, k)
+            if currentpath == '.':
+                newpath = f".{newk}"
+            else:
+                newpath = f"{currentpath}.{newk}"
+            newv = _expand_obj(ctxvars, v, newpath)
+            try:
+                newobj[newk] = newv
+            except Exception as e:
+                es = f"failed substitution, path={newpath}, key={newk}: {e}"
+                raise HcpJsonExpanderError(es)
+        return newobj
+    if isinstance(obj, list):
+        newpath = f"{currentpath}[]"
+        return [ _expand_obj(ctxvars, v, newpath) for v in obj ]
+    newobj = vars_expand(ctxvars, obj, currentpath)
+    # The same pivot as in process_obj()
+    if isinstance(obj, str) and type(newobj) != str:
+        newobj = _expand_obj(ctxvars, newobj, currentpath)
+    return newobj
+
 def _load(obj, varskey = default_varskey, fileskey = default_fileskey,
             retainkeys = default_retainkeys):
     ctxvars = {}
@@ -0,0 +1,127 @@
+import os
+import re
+import time
+import subprocess
+from uuid import uuid4
+
+# A pool of pre-generated private keys, so that whatever needs a fresh key (eg.
+# gencert-hxtool, for each host cert it issues) can take one that's ready,
+# rather than generating it on the spot. The pool is a directory with a
+# sub-directory per kind of key, named "<algorithm>-<parameter>";
+#   rsa-<bits>      eg. rsa-2048
+#   ec-<curve>      eg. ec-prime256v1
+# holding one PEM file per key. The keys are in the "traditional" PEM forms
+# ("RSA PRIVATE KEY", "EC PRIVATE KEY") rather than PKCS#8, as those are what
+# hxtool itself writes its keys in, so they're what it is sure to read back
+# (via --certificate-private-key=FILE:<path>). The keys are as sensitive as
+# any other secret, so the pool is only accessible to its owner (directories
+# are 0700, keys are 0600).
+#
+# Keys are written to a temp name and renamed into place, so they're only
+# visible once they're complete. Taking a key is renaming it to ".claimed-*",
+# which only one taker can succeed at, so no key is ever handed out twice. The
+# taker uses the key and then release()s it (which removes it). If a taker
+# dies before that, gc() removes it later. Keys are never reused.
+
+class HcpKeyPoolError(Exception):
+	pass
+
+kind_prog = re.compile('(rsa-[0-9]+|ec-[a-zA-Z0-9_-]+)')
+
+def genpkey_args(kind):
+	if not kind_prog.fullmatch(kind):
+		raise HcpKeyPoolError(f"unknown kind of key: {kind}")
+	alg, _, param = kind.partition('-')
+	if alg == 'rsa':
+		return [ '-algorithm', 'RSA', '-pkeyopt', f"rsa_keygen_bits:{param}" ]
+	return [ '-algorithm', 'EC', '-pkeyopt', f"ec_paramgen_curve:{param}" ]
+
+class KeyPool:
+	def __init__(self, path):
+		self.path = path
+
+	def kind_dir(self, kind):
+		return f"{self.path}/{kind}"
+
+	def keys(self, kind):
+		try:
+			return [ x for x in os.listdir(self.kind_dir(kind))
+				if not x.startswith('.') ]
+		except FileNotFoundError:
+			return []
+
+	def count(self, kind):
+		return len(self.keys(kind))
+
+	# Returns the path of a key of the given kind, which is now the
+	# caller's, or None if the pool has none. The claimed key's mtime is the
+	# time of the claim (rather than when it was generated), as that's what
+	# gc() goes by.
+	def claim(self, kind):
+		d = self.kind_dir(kind)
+		for name in self.keys(kind):
+			claimed = f"{d}/.claimed-{name}"
+			try:
+				os.rename(f"{d}/{name}", claimed)
+				os.utime(claimed)
+			except FileNotFoundError:
+				# Someone else got there first (or gc() did, if
+				# it ran between the two)
+				continue
+			return claimed
+		return None
+
+	def release(self, claimed):
+		try:
+			os.unlink(claimed)
+		except FileNotFoundError:
+			pass
+
+	# Generates one key of the given kind into the pool.
+	def generate(self, kind):
+		args = genpkey_args(kind)
+		d = self.kind_dir(kind)
+		os.makedirs(d, mode = 0o700, exist_ok = True)
+		name = f"{uuid4().hex}.pem"
+		tmp = f"{d}/.tmp-{name}"
+		fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+		try:
+			# genpkey writes PKCS#8, 'pkey -traditional' converts it
+			g = subprocess.Popen([ 'openssl', 'genpkey' ] + args,
+				stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+			c = subprocess.run([ 'openssl', 'pkey', '-traditional' ],
+				stdin = g.stdout, stdout = fd,
+				stderr = subprocess.PIPE, text = True)
+			g.stdout.close()
+			g_stderr = g.stderr.read().decode()
+			g.stderr.close()
+			g.wait()
+		finally:
+			os.close(fd)
+		if g.returncode != 0 or c.returncode != 0:
+			os.unlink(tmp)
+			raise HcpKeyPoolError(f"openssl genpkey failed for {kind}: "
+				f"{g_stderr.strip()} {c.stderr.strip()}")
+		os.rename(tmp, f"{d}/{name}")
+
+	# Removes claimed keys (whose takers must have died) and partial ones
+	# (ditto, for generators) that are older than 'max_age' seconds.
+	# Returns how many were removed.
+	def gc(self, max_age):
+		removed = 0
+		now = time.time()
+		for kind in os.listdir(self.path):
+			d = self.kind_dir(kind)
+			if not os.path.isdir(d):
+				continue
+			for name in os.listdir(d):
+				if not name.startswith(('.claimed-', '.tmp-')):
+					continue
+				try:
+					if now - os.lstat(f"{d}/{name}").st_mtime > \
+							max_age:
+						os.unlink(f"{d}/{name}")
+						removed += 1
+				except FileNotFoundError:
+					pass
+		return removed
@@ -1,5 +1,8 @@
 import subprocess
 import sys
+import re
+import base64
+import binascii
 
 # This is just a holding pen for miscellaneous utilities that deal with PEM
 # files and "openssl x509" and what-not.
@@ -11,6 +14,27 @@ class HcpPemError(Exception):
 def pem_clean(s):
 	return s.strip().replace('\t', '')
 
+# Re-encodes a PEM block of type 'label' in canonical form (as openssl writes
+# it), ie. the base64 wrapped at 64 columns, '\n' line-endings, and nothing
+# before or after the block. Returns None if 'data' (bytes) isn't one such
+# block (give or take whitespace).
+pem_prog = re.compile(rb'\s*-----BEGIN ([A-Z0-9 ]+)-----([A-Za-z0-9+/=\s]+)' +
+			rb'-----END \1-----\s*')
+
+def pem_normalize(data, label = 'PUBLIC KEY'):
+	m = pem_prog.fullmatch(data)
+	if not m or m.group(1) != label.encode():
+		return None
+	try:
+		der = base64.b64decode(re.sub(rb'\s', b'', m.group(2)),
+					validate = True)
+	except binascii.Error:
+		return None
+	b64 = base64.b64encode(der)
+	lines = [ b64[i:i + 64] + b'\n' for i in range(0, len(b64), 64) ]
+	return f"-----BEGIN {label}-----\n".encode() + b''.join(lines) + \
+		f"-----END {label}-----\n".encode()
+
 baseargs = [ 'openssl', 'x509', '-inform', 'PEM', '-noout' ]
 
 def get_email_address(s):
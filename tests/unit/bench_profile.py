@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+# Micro-benchmark for building enrollment profiles (enrollsvc/db_add.py's
+# build_profile(), and the prepared_profile() cache it uses). This needs the
+# enrollsvc code (ie. /hcp) but nothing else;
+#     python3 bench_profile.py [N]
+# It checks that profiles built from the cache are the same as expanding the
+# whole merged profile for the enrollment (which is what build_profile() did
+# before there was a cache), for a few client profiles, including one whose
+# vars can't be prepared, and that each is a new object. It then reports the
+# time per build_profile() with the cache cold (as in a one-off 'db_add.py'
+# process) and warm (as in the enroll_worker, which runs its jobs in-process),
+# and the time to expand the whole profile, and fails if the warm cache isn't
+# at least twice as fast as the cold one. For comparison, it also reports the
+# time to start a process that imports db_add, which the in-process worker no
+# longer pays per job either.
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import copy
+
+N = 2000
+if len(sys.argv) > 1:
+	N = int(sys.argv[1])
+
+scratch = tempfile.mkdtemp()
+cfg = f"{scratch}/bench_profile.json"
+with open(cfg, 'w') as f:
+	json.dump({ 'enrollsvc': { 'state': f"{scratch}/state" } }, f)
+os.environ['HCP_CONFIG_FILE'] = cfg
+os.environ['HCP_NOTRACEFILE'] = '1'
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_add
+from HcpRecursiveUnion import union
+import HcpJsonExpander
+
+# Shaped like the 'preclient' in usecase/emgmt.json
+db_add.serverprofile_pre = {
+	'__env': {
+		'ENROLL_ISSUERCERT': '/usr/share/ca-certificates/{ENROLL_ID}/certissuer.pem',
+		'ENROLL_CERTPREFIX': 'hostcert-',
+		'ENROLL_KDC': 'secondary.kdc',
+		'ENROLL_KDC_PORT': '3088',
+		'ENROLL_REALM': 'HCPHACKING.XYZ',
+		'ENROLL_CERTDIR': '{ENROLL_ISSUERCERT}.d/{ENROLL_CERTPREFIX}'
+	},
+	'genprogs': 'gencert-hxtool genkrb5keytab genconf-krb5',
+	'gencert-hxtool': {
+		'list': [ 'default-https-hostclient', 'default-https-server' ],
+		'prefix': '{ENROLL_CERTPREFIX}',
+		'<common>': {
+			'generate-key': 'rsa',
+			'key-bits': '2048',
+			'lifetime': '1d'
+		},
+		'default-pkinit-iprop': {
+			'type': 'pkinit-client',
+			'pk-init-principal': 'iprop/{ENROLL_HOSTNAME}@{ENROLL_REALM}',
+			'subject': 'CN=iprop,{ENROLL_HOSTNAME2DC}'
+		},
+		'default-https-server': {
+			'type': 'https-server',
+			'hostname': '{ENROLL_HOSTNAME}'
+		},
+		'default-https-hostclient': {
+			'type': 'https-client',
+			'subject': 'UID=host,{ENROLL_HOSTNAME2DC}',
+			'hostname': '{ENROLL_HOSTNAME}',
+			'issuer': '{ENROLL_ISSUERCERT}',
+			'dir': '{ENROLL_CERTDIR}'
+		}
+	},
+	'genkrb5keytab': {
+		'kdcsvc': 'http://primary.kdc.hcphacking.xyz:9090',
+		'principals': [ 'host/{ENROLL_HOSTNAME}' ]
+	},
+	'genconf-krb5': {
+		'libdefaults': {
+			'default_realm': '{ENROLL_REALM}',
+			'dns_lookup_kdc': 'no'
+		},
+		'realms': {
+			'{ENROLL_REALM}': {
+				'kdc': '{ENROLL_KDC}:{ENROLL_KDC_PORT}'
+			}
+		}
+	}
+}
+db_add.serverprofile_post = { '__env': { 'ENROLL_DOMAIN': 'hcphacking.xyz' } }
+for x in [ 'signing_key_dir', 'signing_key_pub', 'signing_key_priv',
+		'gencert_ca_dir', 'gencert_ca_cert', 'gencert_ca_priv' ]:
+	setattr(db_add, x, f"/nowhere/{x}")
+
+def enrollment(i, clientjson = '{}'):
+	return {
+		'z': 'bench',
+		'op': 'add',
+		'hostname': f"host{i}.hcphacking.xyz",
+		'clientjson': clientjson
+	}
+
+# The profile as build_profile() made it before there was a cache: the whole
+# merged profile, expanded with the enrollment's '__env'.
+def reference(e):
+	body = union(union(db_add.serverprofile_pre, e['clientdata']),
+		db_add.serverprofile_post)
+	body.pop('__env', None)
+	return HcpJsonExpander.expand_obj(e['profile']['__env'], body)
+
+def built(e):
+	return { k: v for k, v in e['profile'].items()
+		if k not in [ '__env', 'final_genprogs' ] }
+
+def fail(msg):
+	print(f"FAIL: {msg}")
+	sys.exit(1)
+
+clients = [
+	'{}',
+	json.dumps({ '__env': { 'ENROLL_KDC': 'other.kdc' } }),
+	json.dumps({ '__env': { 'ENROLL_DOMAIN': 'elsewhere.xyz' },
+		'genkrb5keytab': { 'principals': [ 'HTTP/{ENROLL_ID}' ] } }),
+	json.dumps({ '__env': { 'LOOP1': '{LOOP2}', 'LOOP2': 'x{LOOP1}' } })
+]
+db_add.prepared_profiles.clear()
+for c in clients:
+	for i in range(3):
+		e = enrollment(i, c)
+		db_add.build_profile(e)
+		if built(e) != reference(e):
+			fail(f"{c}: profile for host{i} differs from the reference")
+		# Modifying the result mustn't affect what's cached
+		saved = copy.deepcopy(e['profile'])
+		e['profile']['gencert-hxtool']['list'].append('modified')
+		e['profile']['genconf-krb5']['realms'].clear()
+		e2 = enrollment(i, c)
+		db_add.build_profile(e2)
+		if e2['profile'] != saved:
+			fail(f"{c}: profile for host{i} shares objects with the cache")
+	prepared = db_add.prepared_profile(json.loads(c))
+	print(f"{c} -> ok, {'prepared' if prepared['text'] else 'not prepared'}")
+
+def bench(cold):
+	db_add.prepared_profiles.clear()
+	t = time.monotonic()
+	for i in range(N):
+		if cold:
+			db_add.prepared_profiles.clear()
+		db_add.build_profile(enrollment(i))
+	return (time.monotonic() - t) / N * 1e6
+
+def bench_reference():
+	e = enrollment(0)
+	db_add.build_profile(e)
+	t = time.monotonic()
+	for i in range(N):
+		reference(e)
+	return (time.monotonic() - t) / N * 1e6
+
+cold = bench(True)
+warm = bench(False)
+full = bench_reference()
+print(f"build_profile -> cold cache {cold:.1f}us, warm cache {warm:.1f}us "
+	f"(expanding the whole profile alone takes {full:.1f}us)")
+if warm * 2 > cold:
+	fail("the warm cache isn't twice as fast as the cold one")
+
+runs = 5
+t = time.monotonic()
+for i in range(runs):
+	subprocess.run([ sys.executable, '-c',
+		"import sys; sys.path.insert(1, '/hcp/enrollsvc'); import db_add" ],
+		check = True)
+startup = (time.monotonic() - t) / runs * 1e3
+print(f"process start-up and import -> {startup:.1f}ms")
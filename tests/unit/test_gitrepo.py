@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+# HcpGitRepo (xtra/HcpGitRepo.py), against scratch repos made by git itself.
+# This needs xtra/ (ie. /hcp/xtra) and git, nothing else;
+#     python3 test_gitrepo.py
+# It checks that;
+#  - every object (loose, packed, and deltified) reads back exactly as
+#    'git cat-file' has it.
+#  - commits made the way db_common.git_commit() makes them (write_path(),
+#    update_tree(), write_commit(), update_ref(), update_index()) add, modify,
+#    and delete what they should, and leave 'git status' and
+#    'git fsck --strict' clean, whether update_index() patches the index or
+#    has to rewrite it.
+#  - many threads writing the same objects at once all succeed.
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import threading
+
+sys.path.insert(1, '/hcp/xtra')
+import HcpGitRepo
+
+scratch = tempfile.mkdtemp()
+repo = f"{scratch}/repo"
+os.environ['GIT_COMMITTER_NAME'] = 'test_gitrepo'
+os.environ['GIT_COMMITTER_EMAIL'] = 'do-not-reply@nowhere.special'
+os.environ['GIT_AUTHOR_NAME'] = 'test_gitrepo'
+os.environ['GIT_AUTHOR_EMAIL'] = 'do-not-reply@nowhere.special'
+
+def git(*args, data = None):
+	return subprocess.run([ 'git', '-C', repo ] + list(args), check = True,
+			input = data, stdout = subprocess.PIPE).stdout
+
+def fail(msg):
+	print(f"FAIL: {msg}")
+	sys.exit(1)
+
+def write(rel, data, mode = 0o644):
+	path = f"{repo}/{rel}"
+	os.makedirs(os.path.dirname(path), exist_ok = True)
+	with open(path, 'w') as f:
+		f.write(data)
+	os.chmod(path, mode)
+
+# Each entry gets a ply of its own
+def entry(n):
+	h = f"{n:02x}" * 32
+	return f"ekpubhash/{h[:2]}/{h[:6]}/{h[:32]}"
+
+def add_entry(n):
+	write(f"{entry(n)}/ek.pub", f"ekpub {n}\n")
+	write(f"{entry(n)}/hostname", f"host{n}.example.com\n")
+
+# A repo with history, some of it packed (with deltas: 'big' changes a little
+# in each commit) and some of it loose.
+os.makedirs(repo)
+git('init', '-q')
+big = ''.join(f"line {i}\n" for i in range(2000))
+for c in range(6):
+	for n in range(c * 5, c * 5 + 5):
+		add_entry(n)
+	big = big.replace(f"line {c}\n", f"line {c} changed\n")
+	write('big', big)
+	write('hn2ek', f"[ {c} ]\n")
+	git('add', '-A', '.')
+	git('commit', '-q', '-m', f"commit {c}")
+	if c == 3:
+		git('gc', '-q', '--aggressive')
+os.symlink('big', f"{repo}/link")
+write('tool', '#!/bin/sh\n', 0o755)
+git('add', '-A', '.')
+git('commit', '-q', '-m', 'loose')
+
+r = HcpGitRepo.GitRepo(repo)
+objects = git('rev-list', '--objects', '--all').decode().split('\n')
+objects = [ x.split()[0] for x in objects if x ]
+for sha in objects:
+	kind, data = r.read_object(sha)
+	if kind != git('cat-file', '-t', sha).decode().strip():
+		fail(f"{sha}: kind {kind}")
+	if data != git('cat-file', kind, sha):
+		fail(f"{sha}: data differs")
+print(f"read -> {len(objects)} objects match")
+
+# The same as db_common.git_commit(), with 'paths'
+def commit(paths, msg):
+	head = r.read_ref('HEAD')
+	changes = {}
+	removed = []
+	added = []
+	for rel in paths:
+		removed.append(rel)
+		changes[rel] = r.write_path(f"{repo}/{rel}", added, rel)
+	tree = r.update_tree(r.commit_tree(head), changes)
+	commit = r.write_commit(tree, [ head ], msg)
+	r.update_ref('HEAD', commit, head, f"commit: {msg}")
+	if not r.update_index(removed, added):
+		fail(f"{msg}: index not patchable")
+
+def check(msg, expected):
+	status = git('status', '--porcelain', '--untracked-files=all').decode()
+	if status:
+		fail(f"{msg}: status not clean: {status}")
+	git('fsck', '--strict', '--no-progress')
+	changed = git('diff-tree', '-r', '--name-status', 'HEAD~', 'HEAD')
+	changed = set(tuple(x.split('\t')) for x in
+			changed.decode().split('\n') if x)
+	if changed != expected:
+		fail(f"{msg}: changed {sorted(changed)}, "
+			f"expected {sorted(expected)}")
+	print(f"{msg} -> ok")
+
+def files(n, status):
+	return { (status, f"{entry(n)}/ek.pub"),
+		(status, f"{entry(n)}/hostname") }
+
+# Adds, in a new ply and in existing ones
+add_entry(100)
+add_entry(101)
+commit([ entry(100), entry(101) ], 'add')
+check('add', files(100, 'A') | files(101, 'A'))
+
+# Modifications, including the executable bit
+write('hn2ek', "[ 'modified' ]\n")
+write('big', big + 'more\n', 0o755)
+commit([ 'hn2ek', 'big' ], 'modify')
+check('modify', { ('M', 'hn2ek'), ('M', 'big') })
+
+# Deletions, including the last entry in its ply (whose directories go too)
+shutil.rmtree(f"{repo}/ekpubhash/{100:02x}")
+shutil.rmtree(f"{repo}/{entry(3)}")
+commit([ entry(100), entry(3) ], 'delete')
+check('delete', files(100, 'D') | files(3, 'D'))
+
+# All three at once, twice in a row (so the second patches the index that
+# the first one wrote, without git touching it in between)
+add_entry(102)
+write('hn2ek', "[ 'again' ]\n")
+shutil.rmtree(f"{repo}/{entry(4)}")
+commit([ entry(102), 'hn2ek', entry(4) ], 'mixed')
+add_entry(103)
+commit([ entry(103) ], 'mixed again')
+check('mixed again', files(103, 'A'))
+
+# An index that git wrote last (so update_index() can't patch it)
+git('update-index', '--force-write-index')
+os.unlink(f"{repo}/.git/hcp-index")
+shutil.rmtree(f"{repo}/{entry(5)}")
+add_entry(104)
+commit([ entry(5), entry(104) ], 'rewrite')
+check('rewrite', files(5, 'D') | files(104, 'A'))
+
+# Lots of threads writing the same (and some different) objects at once
+errors = []
+def writer(i):
+	try:
+		for j in range(50):
+			r.write_blob(f"same {j}\n".encode())
+			r.write_blob(f"thread {i} {j}\n".encode())
+	except Exception as e:
+		errors.append(e)
+threads = [ threading.Thread(target = writer, args = (i,)) for i in range(16) ]
+for t in threads:
+	t.start()
+for t in threads:
+	t.join()
+if errors:
+	fail(f"concurrent writes: {errors[0]!r}")
+leftovers = [ x for x in os.listdir(f"{repo}/.git/objects")
+	if x != 'pack' and x != 'info'
+	for y in os.listdir(f"{repo}/.git/objects/{x}") if y.startswith('tmp') ]
+if leftovers:
+	fail(f"concurrent writes left {leftovers}")
+git('fsck', '--strict', '--no-progress')
+print("concurrent writes -> ok")
+
+print("OK")
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+# Group commit (enrollsvc/db_commit.py), against a scratch DB. This needs the
+# enrollsvc code (ie. /hcp) but nothing else, so it can be run in the enrollsvc
+# container (or anywhere with /hcp);
+#     python3 test_group_commit.py [N [min_speedup]]
+# It checks that;
+#  - submit_many() commits a batch as one commit, with a result per item (in
+#    order), and that an item that can't be committed (an already-enrolled TPM)
+#    fails on its own without affecting the others.
+#  - N adds submitted concurrently (by 'procs' processes) all get committed,
+#    each caller gets its own result, and they get committed in batches (fewer
+#    commits than adds, whose batch sizes add up to the number of adds).
+#  - the concurrent adds/sec is at least 'min_speedup' (default 2) times the
+#    adds/sec for N adds submitted one after the other.
+# Each commit's cost grows with the DB, which is what batching saves on, so
+# the speedup grows with N; it's around 2x at N=200, and 3x or more at the
+# default N=400 (even on one CPU). Much smaller N won't show it.
+
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+N = 400
+if len(sys.argv) > 1:
+	N = int(sys.argv[1])
+min_speedup = 2
+if len(sys.argv) > 2:
+	min_speedup = float(sys.argv[2])
+procs = 16
+
+scratch = tempfile.mkdtemp()
+state = f"{scratch}/state"
+repo = f"{state}/db/enrolldb.git"
+cfg = f"{scratch}/test_group_commit.json"
+with open(cfg, 'w') as f:
+	json.dump({ 'enrollsvc': { 'state': state } }, f)
+os.environ['HCP_CONFIG_FILE'] = cfg
+os.environ['HCP_NOTRACEFILE'] = '1'
+
+def git(*args):
+	return subprocess.run([ 'git', '-C', repo ] + list(args), check = True,
+			stdout = subprocess.PIPE, text = True).stdout
+
+# The same as enrollsvc/init_repo.sh
+os.makedirs(f"{repo}/ekpubhash")
+git('init', '-q')
+git('config', 'user.email', 'do-not-reply@nowhere.special')
+git('config', 'user.name', 'test_group_commit')
+for name in [ 'hn2ek', 'hn2ek-rev' ]:
+	with open(f"{repo}/{name}", 'w') as f:
+		f.write('[]\n')
+open(f"{repo}/ekpubhash/do_not_remove", 'w').close()
+git('add', '.')
+git('commit', '-q', '-m', 'Initial commit')
+
+sys.path.insert(1, '/hcp/enrollsvc')
+import db_common
+import db_commit
+
+# An enrollment's assets, as attest-enroll would leave them (for our purposes)
+def assets(tag):
+	d = tempfile.mkdtemp(dir = scratch)
+	ekpub = f"ekpub for {tag}\n".encode()
+	with open(f"{d}/ek.pub", 'wb') as f:
+		f.write(ekpub)
+	with open(f"{d}/hostname", 'w') as f:
+		f.write(f"{tag}.example.com\n")
+	return hashlib.sha256(ekpub).hexdigest(), f"{tag}.example.com", d
+
+def add(tag):
+	ekpubhash, hostname, d = assets(tag)
+	try:
+		result = db_commit.submit('add', ekpubhash, hostname, '{}', d)
+	except Exception as e:
+		result = type(e).__name__
+	return tag, ekpubhash, result
+
+def commits():
+	return int(git('rev-list', '--count', 'HEAD'))
+
+def committed_hostname(ekpubhash):
+	return git('show', f"HEAD:{db_common.fpath_rel(ekpubhash)}/hostname").strip()
+
+def fail(msg):
+	print(f"FAIL: {msg}")
+	sys.exit(1)
+
+# submit_many(): one commit, a result per item
+before = commits()
+items = [ assets(f"many{i}") for i in range(10) ]
+items = [ ('add', h, hn, '{}', d) for h, hn, d in items ]
+results = db_commit.submit_many(items + [ items[3] ])
+if commits() != before + 1:
+	fail(f"submit_many made {commits() - before} commits")
+if any(r != { 'returncode': 0 } for r in results[:-1]):
+	fail(f"submit_many results: {results}")
+if not isinstance(results[-1], db_commit.HcpErrorTPMalreadyEnrolled):
+	fail(f"submit_many duplicate: {results[-1]}")
+print(f"submit_many -> one commit, {len(results)} results")
+
+# One after the other, half before the concurrent adds and half after. Each
+# commit rewrites hn2ek, which grows with every add, so (at this scale) adds
+# get slower as the DB grows, and this way both sets of adds see the DB at the
+# same sizes, on average.
+def serial_adds(start, end):
+	before = commits()
+	t = time.monotonic()
+	result = [ add(f"serial{i}") for i in range(start, end) ]
+	elapsed = time.monotonic() - t
+	if commits() != before + end - start:
+		fail(f"{end - start} serial adds made {commits() - before} commits")
+	return result, elapsed
+
+serial, serial_time = serial_adds(0, N // 2)
+
+# Concurrently, with every tenth caller resubmitting one of the serial adds,
+# which must fail (and only fail that caller). The pool's processes are
+# started before the clock is.
+def concurrent(i):
+	if i % 10 == 0:
+		tag, ekpubhash, result = add(serial[i // 2][0])
+		return f"dup{i}", ekpubhash, result
+	return add(f"concurrent{i}")
+
+before = commits()
+head = git('rev-parse', 'HEAD').strip()
+with ProcessPoolExecutor(max_workers = procs,
+		mp_context = multiprocessing.get_context('fork')) as pool:
+	list(pool.map(time.sleep, [ 0.1 ] * procs))
+	t = time.monotonic()
+	results = list(pool.map(concurrent, range(N)))
+	concurrent_time = time.monotonic() - t
+added = 0
+for tag, ekpubhash, result in results:
+	if tag.startswith('dup'):
+		if result != 'HcpErrorTPMalreadyEnrolled':
+			fail(f"{tag}: {result}")
+		continue
+	if result != { 'returncode': 0 }:
+		fail(f"{tag}: {result}")
+	if committed_hostname(ekpubhash) != f"{tag}.example.com":
+		fail(f"{tag}: not committed")
+	added += 1
+sizes = []
+for subject in git('log', '--format=%s', f"{head}..HEAD").splitlines():
+	if subject.startswith('batch of '):
+		sizes.append(int(subject[len('batch of '):]))
+	else:
+		sizes.append(1)
+if sum(sizes) != added:
+	fail(f"{added} adds, but the commits have {sum(sizes)}")
+if len(sizes) >= added:
+	fail(f"{added} concurrent adds made {len(sizes)} commits")
+
+more, more_time = serial_adds(N // 2, N)
+serial += more
+serial_time += more_time
+hn2ek = json.loads(git('show', 'HEAD:hn2ek'))
+if len(hn2ek) != 10 + N + added:
+	fail(f"hn2ek has {len(hn2ek)} entries")
+
+serial_rate = N / serial_time
+concurrent_rate = N / concurrent_time
+speedup = concurrent_rate / serial_rate
+print(f"serial -> {serial_rate:.1f} adds/sec")
+print(f"concurrent -> {concurrent_rate:.1f} adds/sec ({speedup:.2f}x), "
+	f"{added} adds in {len(sizes)} commits (largest {max(sizes)})")
+if speedup < min_speedup:
+	fail(f"concurrent adds are only {speedup:.2f}x as fast as serial ones")
+
+git('fsck', '--strict', '--no-progress')
+if git('status', '--porcelain'):
+	fail("working tree isn't clean")
+print("OK")